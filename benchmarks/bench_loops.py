@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Event loop benchmark.
+
+Runs the same workload through STKServer with stand-in STK processes on the asyncio and uvloop event loops:
+- startup: time until N servers report that they are online
+- throughput: log lines per second through handle_stdout and the log_event handlers
+- command latency: network console round trip of STKServer.probe()
+Every loop is measured in a separate Python process.
+
+Usage: python benchmarks/bench_loops.py [--servers 20] [--lines 200000] [--probes 2000] [--loop asyncio uvloop]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from functools import partial
+
+benchdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(benchdir))
+fake_stk = os.path.join(benchdir, 'fake_supertuxkart.py')
+
+
+def percentile(values, fraction: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+async def _on_ready(event: asyncio.Event, *args, **kwargs):
+    event.set()
+
+
+async def _on_log(counter: list, done: asyncio.Event, event, message: str, *args, **kwargs):
+    counter[0] += 1
+    if message == 'fake-flood done':
+        done.set()
+
+
+async def run_loop(args) -> dict:
+    import stkserver_wrapper
+    logger = logging.getLogger('bench')
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    # the lines are counted by the handler, don't spend the time on logging them
+    logger.disabled = True
+    stkserver_wrapper.install_child_watcher('auto', logger)
+    workdir = os.path.join(benchdir, 'workdir')
+    os.makedirs(workdir, exist_ok=True)
+    servers = []
+    ready_events = []
+    _start = time.perf_counter()
+    for i in range(args.servers):
+        server = stkserver_wrapper.STKServer(
+            logger, print, f'bench{i}', cfgpath='server.xml', datapath=workdir,
+            executable_path=fake_stk, cwd=workdir, autorestart=False
+        )
+        _ready = asyncio.Event()
+        server.ready_event.add_handler(partial(_on_ready, _ready))
+        await server.launch()
+        servers.append(server)
+        ready_events.append(_ready)
+    await asyncio.wait_for(asyncio.gather(*(event.wait() for event in ready_events)), 120)
+    startup = time.perf_counter() - _start
+
+    server = servers[0]
+    counter = [0]
+    _done = asyncio.Event()
+    server.log_event.add_handler(partial(_on_log, counter, _done))
+    _start = time.perf_counter()
+    await server.stuff(f'fake-flood {args.lines}')
+    await asyncio.wait_for(_done.wait(), 600)
+    throughput = counter[0] / (time.perf_counter() - _start)
+
+    latencies = []
+    for _ in range(args.probes):
+        _latency = await server.probe(5)
+        if _latency is not None:
+            latencies.append(_latency)
+
+    for server in servers:
+        server.restart = False
+    await asyncio.gather(*(server.stop(10) for server in servers))
+    return {
+        'loop': type(asyncio.get_running_loop()).__module__.partition('.')[0],
+        'servers': args.servers,
+        'startup_s': startup,
+        'lines_per_s': throughput,
+        'probe_p50_ms': percentile(latencies, 0.5) * 1000,
+        'probe_p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--servers', type=int, default=20)
+    parser.add_argument('--lines', type=int, default=200000)
+    parser.add_argument('--probes', type=int, default=2000)
+    parser.add_argument('--loop', nargs='+', default=['asyncio', 'uvloop'])
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        import stkserver_wrapper
+        _, _loop = stkserver_wrapper.event_loop_factory(args.loop[0])
+        if _loop != args.loop[0]:
+            print(json.dumps(None))
+            return
+        print(json.dumps(stkserver_wrapper.run(run_loop(args), args.loop[0])))
+        return
+    results = []
+    for loop in args.loop:
+        _proc = subprocess.run((sys.executable, __file__, '--child', '--servers', str(args.servers), '--lines', str(args.lines),
+                                '--probes', str(args.probes), '--loop', loop),
+                               stdout=subprocess.PIPE, check=True)
+        _result = json.loads(_proc.stdout.decode().strip().splitlines()[-1])
+        if _result is None:
+            print(f'{loop} is not available, skipped')
+            continue
+        results.append(_result)
+    if not results:
+        return
+    columns = tuple(results[0].keys())
+    print(' | '.join(f'{column:>14}' for column in columns))
+    for result in results:
+        print(' | '.join(f'{result[column]:>14.2f}' if isinstance(result[column], float) else f'{result[column]:>14}'
+                         for column in columns))
+
+
+if __name__ == '__main__':
+    main()
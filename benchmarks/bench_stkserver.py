@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark suite of STKServer with stand-in STK processes (fake_supertuxkart.py).
+
+parse   - lines per second through STKServer.handle_stdout, without a process
+latency - delay between a line written by the server and its log_event handler,
+          with N servers producing the traffic of busy soccer servers
+storm   - start, restart and stop of N servers at once, like after the wrapper start or an add-on update
+memory  - wrapper Python heap (tracemalloc) and tasks per running server
+fairness - delay of the lines of quiet servers while one server floods its output,
+           with and without the reader budgets
+
+Usage: python benchmarks/bench_stkserver.py [--servers 50] [--lines 200000] [--noise-rate 200] [--duration 10]
+                                            [--scenario parse latency storm memory fairness]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+import tracemalloc
+from functools import partial
+
+benchdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(benchdir))
+fake_stk = os.path.join(benchdir, 'fake_supertuxkart.py')
+workdir = os.path.join(benchdir, 'workdir')
+sample_lines = (
+    '[info   ] STKHost: 192.168.0.7:2759 has just connected. There are now 1 peers.\n',
+    '[debug  ] ServerLobby: playerjoin player7 7\n',
+    '[debug  ] ServerLobby: player7 validated\n',
+    '[info   ] ServerLobby: Max ping from peers: 120, jitter tolerance: 20\n',
+    '[debug  ] SoccerWorld: goal player7 red.\n',
+    '[verbose] STKHost: heartbeat 1700000000.000000\n',
+    '[info   ] ProtocolManager: A 10GameProtocol protocol has been terminated.\n',
+    '[debug  ] ServerLobby: playerleave player7 7\n',
+    '[info   ] STKHost: 192.168.0.7:2759 has just disconnected. There are now 0 peers.\n',
+    'Unknown command: something\n',
+)
+
+
+def percentile(values, fraction: float) -> float:
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def make_logger() -> logging.Logger:
+    logger = logging.getLogger('bench')
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    logger.disabled = True
+    return logger
+
+
+def make_server(stkserver_wrapper, logger: logging.Logger, i: int, extra_args=(), **kwargs):
+    server = stkserver_wrapper.STKServer(
+        logger, print, f'bench{i}', cfgpath='server.xml', datapath=workdir,
+        executable_path=fake_stk, cwd=workdir, autorestart=False, extra_args=list(extra_args), **kwargs
+    )
+    # the handlers of the benchmarks need the verbose heartbeat lines
+    server.subscribe_log('bench', '*', logging.DEBUG, 'benchmark handlers')
+    return server
+
+
+async def _count(counter: list, *args, **kwargs):
+    counter[0] += 1
+
+
+async def _on_ready(event: asyncio.Event, *args, **kwargs):
+    event.set()
+
+
+async def _heartbeat(latencies: list, event, message: str, *args, **kwargs):
+    if message.startswith('heartbeat '):
+        latencies.append(time.time() - float(message[10:]))
+
+
+async def _flood_done(done: asyncio.Event, event, message: str, *args, **kwargs):
+    if message == 'fake-flood done':
+        done.set()
+
+
+async def bench_parse(stkserver_wrapper, args):
+    logger = make_logger()
+    server = make_server(stkserver_wrapper, logger, 0)
+    counter = [0]
+    server.log_event.add_handler(partial(_count, counter))
+    server.ready_event.add_handler(partial(_count, counter))
+    lines = sample_lines * (args.lines // len(sample_lines))
+    _start = time.perf_counter()
+    for line in lines:
+        await server.handle_stdout(line)
+    _elapsed = time.perf_counter() - _start
+    print(f'parse: {len(lines) / _elapsed:.0f} lines/s through handle_stdout, '
+          f'{_elapsed / len(lines) * 1e6:.2f} us per line, {counter[0]} handler calls')
+
+
+async def launch_all(servers, timeout=300.0) -> float:
+    events = []
+    for server in servers:
+        _ready = asyncio.Event()
+        server.ready_event.add_handler(partial(_on_ready, _ready))
+        events.append(_ready)
+    _start = time.perf_counter()
+    await asyncio.gather(*(server.launch() for server in servers))
+    await asyncio.wait_for(asyncio.gather(*(event.wait() for event in events)), timeout)
+    return time.perf_counter() - _start
+
+
+async def stop_all(servers):
+    for server in servers:
+        server.restart = False
+    await asyncio.gather(*(server.stop(10) for server in servers if server.active))
+    while any(server.active for server in servers):
+        await asyncio.sleep(0.05)
+
+
+async def bench_latency(stkserver_wrapper, args):
+    logger = make_logger()
+    _traffic = ('--fake-noise-rate', str(args.noise_rate), '--fake-join-rate', '0.5', '--fake-goal-rate', '0.5',
+                '--fake-game-length', '30', '--fake-session', '20')
+    servers = [make_server(stkserver_wrapper, logger, i, _traffic) for i in range(args.servers)]
+    latencies = []
+    for server in servers:
+        server.log_event.add_handler(partial(_heartbeat, latencies))
+    await launch_all(servers)
+    latencies.clear()
+    await asyncio.sleep(args.duration)
+    _count = len(latencies)
+    await stop_all(servers)
+    print(f'latency: {args.servers} servers x {args.noise_rate:.0f} lines/s, {_count / args.duration:.0f} lines/s handled, '
+          f'p50 {percentile(latencies, 0.5) * 1000:.2f} ms, p99 {percentile(latencies, 0.99) * 1000:.2f} ms, '
+          f'max {max(latencies, default=float("nan")) * 1000:.2f} ms')
+
+
+async def bench_storm(stkserver_wrapper, args):
+    logger = make_logger()
+    for guarded in (False, True):
+        # the wrapper serializes the starts with start_stop_guard, because concurrent startup of STK 1.4 is broken
+        _guard = asyncio.Lock() if guarded else None
+        servers = [make_server(stkserver_wrapper, logger, i, ('--fake-ready-delay', str(args.ready_delay)),
+                               start_stop_guard=_guard) for i in range(args.servers)]
+        _start = await launch_all(servers)
+        _ready = [asyncio.Event() for _ in servers]
+        for server, event in zip(servers, _ready):
+            server.ready_event.add_handler(partial(_on_ready, event))
+            server.autorestart = True
+            server.autorestart_pause = 0.0
+        _begin = time.perf_counter()
+        for server in servers:
+            server.restart = True
+        await asyncio.gather(*(server.stop(10) for server in servers))
+        await asyncio.wait_for(asyncio.gather(*(event.wait() for event in _ready)), 300)
+        _restart = time.perf_counter() - _begin
+        _begin = time.perf_counter()
+        await stop_all(servers)
+        _stop = time.perf_counter() - _begin
+        print(f'storm{" (start_stop_guard)" if guarded else ""}: {args.servers} servers, start {_start:.2f} s, '
+              f'restart {_restart:.2f} s, stop {_stop:.2f} s')
+
+
+async def bench_memory(stkserver_wrapper, args):
+    logger = make_logger()
+    # warm up the caches and lazy imports with one server, so they don't count
+    servers = [make_server(stkserver_wrapper, logger, 0)]
+    await launch_all(servers)
+    await stop_all(servers)
+    tracemalloc.start()
+    _before = tracemalloc.take_snapshot()
+    _tasks = len(asyncio.all_tasks())
+    servers = [make_server(stkserver_wrapper, logger, i) for i in range(args.servers)]
+    await launch_all(servers)
+    _after = tracemalloc.take_snapshot()
+    _size = sum(stat.size_diff for stat in _after.compare_to(_before, 'filename'))
+    tracemalloc.stop()
+    print(f'memory (tracemalloc, Python heap): {_size / 1024 / args.servers:.1f} KiB and '
+          f'{(len(asyncio.all_tasks()) - _tasks) / args.servers:.1f} tasks per running server')
+    await stop_all(servers)
+
+
+async def bench_fairness(stkserver_wrapper, args):
+    logger = make_logger()
+    for budget in (False, True):
+        _budget = {} if budget else {'reader_budget_lines': 0, 'reader_budget_ms': 0}
+        servers = [make_server(stkserver_wrapper, logger, i, ('--fake-noise-rate', '50'), **_budget)
+                   for i in range(args.servers)]
+        latencies = []
+        for server in servers[1:]:
+            server.log_event.add_handler(partial(_heartbeat, latencies))
+        _done = asyncio.Event()
+        servers[0].log_event.add_handler(partial(_flood_done, _done))
+        await launch_all(servers)
+        await asyncio.sleep(1)
+        latencies.clear()
+        _start = time.perf_counter()
+        await servers[0].stuff(f'fake-flood {args.lines}')
+        await asyncio.wait_for(_done.wait(), 600)
+        _elapsed = time.perf_counter() - _start
+        _latencies = tuple(latencies)
+        await stop_all(servers)
+        print(f'fairness{" (reader budgets)" if budget else ""}: {args.lines} lines flooded in {_elapsed:.2f} s, '
+              f'{args.servers - 1} quiet servers p50 {percentile(_latencies, 0.5) * 1000:.2f} ms, '
+              f'p99 {percentile(_latencies, 0.99) * 1000:.2f} ms, max {max(_latencies, default=float("nan")) * 1000:.2f} ms, '
+              f'{servers[0].reader_overruns} budget overruns')
+
+
+scenarios = {
+    'parse': bench_parse,
+    'latency': bench_latency,
+    'storm': bench_storm,
+    'memory': bench_memory,
+    'fairness': bench_fairness,
+}
+
+
+async def run(args):
+    import stkserver_wrapper
+    os.makedirs(workdir, exist_ok=True)
+    stkserver_wrapper.install_child_watcher('auto', make_logger())
+    for scenario in args.scenario:
+        await scenarios[scenario](stkserver_wrapper, args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--servers', type=int, default=50)
+    parser.add_argument('--lines', type=int, default=200000, help='lines for the parse scenario')
+    parser.add_argument('--noise-rate', type=float, default=200.0, help='lines per second of every server in the latency scenario')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of the latency scenario')
+    parser.add_argument('--ready-delay', type=float, default=0.2, help='startup seconds of every server in the storm scenario')
+    parser.add_argument('--scenario', nargs='+', choices=tuple(scenarios), default=list(scenarios))
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Child process supervision benchmark.
+
+Launches N stand-in STK servers through STKServer with every child watcher backend
+and compares the thread count, memory and task count of the wrapper,
+as well as the latency between killing a process and the wrapper noticing its exit.
+Every backend is measured in a separate Python process, because the child watcher is process-wide.
+
+Usage: python benchmarks/bench_supervision.py [--count 200] [--watcher threaded pidfd]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from functools import partial
+
+benchdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(benchdir))
+fake_stk = os.path.join(benchdir, 'fake_supertuxkart.py')
+
+
+def rss_kb() -> int:
+    with open('/proc/self/status') as file:
+        for line in file:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def percentile(values, fraction: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+async def _on_ready(event: asyncio.Event, *args, **kwargs):
+    event.set()
+
+
+async def run_backend(watcher: str, count: int) -> dict:
+    import stkserver_wrapper
+    logger = logging.getLogger('bench')
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    used = stkserver_wrapper.install_child_watcher(watcher, logger)
+    workdir = os.path.join(benchdir, 'workdir')
+    os.makedirs(workdir, exist_ok=True)
+    baseline_threads = threading.active_count()
+    baseline_rss = rss_kb()
+    servers = []
+    ready_events = []
+    _start = time.perf_counter()
+    for i in range(count):
+        server = stkserver_wrapper.STKServer(
+            logger, print, f'bench{i}', cfgpath='server.xml', datapath=workdir,
+            executable_path=fake_stk, cwd=workdir, autorestart=False
+        )
+        _ready = asyncio.Event()
+        server.ready_event.add_handler(partial(_on_ready, _ready))
+        await server.launch()
+        servers.append(server)
+        ready_events.append(_ready)
+    await asyncio.wait_for(asyncio.gather(*(event.wait() for event in ready_events)), 120)
+    startup = time.perf_counter() - _start
+    threads = threading.active_count() - baseline_threads
+    tasks = len(asyncio.all_tasks())
+    rss = rss_kb() - baseline_rss
+
+    loop = asyncio.get_running_loop()
+    latencies = []
+
+    async def _kill_and_wait(server):
+        server.restart = False
+        process = server.process
+        _killed = loop.time()
+        process.kill()
+        await process.wait()
+        latencies.append(loop.time() - _killed)
+    await asyncio.gather(*(_kill_and_wait(server) for server in servers))
+    await asyncio.sleep(0.5)
+    return {
+        'watcher': used,
+        'count': count,
+        'startup_s': startup,
+        'extra_threads': threads,
+        'tasks': tasks,
+        'rss_delta_kb': rss,
+        'exit_latency_p50_ms': percentile(latencies, 0.5) * 1000,
+        'exit_latency_p99_ms': percentile(latencies, 0.99) * 1000,
+        'exit_latency_max_ms': max(latencies) * 1000,
+        'exit_latency_mean_ms': statistics.mean(latencies) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type=int, default=200)
+    parser.add_argument('--watcher', nargs='+', default=['threaded', 'pidfd'])
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        print(json.dumps(asyncio.run(run_backend(args.watcher[0], args.count))))
+        return
+    results = []
+    for watcher in args.watcher:
+        _proc = subprocess.run((sys.executable, __file__, '--child', '--count', str(args.count), '--watcher', watcher),
+                               stdout=subprocess.PIPE, check=True)
+        results.append(json.loads(_proc.stdout.decode().strip().splitlines()[-1]))
+    columns = tuple(results[0].keys())
+    print(' | '.join(f'{column:>20}' for column in columns))
+    for result in results:
+        print(' | '.join(f'{result[column]:>20.2f}' if isinstance(result[column], float) else f'{result[column]:>20}'
+                         for column in columns))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Stand-in for the supertuxkart executable, used by the benchmarks.
+Accepts the command line of an STK server started by the wrapper,
+announces that the server is online after --fake-ready-delay seconds and produces
+the log traffic of a soccer server at the configured rates: players join and leave,
+games start and end, goals are scored, and other lines are logged as noise.
+Noise lines carry their send time, so the benchmarks can measure the delay until they are handled.
+
+The network console understands:
+quit - exits the process
+listpeers, speedstats - answers like STK does
+kick <name> - disconnects the player
+fake-flood N - writes N log lines as fast as possible, followed by "fake-flood done"
+any other command is echoed as unknown.
+"""
+import argparse
+import heapq
+import os
+import random
+import select
+import sys
+import time
+
+
+stk_levels = {'debug': 0, 'verbose': 1, 'info': 2, 'warn': 3, 'error': 4, 'fatal': 5}
+log_level = 0
+
+
+def log(level: str, objectname: str, message: str):
+    if stk_levels[level] >= log_level:
+        sys.stdout.write(f'[{level:<7}] {objectname}: {message}\n')
+
+
+class FakeServer:
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.fake_seed)
+        self.players = {}
+        self.next_id = 1
+        self.game_running = False
+        self.events = []
+        self.upload = 0
+        self.download = 0
+
+    def schedule(self, delay: float, kind: str):
+        heapq.heappush(self.events, (time.monotonic() + delay, kind))
+
+    def schedule_rate(self, rate: float, kind: str):
+        if rate > 0:
+            self.schedule(self.random.expovariate(rate), kind)
+
+    def start(self):
+        self.schedule_rate(self.args.fake_join_rate, 'join')
+        self.schedule_rate(self.args.fake_noise_rate, 'noise')
+        self.schedule(1.0, 'speed')
+
+    def join(self):
+        if len(self.players) < self.args.fake_max_players:
+            name = f'player{self.next_id}'
+            address = f'192.168.{self.next_id // 250 % 250}.{self.next_id % 250 + 1}:2759'
+            self.players[name] = (self.next_id, address, self.random.randint(20, 200))
+            log('info', 'STKHost', f'{address} has just connected. There are now {len(self.players)} peers.')
+            log('debug', 'ServerLobby', f'playerjoin {name} {self.next_id}')
+            log('debug', 'ServerLobby', f'{name} validated')
+            self.next_id += 1
+            self.schedule(self.random.expovariate(1 / self.args.fake_session), f'leave {name}')
+            if not self.game_running:
+                self.schedule(self.args.fake_game_pause, 'gamestart')
+        self.schedule_rate(self.args.fake_join_rate, 'join')
+
+    def leave(self, name: str):
+        if name not in self.players:
+            return
+        _id, address, _ = self.players.pop(name)
+        log('debug', 'ServerLobby', f'playerleave {name} {_id}')
+        log('info', 'STKHost', f'{address} has just disconnected. There are now {len(self.players)} peers.')
+
+    def game_start(self):
+        if self.game_running or not self.players:
+            return
+        self.game_running = True
+        log('info', 'ServerLobby', f'Max ping from peers: {max(ping for _, _, ping in self.players.values())}, jitter tolerance: 20')
+        self.schedule(self.args.fake_game_length, 'gameend')
+        self.schedule_rate(self.args.fake_goal_rate, 'goal')
+
+    def game_end(self):
+        self.game_running = False
+        log('info', 'ProtocolManager', 'A 10GameProtocol protocol has been terminated.')
+        if self.players:
+            self.schedule(self.args.fake_game_pause, 'gamestart')
+
+    def goal(self):
+        if not self.game_running or not self.players:
+            return
+        name = self.random.choice(tuple(self.players))
+        _own = 'own_' if self.random.random() < 0.1 else ''
+        log('debug', 'SoccerWorld', f'{_own}goal {name} {self.random.choice(("red", "blue"))}.')
+        self.schedule_rate(self.args.fake_goal_rate, 'goal')
+
+    def noise(self):
+        log('verbose', 'STKHost', f'heartbeat {time.time():.6f}')
+        self.schedule_rate(self.args.fake_noise_rate, 'noise')
+
+    def speed(self):
+        self.upload = len(self.players) * self.random.randint(2000, 6000)
+        self.download = len(self.players) * self.random.randint(1000, 3000)
+        self.schedule(1.0, 'speed')
+
+    def run_due(self):
+        _now = time.monotonic()
+        while self.events and self.events[0][0] <= _now:
+            _, kind = heapq.heappop(self.events)
+            if kind.startswith('leave '):
+                self.leave(kind[6:])
+            elif kind == 'join':
+                self.join()
+            elif kind == 'gamestart':
+                self.game_start()
+            elif kind == 'gameend':
+                self.game_end()
+            elif kind == 'goal':
+                self.goal()
+            elif kind == 'noise':
+                self.noise()
+            elif kind == 'speed':
+                self.speed()
+
+    def command(self, command: str) -> bool:
+        """Returns False when the server has to exit"""
+        if command == 'quit':
+            return False
+        if command == 'listpeers':
+            if not self.players:
+                sys.stdout.write('No peers exist\n')
+            for _id, address, _ in self.players.values():
+                sys.stdout.write(f'{_id}: {address} SuperTuxKart/1.4 (Linux)\n')
+        elif command == 'speedstats':
+            sys.stdout.write(f'Upload speed (KBps): {self.upload / 1024:f}   Download speed (KBps): {self.download / 1024:f}\n')
+        elif command.startswith('kick '):
+            self.leave(command[5:])
+        elif command.startswith('bc '):
+            pass
+        elif command.startswith('fake-flood '):
+            flood(int(command.split()[1]))
+        else:
+            sys.stdout.write(f'Unknown command: {command}\n')
+        return True
+
+
+def flood(count: int):
+    lines = (
+        '[info   ] STKHost: 192.168.0.{0}:2759 has just connected. There are now 1 peers.\n',
+        '[debug  ] ServerLobby: playerjoin player{0} {0}\n',
+        '[debug  ] SoccerWorld: goal player{0} red.\n',
+        '[info   ] STKHost: 192.168.0.{0}:2759 has just disconnected. There are now 0 peers.\n',
+    )
+    sys.stdout.writelines(lines[i % len(lines)].format(i % 250) for i in range(count))
+    log('info', 'ServerLobby', 'fake-flood done')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--server-config', default='server.xml')
+    parser.add_argument('--network-console', action='store_true')
+    parser.add_argument('--log', type=int, default=0, help='lowest level of the printed lines, 0 is debug and 5 is fatal')
+    parser.add_argument('--fake-ready-delay', type=float, default=0.0,
+                        help='seconds before the server announces that it is online')
+    parser.add_argument('--fake-join-rate', type=float, default=0.0, help='players joining per second')
+    parser.add_argument('--fake-session', type=float, default=120.0, help='mean seconds a player stays')
+    parser.add_argument('--fake-max-players', type=int, default=8)
+    parser.add_argument('--fake-game-length', type=float, default=60.0, help='seconds of a game')
+    parser.add_argument('--fake-game-pause', type=float, default=5.0, help='seconds between the games')
+    parser.add_argument('--fake-goal-rate', type=float, default=0.1, help='goals per second during a game')
+    parser.add_argument('--fake-noise-rate', type=float, default=0.0, help='other log lines per second')
+    parser.add_argument('--fake-seed', type=int, default=None)
+    args, _ = parser.parse_known_args()
+    global log_level
+    log_level = args.log
+    server = FakeServer(args)
+    log('info', 'main', f'Using server config "{args.server_config}"')
+    sys.stdout.flush()
+    time.sleep(args.fake_ready_delay)
+    log('info', 'ServerLobby', 'Server 0 is now online.')
+    log('debug', 'ServerLobby', 'Updating server info with new difficulty: 3, game mode: 6 to stk-addons.')
+    sys.stdout.flush()
+    server.start()
+    _buffer = b''
+    _running = True
+    while _running:
+        _timeout = max(server.events[0][0] - time.monotonic(), 0.0) if server.events else None
+        readable, _, _ = select.select((0, ), (), (), _timeout)
+        if readable:
+            _data = os.read(0, 65536)
+            if not _data:
+                break
+            _buffer += _data
+            *lines, _buffer = _buffer.split(b'\n')
+            for line in lines:
+                if not server.command(line.decode(errors='replace').rstrip('\r')):
+                    _running = False
+                    break
+        server.run_due()
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,7 @@
-import asyncio
 import html
 import os
 import re
+import sys
 import traceback
 import logging
 from configparser import ConfigParser
@@ -10,13 +10,17 @@ from zipfile import ZipFile
 from math import floor
 from aiohttp import ClientSession, ClientResponse
 from admin_console import AdminCommandExecutor, AdminCommandExtension, paginate_range
-from aiohndchain import AIOHandlerChain
 from defusedxml import ElementTree as dElementTree
 from xml.etree import ElementTree
 from enum import Flag, Enum
 from itertools import islice, repeat, chain, count
 from packaging.version import parse as parseVersion, InvalidVersion
 from typing import Sequence, Tuple, MutableSequence
+from functools import partial
+
+
+Interval = sys.modules['__main__'].Interval
+TimedHandlerChain = sys.modules['__main__'].TimedHandlerChain
 
 
 black_star = chr(9733)
@@ -36,6 +40,7 @@ nostatus = re.compile(r'(?:-)[a-zA-Z_]+')
 status = re.compile(r'(?:\+)?[a-zA-Z_]+')
 stripper = re.compile(r'[+-]')
 heavy_check_sign = chr(9989)
+autoupdate_job = 'addons:autoupdate'
 defaultconf = {
     'AddonUpdater': {
         'online_assets_url': 'https://online.supertuxkart.net/downloads/xml/online_assets.xml',
@@ -337,6 +342,7 @@ async def update_addon(ext: AdminCommandExtension, addon: ElementTree.Element, u
     unpack_addon(ext, _addonid, addon.tag, _archive_path)
     ext.data['installed_dict'][_addonid].attrib['revision'] = addon.attrib['revision']
     ext.logger.info(f'{addon.tag.title()} "{addon.attrib["id"]}" has been updated.')
+    await ext.addon_updated.emit(addon)
     if unoutdate:
         ext.data['updates_available'].remove(addon)
     ext.data['addonmodflag'] = True
@@ -517,32 +523,34 @@ async def update_all_installmore(ext: AdminCommandExtension, install_more=True):
 
 async def autoupdate_task(ext: AdminCommandExtension):
     try:
-        if 'stkaddons_autoupdate_task' in ext.tasks:
-            ext.logger.error('Another autoupdate_task is already running! Aborting!')
+        if not ext.mconfig.getboolean('autoupdate'):
+            ext.ace.scheduler.remove_job(autoupdate_job)
             return
-        ext.tasks['stkaddons_autoupdate_task'] = asyncio.current_task()
-        if 'autoupdate_interval' not in ext.mconfig:
-            raise KeyError('autoupdate_interval is not set in ext.mconfig')
-        ext.logger.info(f'Autofetcher is enabled. Interval = {ext.mconfig["autoupdate_interval"]} seconds')
-        while ext.mconfig.getboolean('autoupdate'):
-            await asyncio.sleep(ext.mconfig.getfloat('autoupdate_interval'))
-            await fetch(ext)
-            await update_all(ext)
-            if ext.mconfig.getboolean('autoinstall'):
-                await install_new_addons(ext)
-            ext.logger.info('Cleaning downloads directory')
-            clear_directory(ext.mconfig['downloadpath'])
-            if ext.data['addonmodflag']:
-                ext.ace.server_restart_clk()
-            ext.data['addonmodflag'] = False
+        await fetch(ext)
+        await update_all(ext)
+        if ext.mconfig.getboolean('autoinstall'):
+            await install_new_addons(ext)
+        ext.logger.info('Cleaning downloads directory')
+        clear_directory(ext.mconfig['downloadpath'])
+        if ext.data['addonmodflag']:
+            ext.ace.server_restart_clk()
+        ext.data['addonmodflag'] = False
     except Exception:
         ext.logger.error(traceback.format_exc())
 
 
+def schedule_autoupdate(ext: AdminCommandExtension):
+    if 'autoupdate_interval' not in ext.mconfig:
+        raise KeyError('autoupdate_interval is not set in ext.mconfig')
+    ext.logger.info(f'Autofetcher is enabled. Interval = {ext.mconfig["autoupdate_interval"]} seconds')
+    ext.ace.scheduler.add_job(autoupdate_job, partial(autoupdate_task, ext),
+                              Interval(ext.mconfig.getfloat('autoupdate_interval')), owner='addon_updater')
+
+
 def stkaddons_command_set(ext: AdminCommandExtension):
     async def check_available(cmd: AdminCommandExecutor):
         cmd.print('Checking...')
-        asyncio.create_task(fetch(ext))
+        ext.ace.task_registry.spawn(fetch(ext), owner='addon_updater', tasks=ext.tasks)
     ext.add_command(check_available, 'check-available', tuple(), tuple(), 'Check if there are any available addons to update')
 
     async def listaddons(cmd: AdminCommandExecutor, cpage: int = 1, flags_: str = None, not_installed=False):
@@ -672,7 +680,8 @@ def stkaddons_command_set(ext: AdminCommandExtension):
             cmd.error(f'Addon {addonid} not found.')
             return
         _addon: ElementTree.Element = ext.data['addons_dict'][addonid]
-        asyncio.create_task(download_addon(cmd, addonid, _addon.attrib['file']))
+        ext.ace.task_registry.spawn(download_addon(cmd, addonid, _addon.attrib['file']), owner='addon_updater',
+                                    description=f'download {addonid}', tasks=ext.tasks)
         cmd.print('Starting to download addon {addonid}')
 
     async def downloadaddon_tab(cmd: AdminCommandExecutor, addonid: str = '', *, argl: str):
@@ -705,8 +714,8 @@ def stkaddons_command_set(ext: AdminCommandExtension):
         if addonid not in ext.data['addons_dict']:
             cmd.error(f'Couldn\'t find addon "{addonid}"')
         _addon: ElementTree.Element = ext.data['addons_dict'][addonid]
-        task = asyncio.create_task(install_addon(ext, _addon, restart=True))
-        ext.tasks[task.get_name()] = task
+        ext.ace.task_registry.spawn(install_addon(ext, _addon, restart=True), owner='addon_updater',
+                                    description=f'install {addonid}', tasks=ext.tasks)
 
     async def installaddon_tab(cmd: AdminCommandExecutor, addonid: str = '', *, argl: str):
         def _predicate(_addon):
@@ -727,31 +736,37 @@ def stkaddons_command_set(ext: AdminCommandExtension):
         if _addon not in _updates_available:
             cmd.error(f'No available update for "{addonid}"')
             return
-        task = asyncio.create_task(update_addon(ext, _addon, restart=True))
-        ext.tasks[task.get_name()] = task
+        ext.ace.task_registry.spawn(update_addon(ext, _addon, restart=True), owner='addon_updater',
+                                    description=f'update {addonid}', tasks=ext.tasks)
 
     async def updateaddon_tab(cmd: AdminCommandExecutor, addonid: str = '', *, argl: str):
         return list(filter(lambda name: name.startswith(addonid), (addon.attrib['id'] for addon in ext.data['updates_available'])))
     ext.add_command(updateaddon, 'updateaddon', ((str, 'addonid'), ), description='Install update for an addon', atabcomplete=updateaddon_tab)
 
     async def updateall(cmd: AdminCommandExecutor, _installnew=False):
-        task = asyncio.create_task(update_all_installmore(ext, _installnew))
-        ext.tasks[task.get_name()] = task
+        ext.ace.task_registry.spawn(update_all_installmore(ext, _installnew), owner='addon_updater', tasks=ext.tasks)
     ext.add_command(updateall, 'updateall', optargs=((bool, 'install new addons?'), ), description='Install all available updates (and download more addons if specified)')
 
 
 async def extension_init(ext: AdminCommandExtension):
     ext.data['addonmodflag'] = False
-    ext.addon_installed = AIOHandlerChain()  # (addon: Element)
-    ext.addon_uninstalled = AIOHandlerChain()  # (addon: Element)
-    ext.addon_updated = AIOHandlerChain()  # (addon: Element)
+    ext.addon_installed = TimedHandlerChain('addon_installed')  # (addon: Element)
+    ext.addon_uninstalled = TimedHandlerChain('addon_uninstalled')  # (addon: Element)
+    ext.addon_updated = TimedHandlerChain('addon_updated')  # (addon: Element)
     # fired explicitly
-    ext.addon_bulk_modified = AIOHandlerChain(cancellable=False)  # ()
+    ext.addon_bulk_modified = TimedHandlerChain('addon_bulk_modified', cancellable=False)  # ()
+    ext.events = getattr(ext.ace, 'events', None)
+    if ext.events is not None:
+        for addon_chain in (ext.addon_installed, ext.addon_uninstalled, ext.addon_updated):
+            addon_chain.add_handler(partial(_publish_addon, ext))
+        ext.addon_bulk_modified.add_handler(partial(_publish_bulk_modified, ext))
     ext.mconfig_path = config_path = os.path.join(ext.ace.extpath, 'stkswrapper.conf')
 
     def save_config(newfile=False):
         with open(config_path, 'x' if newfile else 'w') as file:
             ext.config.write(file)
+        if getattr(ext, 'file_watcher', None) is not None:
+            ext.file_watcher.note_written(config_path)
 
     def load_config():
         ext.config.read(config_path)
@@ -773,9 +788,32 @@ async def extension_init(ext: AdminCommandExtension):
     stkaddons_command_set(ext)
     ext.clientsession = ClientSession()
     if ext.mconfig.getboolean('autoupdate'):
-        asyncio.create_task(autoupdate_task(ext))
+        schedule_autoupdate(ext)
+    ext.file_watcher = getattr(ext.ace, 'file_watcher', None)
+    if ext.file_watcher is not None:
+        ext.file_watcher.watch(config_path, partial(_on_config_changed, ext), owner='addon_updater')
     # asyncio.create_task(fetch(ext))
 
 
+async def _publish_addon(ext: AdminCommandExtension, event: TimedHandlerChain, addon: ElementTree.Element, *args, **kwargs):
+    ext.events.publish(event.name, id=addon.attrib.get('id'), name=addon.attrib.get('name'), kind=addon.tag,
+                       revision=addon.attrib.get('revision'))
+
+
+async def _publish_bulk_modified(ext: AdminCommandExtension, event: TimedHandlerChain, *args, **kwargs):
+    ext.events.publish(event.name)
+
+
+def _on_config_changed(ext: AdminCommandExtension, path: str):
+    ext.load_config()
+    if ext.mconfig.getboolean('autoupdate'):
+        schedule_autoupdate(ext)
+    else:
+        ext.ace.scheduler.remove_job(autoupdate_job)
+
+
 async def extension_cleanup(ext: AdminCommandExtension):
+    ext.ace.scheduler.remove_job(autoupdate_job, forget=False)
+    if ext.file_watcher is not None:
+        ext.file_watcher.unwatch_owner('addon_updater')
     await ext.clientsession.close()
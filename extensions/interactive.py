@@ -1,9 +1,21 @@
 from admin_console import AdminCommandExtension, AdminCommandExecutor
 # from code import InteractiveInterpreter
 from functools import partial
+from collections import Counter
+from io import StringIO
+import asyncio
+import cProfile
+import pstats
+import threading
+import tracemalloc
+import sys
+import os
 import re
 
 
+collapsed_suffixes = ('.collapsed', '.folded')
+
+
 async def aexec(code, globals_=globals(), locals_=locals()):
     # Make an async function with the code and `exec` it
     if '__ex' in locals_:
@@ -25,6 +37,23 @@ async def aexec(code, globals_=globals(), locals_=locals()):
     return _val
 
 
+def print_top(cmd: AdminCommandExecutor, profile: cProfile.Profile, top: int):
+    _stream = StringIO()
+    pstats.Stats(profile, stream=_stream).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top)
+    cmd.print(_stream.getvalue().strip('\n'))
+
+
+def sample_stacks(thread_id: int, interval: float, stop: threading.Event, counts: Counter):
+    """Collects the stacks of a thread for the flame graph tools, without tracing every call like cProfile does"""
+    while not stop.wait(interval):
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            stack.append(f'{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_firstlineno})')
+            frame = frame.f_back
+        counts[';'.join(reversed(stack))] += 1
+
+
 async def extension_init(ext: AdminCommandExtension):
     await_p = re.compile(r'await +(.*)')
     _locals = ext.locals = {'ext': ext, 'cmd': ext.ace, 'print': ext.ace.print}
@@ -68,6 +97,76 @@ async def extension_init(ext: AdminCommandExtension):
                 exec(_line, _locals)
     ext.add_command(pyexec_console, 'pyexec-console', optargs=((None, 'quitstr'), ), description='Enter interactive Python console "quit" to return back')
 
+    async def profile_for(cmd: AdminCommandExecutor, seconds: float, output: str = '', top: int = 30):
+        if output.endswith(collapsed_suffixes):
+            _counts = Counter()
+            _stop = threading.Event()
+            _sampler = threading.Thread(target=sample_stacks, args=(threading.get_ident(), 0.002, _stop, _counts), daemon=True)
+            _sampler.start()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                _stop.set()
+                _sampler.join()
+            with open(output, 'w') as file:
+                file.writelines(f'{stack} {count}\n' for stack, count in _counts.items())
+            cmd.print(f'{sum(_counts.values())} samples saved to "{output}"')
+            return
+        _profile = cProfile.Profile()
+        _profile.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            _profile.disable()
+        if output:
+            _profile.dump_stats(output)
+            cmd.print(f'Profile saved to "{output}", open it with python -m pstats')
+        else:
+            print_top(cmd, _profile, top)
+    ext.add_command(profile_for, 'profile-for', ((float, 'seconds'), ), ((str, 'output file'), (int, 'top')),
+                    description='Profile the running wrapper for N seconds, print the top functions or save them to a file. '
+                                'Files ending with .collapsed or .folded get sampled stacks for flame graphs, others get pstats')
+
+    async def profile_await(cmd: AdminCommandExecutor, expr: str):
+        _profile = cProfile.Profile()
+        _profile.enable()
+        try:
+            _val = await eval(expr, _locals)
+        finally:
+            _profile.disable()
+        print_top(cmd, _profile, 30)
+        _locals['_'] = _val
+    ext.add_command(profile_await, 'profile-await', ((None, 'python awaitable expression'), ),
+                    description='Profile the evaluation of an awaitable expression and print the top functions')
+
+    ext.snapshot = None
+
+    async def tracemalloc_snapshot(cmd: AdminCommandExecutor, frames: int = 1):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            cmd.print(f'Tracing allocations with {frames} frames, take a snapshot later to see the growth')
+        ext.snapshot = tracemalloc.take_snapshot()
+        _current, _peak = tracemalloc.get_traced_memory()
+        cmd.print(f'Snapshot taken, {_current / 1048576:.1f} MiB traced, peak {_peak / 1048576:.1f} MiB')
+    ext.add_command(tracemalloc_snapshot, 'tracemalloc-snapshot', optargs=((int, 'frames'), ),
+                    description='Start tracing the allocations and remember a snapshot to compare with')
+
+    async def tracemalloc_diff(cmd: AdminCommandExecutor, top: int = 20):
+        if ext.snapshot is None or not tracemalloc.is_tracing():
+            cmd.error('Take a snapshot first with tracemalloc-snapshot', log=False)
+            return
+        _snapshot = tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__), ))
+        cmd.print(f'Allocation growth since the snapshot, top {top} lines:')
+        cmd.print(*(str(stat) for stat in _snapshot.compare_to(ext.snapshot, 'lineno')[:top]), sep='\n')
+    ext.add_command(tracemalloc_diff, 'tracemalloc-diff', optargs=((int, 'top'), ),
+                    description='Show the allocation growth by line since the last snapshot')
+
+    async def tracemalloc_stop(cmd: AdminCommandExecutor):
+        tracemalloc.stop()
+        ext.snapshot = None
+        cmd.print('Allocation tracing stopped')
+    ext.add_command(tracemalloc_stop, 'tracemalloc-stop', description='Stop tracing the allocations and free the snapshot')
+
 
 async def extension_cleanup(ext: AdminCommandExtension):
-    pass
+    ext.snapshot = None
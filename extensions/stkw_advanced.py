@@ -11,13 +11,16 @@ on starting servers
 
 from admin_console import AdminCommandExtension, AdminCommandExecutor, paginate_range
 from aiohndchain import AIOHandlerChain
-from typing import Optional, MutableMapping, Union
+from typing import Optional, Mapping, MutableMapping, MutableSequence, Iterable, Sequence, Tuple, Union
 from defusedxml import ElementTree as dElementTree
 from xml.etree import ElementTree
+from bisect import bisect_left
 from collections import defaultdict
 from functools import partial
 from configparser import ConfigParser
+from fnmatch import fnmatchcase
 import emoji
+import copy
 import weakref
 import os
 import sys
@@ -25,6 +28,7 @@ import asyncio
 import re
 import logging
 import datetime
+import time
 
 
 # joinmsg_parser = re.compile(r'New player (?P<username>\S+) with online id (?P<online_id>\d+) from '
@@ -45,6 +49,8 @@ soccergoal_logobject = 'SoccerWorld'
 soccergoal_loglevel = logging.DEBUG
 main = sys.modules['__main__']
 STKServer = main.STKServer
+OneShot = main.OneShot
+TimedHandlerChain = main.TimedHandlerChain
 gamemode_names = (
     'normal grand prix',
     'time-trial grand prix',
@@ -70,8 +76,11 @@ defaultconf = {
         'servers': '',
         'sayNiceWhen69': True,
         'sayBrDeFlagsWhen17': True
-    }
+    },
+    # tag = server names or globs separated with spaces, used by tag:<name> selectors
+    'Tags': {}
 }
+tag_prefix = 'tag:'
 
 
 def load_stkdefault(ext: AdminCommandExtension):
@@ -81,6 +90,129 @@ def load_stkdefault(ext: AdminCommandExtension):
     ext.logmsg(f'"{ext.stkdefaultxml_path}" loaded')
 
 
+def write_atomic(path: str, data: bytes):
+    """Writes the file through a temporary one, so that STK never reads a partially written config"""
+    _tmppath = f'{path}.tmp'
+    with open(_tmppath, 'wb') as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(_tmppath, path)
+
+
+class ConfigIndex:
+    """
+    Tag to element map of a server config, the first element wins,
+    and the sorted tags for the prefix completion. The elements are shared with the config,
+    so only a structural change (a new element, a reloaded file) needs a new index
+    """
+    __slots__ = ('elements', 'keys')
+
+    def __init__(self, root: ElementTree.Element):
+        self.elements: MutableMapping[str, ElementTree.Element] = {}
+        for element in root.iter():
+            if element is not root:
+                self.elements.setdefault(element.tag, element)
+        self.keys = sorted(self.elements)
+
+    def get(self, tag: str) -> Optional[ElementTree.Element]:
+        return self.elements.get(tag)
+
+    def complete(self, prefix: str) -> MutableSequence[str]:
+        return self.keys[bisect_left(self.keys, prefix):bisect_left(self.keys, prefix + chr(0x10ffff))]
+
+
+def config_stat(path: str) -> Optional[Tuple[int, int]]:
+    """Modification time and size of the file, None if it doesn't exist"""
+    try:
+        _stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return _stat.st_mtime_ns, _stat.st_size
+
+
+def write_config(path: str, data: bytes) -> Optional[Tuple[int, int]]:
+    write_atomic(path, data)
+    return config_stat(path)
+
+
+def effective_config(index: ConfigIndex) -> MutableMapping[str, MutableMapping[str, str]]:
+    """Attributes of every config key, which is what STK reads from the file"""
+    return {tag: dict(element.attrib) for tag, element in index.elements.items()}
+
+
+def apply_overlay(root: ElementTree.Element, overlay: ElementTree.Element):
+    """Sets the attributes of the overlay elements on the elements of the same tag, appends the missing elements"""
+    index = ConfigIndex(root)
+    for element in overlay:
+        target = index.get(element.tag)
+        if target is None:
+            root.append(copy.deepcopy(element))
+        else:
+            target.attrib.update(element.attrib)
+
+
+class TemplateCache:
+    """
+    Server configs rendered from layers: stkdefault.xml, then the overlays of the tags,
+    then the overlay of the server. Each layer file is parsed again only when its modification time or size changes,
+    and a server is rendered again only when one of its layers has changed
+    """
+    def __init__(self):
+        # path: (stat, root)
+        self.layers: MutableMapping[str, Tuple[Tuple[int, int], ElementTree.Element]] = {}
+        # server name: (stats of the layers, root, effective config)
+        self.rendered: MutableMapping[str, Tuple[Tuple, ElementTree.Element, Mapping[str, Mapping[str, str]]]] = {}
+
+    def layer(self, path: str, stat: Tuple[int, int]) -> ElementTree.Element:
+        cached = self.layers.get(path)
+        if cached is not None and cached[0] == stat:
+            return cached[1]
+        with open(path, 'r') as file:
+            root = dElementTree.fromstring(file.read())
+        self.layers[path] = (stat, root)
+        return root
+
+    def render(self, name: str, paths: Sequence[str]) -> Tuple[ElementTree.Element, Mapping[str, Mapping[str, str]]]:
+        """
+        Merges the layer files that exist, the first one is the base.
+        Returns the root and the effective config, both are shared with the cache and must not be modified
+        """
+        key = tuple((path, config_stat(path)) for path in paths)
+        cached = self.rendered.get(name)
+        if cached is not None and cached[0] == key:
+            return cached[1], cached[2]
+        root = None
+        for path, stat in key:
+            if stat is None:
+                continue
+            if root is None:
+                root = copy.deepcopy(self.layer(path, stat))
+            else:
+                apply_overlay(root, self.layer(path, stat))
+        if root is None:
+            raise FileNotFoundError(f'None of the templates of "{name}" exist')
+        _effective = effective_config(ConfigIndex(root))
+        self.rendered[name] = (key, root, _effective)
+        return root, _effective
+
+
+def select_servers(config: ConfigParser, selector: str, names: Iterable[str]) -> MutableSequence[str]:
+    """
+    Server names matching the selector: all, a glob of the server name or tag:<name> of the Tags section.
+    Several selectors are separated with commas
+    """
+    _patterns = []
+    for _selector in selector.split(','):
+        if _selector in ('all', '*'):
+            _patterns.append('*')
+        elif _selector.startswith(tag_prefix):
+            _patterns.extend(config.get('Tags', _selector[len(tag_prefix):], fallback='').split())
+        elif _selector:
+            _patterns.append(_selector)
+    return [name for name in names if any(fnmatchcase(name, pattern) for pattern in _patterns)]
+
+
 def _startswith_predicate(name: str, stkservername: str):
     return stkservername.startswith(name)
 
@@ -114,9 +246,13 @@ async def extension_init(ext: AdminCommandExtension):
     def save_config():
         with open(confpath, 'w' if os.path.isfile(confpath) else 'x') as conffile:
             config.write(conffile)
+        if ext.file_watcher is not None:
+            ext.file_watcher.note_written(confpath)
     ext.load_config = load_config
     ext.save_config = save_config
     load_config()
+    ext.file_watcher = getattr(ext.ace, 'file_watcher', None)
+    ext.events = getattr(ext.ace, 'events', None)
 
     class ServerEnhancer:
         _gamestart_parser = re.compile(r'Max ping from peers: \d+, jitter tolerance: \d+')
@@ -131,28 +267,64 @@ async def extension_init(ext: AdminCommandExtension):
             self.name = server.name
             self._finalizer = partial(_finalizer, server.name)
             self.logger: logging.Logger = server.logger
-            self.player_join = AIOHandlerChain(cancellable=True)
-            self.player_leave = AIOHandlerChain(cancellable=False)
-            self.game_start = AIOHandlerChain(cancellable=False)
-            self.game_end = AIOHandlerChain(cancellable=False)
-            self.game_stop = AIOHandlerChain(cancellable=False)
-            self.game_resume = AIOHandlerChain(cancellable=False)
+            self.player_join = TimedHandlerChain('player_join', server.name, cancellable=True)
+            self.player_leave = TimedHandlerChain('player_leave', server.name, cancellable=False)
+            self.player_validate = TimedHandlerChain('player_validate', server.name, cancellable=False)
+            self.game_start = TimedHandlerChain('game_start', server.name, cancellable=False)
+            self.game_end = TimedHandlerChain('game_end', server.name, cancellable=False)
+            self.game_stop = TimedHandlerChain('game_stop', server.name, cancellable=False)
+            self.game_resume = TimedHandlerChain('game_resume', server.name, cancellable=False)
+            # not a managed server, for example a replay
+            self.published = ext.events is not None and ext.ace.servers.get(server.name) is not None
+            if self.published:
+                for chain in (self.player_join, self.player_leave, self.player_validate):
+                    chain.add_handler(self._publish_player)
+                for chain in (self.game_start, self.game_end, self.game_stop, self.game_resume):
+                    chain.add_handler(self._publish_game)
             self.game_stopped = False  # only useful for supertournament servers
             self.game_running = False  # indicates whether or not the game is happening on the server
             self.players = set()
             self.valid_players = set()
-            if not server.empty_server.is_set():
+            _state = server.attached_state.pop('enhancer', None)
+            if _state is not None:
+                # the server was running under the previous wrapper or enhancer
+                self.restore_state(_state)
+            elif not server.empty_server.is_set():
                 self.logger.warning(f'Enhancer [{server.name}] is initialized with non-empty server. Player list is not synchronized')
             server.log_event.add_handler(self.handle_stdout)
-            self.expiry_timer: Optional[asyncio.Task] = None
+            server.detach_event.add_handler(self._on_detach)
+            server.ready_event.add_handler(self._on_ready)
+            server.subscribe_log('stkw_advanced', joinleave_logobject, joinleave_loglevel, 'player join, leave and validation')
+            server.subscribe_log('stkw_advanced', modediff_obj, modediff_level, 'game mode and difficulty')
+            server.subscribe_log('stkw_advanced', gamestopped_obj, gamestopped_lvl, 'game stop and resume')
+            server.subscribe_log('stkw_advanced', self._gamestart_obj, self._gamestartend_lvl, 'game start')
+            server.subscribe_log('stkw_advanced', self._gameend_obj, self._gamestartend_lvl, 'game end')
             self.saveonempty_task: Optional[asyncio.Task] = None
             self.expiration_seconds: Optional[float] = None
             self.expiry_deletefrom: Optional[MutableMapping[str, STKServer]] = None
             self.cfgpath = os.path.join(server.cwd, server.cfgpath)
             self.servercfg: ElementTree.Element
+            # modification time and size of the loaded or written config file, see load_serverconfig
+            self.cfgstat: Optional[Tuple[int, int]] = None
+            self._cfgindex: Optional[ConfigIndex] = None
             self.load_serverconfig()
-            self.gamemode = int(self.servercfg.find('server-mode').attrib.get('value', '3'))
-            self.difficulty = int(self.servercfg.find('server-difficulty').attrib.get('value', '3'))
+            if ext.file_watcher is not None:
+                ext.file_watcher.watch(self.cfgpath, self._on_cfgfile_changed, owner='stkw_advanced')
+            self.gamemode = int(self.get_config('server-mode', '3'))
+            self.difficulty = int(self.get_config('server-difficulty', '3'))
+            if _state is not None:
+                self.gamemode = _state.get('gamemode', self.gamemode)
+                self.difficulty = _state.get('difficulty', self.difficulty)
+            # resume the expiration that was scheduled before the wrapper restart
+            _expiry = ext.ace.scheduler.persisted.get(self.expiry_job)
+            if _expiry is not None and _expiry['rule']['kind'] == OneShot.kind:
+                self._schedule_expiry(_expiry['rule']['at'])
+            for hook in ext.enhancer_created:
+                hook(self)
+
+        @property
+        def expiry_job(self) -> str:
+            return f'expiry:{self.name}'
 
         def __del__(self):
             try:
@@ -160,34 +332,123 @@ async def extension_init(ext: AdminCommandExtension):
                 _le.remove_handler(self.handle_stdout)
             except (ReferenceError, KeyError, ValueError):
                 pass
-            for task in (self.expiry_timer, self.saveonempty_task):
-                if task is not None:
-                    if not task.done():
-                        task.cancel()
+            if self.saveonempty_task is not None:
+                if not self.saveonempty_task.done():
+                    self.saveonempty_task.cancel()
             self.logger.info(f"Enhancer [{self.name}] has been finished.")
 
+        def export_state(self) -> MutableMapping:
+            """State that is carried over to the next enhancer of the same running server"""
+            return {
+                'players': list(self.players),
+                'valid_players': list(self.valid_players),
+                'game_running': self.game_running,
+                'game_stopped': self.game_stopped,
+                'gamemode': self.gamemode,
+                'difficulty': self.difficulty
+            }
+
+        def restore_state(self, state: MutableMapping):
+            self.players.update(state.get('players', ()))
+            self.valid_players.update(state.get('valid_players', ()))
+            self.game_running = state.get('game_running', False)
+            self.game_stopped = state.get('game_stopped', False)
+
+        async def _on_detach(self, event: AIOHandlerChain, *args, **kwargs):
+            self.server.attached_state['enhancer'] = self.export_state()
+
+        async def _on_ready(self, event: AIOHandlerChain, *args, **kwargs):
+            # the server has been restarted, players of the previous process are gone
+            for username in tuple(self.players):
+                await self.player_leave.emit(username, _match=None)
+            self.players.clear()
+            self.valid_players.clear()
+            self.game_running = False
+            self.game_stopped = False
+
         def cleanup(self):
             self.server.log_event.remove_handler(self.handle_stdout)
-            for task in (self.expiry_timer, self.saveonempty_task):
-                if task is not None:
-                    if not task.done():
-                        task.cancel()
+            self.server.detach_event.remove_handler(self._on_detach)
+            self.server.ready_event.remove_handler(self._on_ready)
+            self.server.unsubscribe_log('stkw_advanced')
+            if ext.file_watcher is not None:
+                ext.file_watcher.unwatch(self.cfgpath, self._on_cfgfile_changed)
+            if self.server.active:
+                self.server.attached_state['enhancer'] = self.export_state()
+            if self.saveonempty_task is not None:
+                if not self.saveonempty_task.done():
+                    self.saveonempty_task.cancel()
+            # the expiration resumes when the server is enhanced again
+            ext.ace.scheduler.remove_job(self.expiry_job, forget=False)
+
+        @property
+        def cfgindex(self) -> ConfigIndex:
+            if self._cfgindex is None:
+                self._cfgindex = ConfigIndex(self.servercfg)
+            return self._cfgindex
+
+        def get_config(self, key: str, default: Optional[str] = None) -> Optional[str]:
+            element = self.cfgindex.get(key)
+            if element is None:
+                return default
+            return element.attrib.get('value', default)
+
+        def set_config(self, key: str, value: str) -> bool:
+            """Sets the value in memory, adding the element if needed. Returns False if the value is unchanged"""
+            element = self.cfgindex.get(key)
+            if element is None:
+                element = ElementTree.SubElement(self.servercfg, key)
+                self._cfgindex = None
+            elif element.attrib.get('value') == value:
+                return False
+            element.attrib['value'] = value
+            return True
+
+        async def _publish_player(self, event: TimedHandlerChain, username: str, *args, _match=None, **kwargs):
+            # a leave without the log line means that the server has exited
+            _online_id = _match.groupdict().get('online_id') if _match is not None else None
+            ext.events.publish(event.name, self.name, username=username,
+                               online_id=int(_online_id) if _online_id is not None else None)
+
+        async def _publish_game(self, event: TimedHandlerChain, *args, **kwargs):
+            ext.events.publish(event.name, self.name, mode=gamemode_names[self.gamemode],
+                               difficulty=difficulty_names[self.difficulty], players=sorted(self.players))
+
+        def replace_config(self, root: ElementTree.Element):
+            """Replaces the config in memory, it is written with save_serverconfig or write_serverconfig"""
+            self.servercfg = root
+            self._cfgindex = None
+
+        def _on_cfgfile_changed(self, path: str):
+            # edited outside the wrapper, the running server picks the file up on the next restart
+            self.load_serverconfig()
 
-        def load_serverconfig(self):
+        def load_serverconfig(self, force=False) -> bool:
+            """Reads the config file, unless its modification time and size are unchanged. Returns True if it was read"""
             try:
+                _stat = config_stat(self.cfgpath)
+                if _stat is not None and _stat == self.cfgstat and not force:
+                    self.logger.debug(f"Enhancer [{self.server.name}] server config is unchanged")
+                    return False
                 self.logger.info(f"Enhancer [{self.server.name}] loading server config \"{self.cfgpath}\"")
-                if os.path.isfile(self.cfgpath):
+                if _stat is not None:
+                    # a broken file isn't parsed again until it changes
+                    self.cfgstat = _stat
                     try:
                         with open(self.cfgpath, 'r') as file:
                             self.servercfg = dElementTree.fromstring(file.read())
                     except ElementTree.ParseError:
                         self.logger.exception(f"Enhancer [{self.server.name}] failed to parse server config")
+                        return False
                     self.logger.info(f"Enhancer [{self.server.name}] server config loaded")
                 else:
                     with open(ext.stkdefaultxml_path, 'r') as file:
-                        self.servercfg = dElementTree.fromstring(file)
+                        self.servercfg = dElementTree.fromstring(file.read())
                     if not self.server.active:
+                        # written right away, a server launched after the enhancer is created must find the file
                         self.save_serverconfig()
+                self._cfgindex = None
+                return True
             except Exception:
                 self.logger.exception('load_serverconfig')
                 raise
@@ -201,13 +462,20 @@ async def extension_init(ext: AdminCommandExtension):
                 if not self.saveonempty_task.done():
                     return
             if later:
-                _tsk = asyncio.create_task(self._save_on_empty())
-                self.saveonempty_task = _tsk
-                ext.tasks[_tsk.get_name()] = _tsk
+                self.saveonempty_task = ext.ace.task_registry.spawn(self._save_on_empty(), owner=self.name,
+                                                                    description='save config when empty', tasks=ext.tasks)
                 return
-            _root = ElementTree.ElementTree(self.servercfg)
-            with open(self.cfgpath, 'wb' if os.path.isfile(self.cfgpath) else 'xb') as file:
-                _root.write(file)
+            self.cfgstat = write_config(self.cfgpath, ElementTree.tostring(self.servercfg))
+            if ext.file_watcher is not None:
+                ext.file_watcher.note_written(self.cfgpath)
+
+        async def write_serverconfig(self):
+            """Writes the config in a thread, the running server keeps its settings until the restart"""
+            self.logger.info(f"Enhancer [{self.server.name}] writing server config")
+            self.cfgstat = await asyncio.get_running_loop().run_in_executor(
+                None, write_config, self.cfgpath, ElementTree.tostring(self.servercfg))
+            if ext.file_watcher is not None:
+                ext.file_watcher.note_written(self.cfgpath)
 
         async def _save_on_empty(self):
             await self.server.empty_server.wait()
@@ -216,7 +484,7 @@ async def extension_init(ext: AdminCommandExtension):
             if self.server.active:
                 self.logger.info(f'_save_on_empty({self.server.name}) server is active')
                 await asyncio.sleep(0)
-            self.save_serverconfig()
+            await self.write_serverconfig()
             self.logger.info(f'Config modified for {self.server.name}')
             await self.server.launch()
 
@@ -256,6 +524,7 @@ async def extension_init(ext: AdminCommandExtension):
                 elif _validatematch:
                     username = _validatematch.group('username')
                     self.valid_players.add(username)
+                    await self.player_validate.emit(username, _match=_validatematch)
                 elif _leavematch:
                     username = _leavematch.group('username')
                     if username in self.players:
@@ -293,7 +562,6 @@ async def extension_init(ext: AdminCommandExtension):
                 self.game_stopped = False
 
         async def _expiry_timer(self):
-            await asyncio.sleep(self.expiration_seconds)
             self.logger.info(f'[{self.server.name}] Server expired. Shutting down...')
             self.server.restart = False
             await self.server.stop()
@@ -308,29 +576,27 @@ async def extension_init(ext: AdminCommandExtension):
             _td = (at - _now)
             _seconds = _td.total_seconds()
             self.logger.info(f'[{self.server.name}] Server expires at {at.ctime()} or {_seconds / 60} minutes')
-            self.expiration_seconds = _seconds
-            if self.expiry_timer is not None:
-                if not self.expiry_timer.done():
-                    self.expiry_timer.cancel()
-            self.expiry_timer = asyncio.create_task(self._expiry_timer())
-            ext.tasks[self.expiry_timer.get_name()] = self.expiry_timer
+            self._schedule_expiry(time.time() + _seconds)
 
         def expire_in(self, seconds: float):
-            self.expiration_seconds = seconds
             self.logger.info(f'[{self.server.name}] Server expires in {seconds / 60} minutes')
-            if self.expiry_timer is not None:
-                if not self.expiry_timer.done():
-                    self.expiry_timer.cancel()
-            self.expiry_timer = asyncio.create_task(self._expiry_timer())
-            ext.tasks[self.expiry_timer.get_name()] = self.expiry_timer
+            self._schedule_expiry(time.time() + seconds)
+
+        def _schedule_expiry(self, at: float):
+            self.expiration_seconds = at - time.time()
+            ext.ace.scheduler.add_job(self.expiry_job, self._expiry_timer, OneShot(at), owner=self.name)
     ext.ServerEnhancer = ServerEnhancer
+    # called with every new enhancer, so that other extensions can add their handlers to its events
+    ext.enhancer_created = []
 
     class STKSoccer(ServerEnhancer):
         def __init__(self, server: STKServer, no_nice=False, no_brde=False, *args, **kwds):
-            super().__init__(*args, server, **kwds)
-            # event argument is player name
-            self.goal = AIOHandlerChain(cancellable=False)
+            # before the base class restores the score of a re-attached server
             self.resetScore()
+            # event argument is player name. Created before the base class calls the enhancer_created hooks
+            self.goal = TimedHandlerChain('goal', server.name, cancellable=False)
+            super().__init__(*args, server, **kwds)
+            server.subscribe_log('stkw_advanced', soccergoal_logobject, soccergoal_loglevel, 'soccer goals')
             self.game_start.add_handler(self.resetScore)
             # im too young to ####### so pls dont say anything about 69
             self.no_nice = no_nice
@@ -341,6 +607,23 @@ async def extension_init(ext: AdminCommandExtension):
             super().cleanup()
             self.game_start.remove_handler(self.resetScore)
 
+        def export_state(self) -> MutableMapping:
+            state = super().export_state()
+            state['score_red'] = self.score_red
+            state['score_blue'] = self.score_blue
+            return state
+
+        def restore_state(self, state: MutableMapping):
+            super().restore_state(state)
+            self.score_red = state.get('score_red', 0)
+            self.score_blue = state.get('score_blue', 0)
+
+        def _publish_goal(self, username: str, blue: bool, own: bool):
+            # after the score is counted, a goal cancelled by a handler isn't published
+            if self.published:
+                ext.events.publish('goal', self.name, username=username, team='blue' if blue else 'red', own=own,
+                                   score_red=self.score_red, score_blue=self.score_blue)
+
         def resetScore(self, *args, **kwargs):
             # don't forget to reset it when necessary
             self.score_red = 0
@@ -354,9 +637,11 @@ async def extension_init(ext: AdminCommandExtension):
                 if _match_red:
                     if await self.goal.emit(_match_red.group(2), blue=False, own=bool(_match_red.group(1))):
                         self.score_red += 1
+                        self._publish_goal(_match_red.group(2), blue=False, own=bool(_match_red.group(1)))
                 if _match_blue:
                     if await self.goal.emit(_match_blue.group(2), blue=True, own=bool(_match_blue.group(1))):
                         self.score_blue += 1
+                        self._publish_goal(_match_blue.group(2), blue=True, own=bool(_match_blue.group(1)))
                 if not self.no_nice:
                     if self.score_red == 6 and self.score_blue == 9:
                         self.logger.info(f'Enhancer [{self.server.name}] 6-9 nice!')
@@ -455,21 +740,34 @@ async def extension_init(ext: AdminCommandExtension):
                                 ' as the server when score reaches 6 - 9',
                     atabcomplete=stkserver_tab)
 
+    def autoenhance():
+        """Enhances the listed servers that aren't enhanced yet"""
+        for servername in config.get('RegularEnhancers', 'servers', fallback='').split(' '):
+            if servername in ext.server_enhancers or not servername:
+                continue
+            ext.server_enhancers[servername] = ServerEnhancer(ext.ace.servers[servername])
+            ext.logmsg(f'{servername} enhanced as a regular server')
+        no_nice = not config.getboolean('SoccerEnhancers', 'sayNiceWhen69', fallback=False)
+        no_brde = not config.getboolean('SoccerEnhancers', 'sayBrDeFlagsWhen17', fallback=False)
+        for servername in config.get('SoccerEnhancers', 'servers', fallback='').split(' '):
+            if servername in ext.server_enhancers or not servername:
+                continue
+            ext.server_enhancers[servername] = STKSoccer(ext.ace.servers[servername], no_nice=no_nice, no_brde=no_brde)
+            ext.logmsg(f'{servername} enhanced as a soccer server')
+
+    def _on_config_changed(path: str):
+        # options removed from the file are forgotten, new servers in the lists are enhanced
+        config.clear()
+        load_config()
+        autoenhance()
     ext.logmsg('Autoenhancing the servers...')
-    for servername in config.get('RegularEnhancers', 'servers', fallback='').split(' '):
-        if servername in ext.server_enhancers or not servername:
-            continue
-        ext.server_enhancers[servername] = ServerEnhancer(ext.ace.servers[servername])
-        ext.logmsg(f'{servername} enhanced as a regular server')
-    no_nice = not config.getboolean('SoccerEnhancers', 'sayNiceWhen69', fallback=False)
-    no_brde = not config.getboolean('SoccerEnhancers', 'sayBrDeFlagsWhen17', fallback=False)
-    for servername in config.get('SoccerEnhancers', 'servers', fallback='').split(' '):
-        if servername in ext.server_enhancers or not servername:
-            continue
-        ext.server_enhancers[servername] = STKSoccer(ext.ace.servers[servername], no_nice=no_nice, no_brde=no_brde)
-        ext.logmsg(f'{servername} enhanced as a soccer server')
+    autoenhance()
+    if ext.file_watcher is not None:
+        ext.file_watcher.watch(confpath, _on_config_changed, owner='stkw_advanced')
 
 
 async def extension_cleanup(ext: AdminCommandExtension):
     for enhancer in ext.server_enhancers.values():
         enhancer.cleanup()
+    if ext.file_watcher is not None:
+        ext.file_watcher.unwatch_owner('stkw_advanced')
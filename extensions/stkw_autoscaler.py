@@ -0,0 +1,311 @@
+"""
+SuperTuxKart Wrapper Autoscaler
+
+Keeps enough free player slots for every configured game mode.
+When the free slots of a mode drop below the threshold, a new instance
+is cloned from the template server. Surplus instances that stay empty
+for the cooldown period are retired.
+Pools are configured in extensions/stkw_autoscaler.conf, for example:
+
+[Pool soccer]
+mode = soccer
+template = soccer1
+min_free_slots = 4
+min_instances = 0
+max_instances = 4
+cooldown = 600
+startup_timeout = 180
+"""
+from admin_console import AdminCommandExtension, AdminCommandExecutor, paginate_range
+from defusedxml import ElementTree as dElementTree
+from xml.etree import ElementTree
+from configparser import ConfigParser, SectionProxy
+from collections import deque
+from functools import partial
+from typing import Optional, MutableMapping
+import weakref
+import os
+import sys
+import asyncio
+import time
+import logging
+
+
+main = sys.modules['__main__']
+STKServer = main.STKServer
+pool_prefix = 'Pool '
+defaultconf = {
+    'Autoscaler': {
+        'interval': 15.0,
+        'poolpath': 'autoscaled'
+    }
+}
+
+
+class ScaledInstance:
+    def __init__(self, server: STKServer):
+        self.server = server
+        self.created = time.monotonic()
+        self.empty_since: Optional[float] = None
+        self.launch_task: Optional[asyncio.Task] = None
+
+
+class ServerPool:
+    """Demand state of a single game mode"""
+    def __init__(self, name: str, section: SectionProxy, gamemode_names):
+        self.name = name
+        _mode = section.get('mode', 'soccer')
+        if _mode.isdigit() and int(_mode) < len(gamemode_names):
+            self.gamemode = int(_mode)
+        elif _mode in gamemode_names:
+            self.gamemode = gamemode_names.index(_mode)
+        else:
+            raise ValueError(f'unknown mode "{_mode}", use one of {", ".join(gamemode_names)} or 0-{len(gamemode_names) - 1}')
+        self.template = section.get('template')
+        self.min_free_slots = section.getint('min_free_slots', 4)
+        self.min_instances = section.getint('min_instances', 0)
+        self.max_instances = section.getint('max_instances', 4)
+        self.cooldown = section.getfloat('cooldown', 600.0)
+        # an instance that isn't ready within this time is retired as failed
+        self.startup_timeout = section.getfloat('startup_timeout', 180.0)
+        self.instances: MutableMapping[str, ScaledInstance] = {}
+        self.pending: MutableMapping[str, float] = {}
+        self.capacity = 0
+        self.free_slots = 0
+        self.breach_since: Optional[float] = None
+        # the last failed start, the next instance waits for startup_timeout after it
+        self.failed_at: Optional[float] = None
+
+
+async def extension_init(ext: AdminCommandExtension):
+    stkw_advanced = weakref.proxy(ext.ace.extensions['stkw_advanced'])
+    stkserver_tab = stkw_advanced.module.stkserver_tab
+    gamemode_names = stkw_advanced.module.gamemode_names
+    ext.logger = ext.ace.logger.getChild('Autoscaler')
+    ext.logger.propagate = True
+    ext.logger.setLevel(logging.INFO)
+    metrics: main.MetricsRegistry = ext.ace.metrics
+    metrics.describe('stk_autoscaler_decisions_total', 'counter', 'Scaling decisions taken by the autoscaler')
+    metrics.describe('stk_autoscaler_scaleup_latency_seconds', 'gauge',
+                     'Seconds between the free slots breach and the new instance becoming ready')
+    confpath = ext.confpath = os.path.join(ext.ace.extpath, 'stkw_autoscaler.conf')
+    config = ext.config = ConfigParser(allow_no_value=True)
+    ext.pools: MutableMapping[str, ServerPool] = {}
+    ext.decisions = deque(maxlen=100)
+
+    def load_config():
+        config.read_dict(defaultconf)
+        if os.path.isfile(confpath):
+            config.read(confpath)
+        else:
+            with open(confpath, 'x') as conffile:
+                config.write(conffile)
+        for section in config.sections():
+            if not section.startswith(pool_prefix):
+                continue
+            name = section[len(pool_prefix):]
+            try:
+                pool = ServerPool(name, config[section], gamemode_names)
+            except ValueError as exc:
+                ext.logger.error(f'Autoscaler [{name}] {exc}, the pool is skipped')
+                continue
+            if name in ext.pools:
+                # keep the instances that were already spawned
+                pool.instances = ext.pools[name].instances
+                pool.pending = ext.pools[name].pending
+                pool.failed_at = ext.pools[name].failed_at
+            ext.pools[name] = pool
+    ext.load_config = load_config
+    load_config()
+
+    def max_players(enhancer) -> int:
+        return int(enhancer.get_config('max-players', '8'))
+
+    def decide(pool: ServerPool, action: str, servername: str, reason: str):
+        metrics.inc('stk_autoscaler_decisions_total', pool=pool.name, action=action)
+        ext.decisions.append((time.time(), pool.name, action, servername, reason))
+        ext.logger.info(f'Autoscaler [{pool.name}] {action} {servername}: {reason}')
+
+    def measure(pool: ServerPool):
+        pool.capacity = 0
+        pool.free_slots = 0
+        for enhancer in tuple(stkw_advanced.server_enhancers.values()):
+            if enhancer.gamemode != pool.gamemode or not enhancer.server.active:
+                continue
+            _max = max_players(enhancer)
+            pool.capacity += _max
+            if enhancer.server.name in pool.pending:
+                # not online yet, but its slots are already on the way
+                pool.free_slots += _max
+            else:
+                pool.free_slots += max(_max - enhancer.server.peer_count, 0)
+        metrics.set('stk_autoscaler_capacity', pool.capacity, pool=pool.name)
+        metrics.set('stk_autoscaler_free_slots', pool.free_slots, pool=pool.name)
+        metrics.set('stk_autoscaler_instances', len(pool.instances), pool=pool.name)
+
+    def next_name(pool: ServerPool) -> str:
+        i = 1
+        while f'{pool.template}-{i}' in ext.ace.servers:
+            i += 1
+        return f'{pool.template}-{i}'
+
+    async def _on_ready(pool: ServerPool, servername: str, *args, **kwargs):
+        _breach = pool.pending.pop(servername, None)
+        if _breach is not None:
+            _latency = time.monotonic() - _breach
+            metrics.set('stk_autoscaler_scaleup_latency_seconds', _latency, pool=pool.name)
+            ext.logger.info(f'Autoscaler [{pool.name}] {servername} is online, {_latency:.1f} seconds after the demand spike')
+
+    async def scale_up(pool: ServerPool, reason: str):
+        template: STKServer = ext.ace.servers[pool.template]
+        template_enhancer = stkw_advanced.server_enhancers[pool.template]
+        name = next_name(pool)
+        cwd = os.path.abspath(os.path.join(config.get('Autoscaler', 'poolpath'), name))
+        os.makedirs(cwd, exist_ok=True)
+        cfgpath = os.path.join(cwd, f'{name}.xml')
+        servercfg = dElementTree.fromstring(ElementTree.tostring(template_enhancer.servercfg))
+        for tag, value in (('server-name', f'{name}'), ('server-port', '0')):
+            element = servercfg.find(tag)
+            if element is None:
+                element = ElementTree.SubElement(servercfg, tag)
+            if tag == 'server-name' and element.attrib.get('value'):
+                value = f'{element.attrib["value"]} {name.rpartition("-")[2]}'
+            element.attrib['value'] = value
+        await asyncio.get_running_loop().run_in_executor(
+            None, stkw_advanced.module.write_atomic, cfgpath, ElementTree.tostring(servercfg))
+        server = STKServer(
+            template.logger, template.writeln, name, cfgpath=cfgpath,
+            # instances aren't in the server list, so they can't be re-attached after the wrapper restart
+            **{**main.server_services(ext.ace), 'statedir': None},
+            datapath=template.datapath, executable_path=template.executable_path, cwd=cwd,
+            autostart=False, autorestart=template.autorestart, autorestart_pause=template.autorestart_pause,
+            startup_timeout=template.startup_timeout, shutdown_timeout=template.shutdown_timeout,
+            extra_env=template.extra_env, extra_args=template.extra_args,
+            global_logignores=ext.ace.global_logignores,
+            logignores=main.make_logignores({})
+        )
+        ext.ace.servers[name] = server
+        stkw_advanced.server_enhancers[name] = type(template_enhancer)(server)
+        server.ready_event.add_handler(partial(_on_ready, pool, name))
+        instance = pool.instances[name] = ScaledInstance(server)
+        pool.pending[name] = pool.breach_since or time.monotonic()
+        decide(pool, 'scale_up', name, reason)
+        instance.launch_task = ext.ace.task_registry.spawn(server.launch(), owner=name, description='autoscaled start',
+                                                           tasks=ext.tasks)
+
+    async def retire(pool: ServerPool, name: str, reason: str, action='retire'):
+        instance = pool.instances.pop(name)
+        pool.pending.pop(name, None)
+        decide(pool, action, name, reason)
+        if action == 'failed':
+            pool.failed_at = time.monotonic()
+        if name in stkw_advanced.server_enhancers:
+            stkw_advanced.server_enhancers[name].cleanup()
+            del stkw_advanced.server_enhancers[name]
+        instance.server.restart = False
+        if instance.server.active:
+            await instance.server.stop()
+        elif instance.server.reader_task is not None and not instance.server.reader_task.done():
+            # exited and waiting for the autorestart
+            instance.server.reader_task.cancel()
+        ext.ace.servers.pop(name, None)
+    ext.retire = retire
+
+    async def check_pending(pool: ServerPool, now: float):
+        """Retires the instances that failed to start, otherwise they would hold the pool in the pending state"""
+        for name in tuple(pool.pending):
+            instance = pool.instances.get(name)
+            if instance is None:
+                pool.pending.pop(name, None)
+                continue
+            _task = instance.launch_task
+            if _task is not None and _task.done():
+                if not _task.cancelled() and _task.exception() is not None:
+                    await retire(pool, name, f'launch failed: {_task.exception()!r}', 'failed')
+                    continue
+                if not instance.server.active:
+                    await retire(pool, name, 'exited before it was ready', 'failed')
+                    continue
+            if now - instance.created >= pool.startup_timeout:
+                await retire(pool, name, f'not ready after {pool.startup_timeout:.0f} seconds', 'failed')
+
+    async def evaluate(pool: ServerPool):
+        if pool.template not in stkw_advanced.server_enhancers:
+            ext.logger.warning(f'Autoscaler [{pool.name}] template server "{pool.template}" is not enhanced, skipping')
+            return
+        _now = time.monotonic()
+        await check_pending(pool, _now)
+        measure(pool)
+        if pool.free_slots < pool.min_free_slots:
+            if pool.breach_since is None:
+                pool.breach_since = _now
+            if pool.pending:
+                return
+            if pool.failed_at is not None and _now - pool.failed_at < pool.startup_timeout:
+                ext.logger.debug(f'Autoscaler [{pool.name}] demand is high, but the last instance has failed to start')
+                return
+            if len(pool.instances) >= pool.max_instances:
+                ext.logger.debug(f'Autoscaler [{pool.name}] demand is high, but max_instances is reached')
+                return
+            await scale_up(pool, f'{pool.free_slots} free slots of {pool.capacity}, threshold {pool.min_free_slots}')
+            return
+        pool.breach_since = None
+        for name, instance in tuple(pool.instances.items()):
+            if not instance.server.empty_server.is_set() or name in pool.pending:
+                instance.empty_since = None
+                continue
+            if instance.empty_since is None:
+                instance.empty_since = _now
+            _enhancer = stkw_advanced.server_enhancers.get(name)
+            _surplus = pool.free_slots - (max_players(_enhancer) if _enhancer is not None else 0)
+            if (_now - instance.empty_since >= pool.cooldown and _surplus >= pool.min_free_slots
+                    and len(pool.instances) > pool.min_instances):
+                await retire(pool, name, f'empty for {_now - instance.empty_since:.0f} seconds, {_surplus} slots remain')
+                measure(pool)
+
+    async def autoscaler_task():
+        while True:
+            await asyncio.sleep(config.getfloat('Autoscaler', 'interval'))
+            for pool in tuple(ext.pools.values()):
+                try:
+                    await evaluate(pool)
+                except Exception:
+                    ext.logger.exception(f'Autoscaler [{pool.name}] evaluation failed:')
+    ext.autoscaler_task = ext.ace.task_registry.spawn(autoscaler_task(), owner='stkw_autoscaler', tasks=ext.tasks)
+
+    async def stk_autoscaler(cmd: AdminCommandExecutor):
+        if not ext.pools:
+            cmd.print(f'No pools are configured. Add [{pool_prefix}name] sections to "{confpath}"')
+            return
+        for pool in ext.pools.values():
+            cmd.print(f'Pool "{pool.name}" ({gamemode_names[pool.gamemode]}, template {pool.template}): '
+                      f'{pool.free_slots} free of {pool.capacity} slots, '
+                      f'{len(pool.instances)} instances ({pool.min_instances}-{pool.max_instances}), '
+                      f'{len(pool.pending)} starting')
+    ext.add_command(stk_autoscaler, 'stk-autoscaler', description='Shows the state of autoscaled server pools')
+
+    async def stk_autoscaler_log(cmd: AdminCommandExecutor, cpage: int = 1):
+        _decisions = tuple(reversed(ext.decisions))
+        _maxpage, _start, _end = paginate_range(len(_decisions), 10, cpage)
+        cmd.print(f'Autoscaler decisions (page {cpage} of {_maxpage}):')
+        cmd.print(*(f'{time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(_time))} [{_pool}] {_action} {_name}: {_reason}'
+                    for _time, _pool, _action, _name, _reason in _decisions[_start:_end]), sep='\n')
+    ext.add_command(stk_autoscaler_log, 'stk-autoscaler-log', optargs=((int, 'page'), ),
+                    description='Shows the recent scaling decisions')
+
+    async def stk_autoscaler_retire(cmd: AdminCommandExecutor, name: str):
+        for pool in ext.pools.values():
+            if name in pool.instances:
+                await retire(pool, name, 'retired manually')
+                cmd.print(f'Instance {name} retired')
+                return
+        cmd.error(f'Server "{name}" is not an autoscaled instance', log=False)
+    ext.add_command(stk_autoscaler_retire, 'stk-autoscaler-retire', ((str, 'name'), ),
+                    description='Stops and removes an autoscaled instance', atabcomplete=stkserver_tab)
+
+
+async def extension_cleanup(ext: AdminCommandExtension):
+    ext.autoscaler_task.cancel()
+    # nothing would manage the instances after the extension is unloaded
+    await asyncio.gather(*(ext.retire(pool, name, 'autoscaler unloaded')
+                           for pool in ext.pools.values() for name in tuple(pool.instances)))
@@ -1,24 +1,96 @@
 """
-This extension adds config editing commands to the console
+This extension adds config editing commands to the console.
+
+Several settings can be changed with one restart in a transaction:
+stk-cfg-begin <server>, any number of stk-cfg-set <server> <key> <value>, then stk-cfg-commit <server>.
+stk-fleet-getcfg and stk-fleet-setcfg work on all servers matching a selector: all, a glob or tag:<name>
+(see Tags in server_enhancers.conf). The restarts they need are rolling, at most restart_concurrency
+servers at once (see extensions/stkw_configedit.conf).
+Configs of the servers listed in the Templates section are rendered from stkdefault.xml and the overlays
+of their tags and their own, stk-render writes the ones that have changed, and so does every edit of a template.
 """
 from admin_console import AdminCommandExtension, AdminCommandExecutor
+from configparser import ConfigParser
 from functools import partial
-from xml.etree.ElementTree import SubElement
+from typing import Awaitable, Callable, Mapping, MutableMapping, MutableSequence, Sequence, Tuple
+from xml.etree import ElementTree
+import asyncio
+import copy
+import logging
+import os
+import shlex
 import weakref
 
 
+# settings that a running server can apply without the restart: key: async function(enhancer, value) -> applied.
+# The network console of STK 1.4 has no commands that change the server config, so it is empty here,
+# servers with extra console commands register their setters
+live_settings: MutableMapping[str, Callable[..., Awaitable[bool]]] = {}
+defaultconf = {
+    'Fleet': {
+        'restart_concurrency': 2
+    },
+    'Templates': {
+        # selector of the servers whose configs are rendered from the templates, none by default
+        'servers': '',
+        # tags/<tag>.xml and servers/<server name>.xml overlays in this directory of extensions
+        'path': 'templates'
+    }
+}
+
+
 async def extension_init(ext: AdminCommandExtension):
     stkw_advanced = weakref.proxy(ext.ace.extensions['stkw_advanced'])
     stkserver_tab = stkw_advanced.module.stkserver_tab
     _startswith_predicate = stkw_advanced.module._startswith_predicate
+    select_servers = stkw_advanced.module.select_servers
+    ext.logger = ext.ace.logger.getChild('ConfigEdit')
+    ext.logger.propagate = True
+    ext.logger.setLevel(logging.INFO)
+    confpath = ext.confpath = os.path.join(ext.ace.extpath, 'stkw_configedit.conf')
+    config = ext.config = ConfigParser(allow_no_value=True)
+
+    def load_config():
+        config.read_dict(defaultconf)
+        if os.path.isfile(confpath):
+            config.read(confpath)
+        else:
+            with open(confpath, 'x') as conffile:
+                config.write(conffile)
+    ext.load_config = load_config
+    load_config()
+
+    async def apply_live(enhancer, changes: Mapping[str, str]) -> MutableSequence[str]:
+        """Applies the live settings to the running server, returns the keys that need the restart"""
+        _restart = []
+        for cfgkey, value in changes.items():
+            _setter = live_settings.get(cfgkey)
+            if _setter is None or not await _setter(enhancer, value):
+                _restart.append(cfgkey)
+        return _restart
+
+    async def apply_changes(enhancer, changes: MutableMapping[str, str]) -> Tuple[MutableMapping[str, str], MutableSequence[str]]:
+        """
+        Sets the values in the config of the enhancer, skipping the unchanged ones,
+        and applies the live settings of a running server.
+        Returns the changed values and the keys that need the restart
+        """
+        _changed = {}
+        for cfgkey, value in changes.items():
+            if enhancer.set_config(cfgkey, value):
+                _changed[cfgkey] = value
+        _restart = await apply_live(enhancer, _changed) if enhancer.server.active else []
+        return _changed, _restart
 
     async def stk_reloadcfg(cmd: AdminCommandExecutor, servername: str):
         if servername not in stkw_advanced.server_enhancers:
             cmd.error(f'Server "{servername}" not found or not enhanced.', log=False)
             return
         enhancer = stkw_advanced.server_enhancers[servername]
-        enhancer.load_serverconfig()
-        cmd.print(f'Reloaded config for server "{servername}"')
+        if enhancer.load_serverconfig():
+            cmd.print(f'Reloaded config for server "{servername}"')
+        else:
+            cmd.print(f'Config file of server "{servername}" is unchanged or broken, not reloaded')
     ext.add_command(stk_reloadcfg, 'stk-reloadcfg', ((str, 'servername'), ),
                     description='Read the server configuration to the enhancer.',
                     atabcomplete=stkserver_tab)
@@ -29,23 +101,19 @@ async def extension_init(ext: AdminCommandExtension):
         elif servername and not argl and not cfgkey:
             return await stkserver_tab(cmd, servername, argl=argl)
         elif servername and argl and not cfgkey and servername in stkw_advanced.server_enhancers:
-            enhancer = stkw_advanced.server_enhancers[servername]
-            return list(element.tag for element in enhancer.servercfg.iter())
+            return list(stkw_advanced.server_enhancers[servername].cfgindex.keys)
         elif servername not in stkw_advanced.server_enhancers:
             return
-        enhancer = stkw_advanced.server_enhancers[servername]
-        return list(element.tag for element in enhancer.servercfg.iter() if element.tag.startswith(cfgkey))
+        return stkw_advanced.server_enhancers[servername].cfgindex.complete(cfgkey)
 
     async def stk_getcfg(cmd: AdminCommandExecutor, servername: str, cfgkey: str):
         if servername not in stkw_advanced.server_enhancers:
             cmd.error(f'Server "{servername}" not found or not enhanced.', log=False)
             return
-        enhancer = stkw_advanced.server_enhancers[servername]
-        element = enhancer.servercfg.find(cfgkey)
-        if element is None:
+        cfgvalue = stkw_advanced.server_enhancers[servername].get_config(cfgkey)
+        if cfgvalue is None:
             cmd.error(f'Element "{cfgkey}" not found.', log=False)
             return
-        cfgvalue = element.attrib['value']
         cmd.print(f'{cfgkey} = {cfgvalue}')
     ext.add_command(stk_getcfg, 'stk-getcfg', ((str, 'servername'), (str, 'cfgkey')),
                     description='Shows the configuration value of specific STK server',
@@ -56,16 +124,320 @@ async def extension_init(ext: AdminCommandExtension):
             cmd.error(f'Server "{servername}" not found or not enhanced.', log=False)
             return
         enhancer = stkw_advanced.server_enhancers[servername]
-        element = enhancer.servercfg.find(cfgkey)
-        if element is None:
-            element = SubElement(enhancer.servercfg, cfgkey)
-        element.attrib['value'] = value
-        enhancer.save_serverconfig(later=enhancer.server.active)
+        if not enhancer.set_config(cfgkey, value):
+            cmd.print(f'Config value "{cfgkey}" is already "{value}"')
+            return
+        if enhancer.server.active:
+            enhancer.save_serverconfig(later=True)
+        else:
+            await enhancer.write_serverconfig()
         cmd.print(f'Set config value "{cfgkey}" = "{value}"')
     ext.add_command(stk_setcfg, 'stk-setcfg', ((str, 'servername'), (str, 'key'), (None, 'value')),
                     description='Sets the configuration value and schedules the server restart if server is active.',
                     atabcomplete=stkserver_cfg_tab)
 
+    # servername: {key: value} of the open transactions
+    ext.transactions: MutableMapping[str, MutableMapping[str, str]] = {}
+
+    async def stk_cfg_begin(cmd: AdminCommandExecutor, servername: str):
+        if servername not in stkw_advanced.server_enhancers:
+            cmd.error(f'Server "{servername}" not found or not enhanced.', log=False)
+            return
+        if servername in ext.transactions:
+            cmd.error(f'Transaction of "{servername}" is already open with {len(ext.transactions[servername])} changes. '
+                      f'Commit it with stk-cfg-commit or discard with stk-cfg-abort', log=False)
+            return
+        ext.transactions[servername] = {}
+        cmd.print(f'Transaction of "{servername}" started, add changes with stk-cfg-set')
+    ext.add_command(stk_cfg_begin, 'stk-cfg-begin', ((str, 'servername'), ),
+                    description='Starts collecting config changes that are applied together by stk-cfg-commit',
+                    atabcomplete=stkserver_tab)
+
+    async def stk_cfg_set(cmd: AdminCommandExecutor, servername: str, cfgkey: str, value: str):
+        if servername not in ext.transactions:
+            cmd.error(f'No open transaction of "{servername}". Start it with stk-cfg-begin', log=False)
+            return
+        ext.transactions[servername][cfgkey] = value
+        enhancer = stkw_advanced.server_enhancers.get(servername)
+        _new = ' (new key)' if enhancer is not None and enhancer.cfgindex.get(cfgkey) is None else ''
+        cmd.print(f'{cfgkey} = "{value}"{_new}, {len(ext.transactions[servername])} changes in the transaction')
+    ext.add_command(stk_cfg_set, 'stk-cfg-set', ((str, 'servername'), (str, 'key'), (None, 'value')),
+                    description='Adds a config change to the open transaction',
+                    atabcomplete=stkserver_cfg_tab)
+
+    async def stk_cfg_abort(cmd: AdminCommandExecutor, servername: str):
+        if ext.transactions.pop(servername, None) is None:
+            cmd.error(f'No open transaction of "{servername}"', log=False)
+            return
+        cmd.print(f'Transaction of "{servername}" discarded')
+    ext.add_command(stk_cfg_abort, 'stk-cfg-abort', ((str, 'servername'), ),
+                    description='Discards the open transaction', atabcomplete=stkserver_tab)
+
+    async def stk_cfg_commit(cmd: AdminCommandExecutor, servername: str):
+        if servername not in ext.transactions:
+            cmd.error(f'No open transaction of "{servername}"', log=False)
+            return
+        if servername not in stkw_advanced.server_enhancers:
+            del ext.transactions[servername]
+            cmd.error(f'Server "{servername}" is no longer enhanced, transaction discarded.', log=False)
+            return
+        enhancer = stkw_advanced.server_enhancers[servername]
+        _changed, _restart = await apply_changes(enhancer, ext.transactions.pop(servername))
+        if not _changed:
+            cmd.print(f'Config of "{servername}" already has these values, nothing to apply')
+            return
+        if not enhancer.server.active:
+            await enhancer.write_serverconfig()
+            cmd.print(f'{len(_changed)} config values of stopped server "{servername}" written')
+            return
+        if _restart:
+            enhancer.save_serverconfig(later=True)
+            cmd.print(f'{len(_changed)} config values of "{servername}" are saved with one restart when the server is empty, '
+                      f'because of {", ".join(_restart)}')
+        else:
+            await enhancer.write_serverconfig()
+            cmd.print(f'{len(_changed)} config values of "{servername}" are applied live and written, no restart needed')
+    ext.add_command(stk_cfg_commit, 'stk-cfg-commit', ((str, 'servername'), ),
+                    description='Applies the changes of the transaction: live if the server supports it, '
+                                'otherwise with a single restart when the server is empty',
+                    atabcomplete=stkserver_tab)
+
+    def select_enhancers(selector: str) -> MutableSequence:
+        return [stkw_advanced.server_enhancers[name]
+                for name in select_servers(stkw_advanced.config, selector, sorted(stkw_advanced.server_enhancers))]
+
+    async def fleet_tab(cmd: AdminCommandExecutor, selector: str = '', cfgkey: str = '', *args, argl: str):
+        if not cfgkey and not (selector and argl):
+            _choices = ['all', *(f'{stkw_advanced.module.tag_prefix}{tag}' for tag in stkw_advanced.config['Tags']),
+                        *stkw_advanced.server_enhancers]
+            return list(filter(partial(_startswith_predicate, selector), _choices))
+        _enhancers = select_enhancers(selector)
+        if not _enhancers:
+            return
+        return _enhancers[0].cfgindex.complete(cfgkey)
+
+    async def stk_fleet_getcfg(cmd: AdminCommandExecutor, selector: str, cfgkey: str):
+        _enhancers = select_enhancers(selector)
+        if not _enhancers:
+            cmd.error(f'No enhanced servers match "{selector}"', log=False)
+            return
+        _rows = []
+        for enhancer in _enhancers:
+            cfgvalue = enhancer.get_config(cfgkey)
+            _state = 'running' if enhancer.server.active else 'stopped'
+            if restart_pending(enhancer):
+                _state += ', restart pending'
+            _rows.append((enhancer.name, cfgvalue if cfgvalue is not None else '(not set)', _state))
+        _namewidth = max(len(row[0]) for row in _rows)
+        _valuewidth = max(len(row[1]) for row in _rows)
+        cmd.print(f'{cfgkey} of {len(_rows)} servers:')
+        cmd.print(*(f'{name:<{_namewidth}}  {value:<{_valuewidth}}  {state}' for name, value, state in _rows), sep='\n')
+    ext.add_command(stk_fleet_getcfg, 'stk-fleet-getcfg', ((str, 'selector'), (str, 'cfgkey')),
+                    description='Shows the configuration value of all servers matching the selector: all, a glob or tag:<name>',
+                    atabcomplete=fleet_tab)
+
+    # names of the servers waiting for the rolling restart
+    ext.restarting = set()
+
+    def restart_pending(enhancer) -> bool:
+        # a pending save on empty restarts with the new values anyway
+        return (enhancer.saveonempty_task is not None and not enhancer.saveonempty_task.done()) or enhancer.name in ext.restarting
+
+    async def restart_when_empty(enhancer, semaphore: asyncio.Semaphore):
+        server = enhancer.server
+        try:
+            while True:
+                await server.empty_server.wait()
+                async with semaphore:
+                    if not server.empty_server.is_set():
+                        # a player came while waiting for the turn
+                        continue
+                    if not server.active:
+                        # stopped meanwhile, the new config is used on the next start
+                        return
+                    ext.logger.info(f'Rolling restart of {enhancer.name} to apply the config')
+                    server.restart = False
+                    await server.stop()
+                    if server.reader_task is not None:
+                        # the process is released when the reader has handled the exit
+                        await asyncio.wait((server.reader_task, ))
+                    await server.launch()
+                    if server.server_ready_task is not None:
+                        # the next server goes down only when this one is back
+                        await asyncio.wait((server.server_ready_task, ))
+                    return
+        finally:
+            ext.restarting.discard(enhancer.name)
+
+    async def rolling_restart(enhancers: Sequence):
+        semaphore = asyncio.Semaphore(max(config.getint('Fleet', 'restart_concurrency'), 1))
+        _results = await asyncio.gather(*(restart_when_empty(enhancer, semaphore) for enhancer in enhancers), return_exceptions=True)
+        for enhancer, result in zip(enhancers, _results):
+            if isinstance(result, Exception):
+                ext.logger.error(f'Rolling restart of {enhancer.name} failed', exc_info=result)
+        ext.logger.info(f'Rolling restart of {len(enhancers)} servers is finished')
+
+    def schedule_rolling_restart(enhancers: Sequence):
+        ext.restarting.update(enhancer.name for enhancer in enhancers)
+        ext.ace.task_registry.spawn(rolling_restart(enhancers), owner='stkw_configedit',
+                                    description=f'rolling restart of {len(enhancers)} servers', tasks=ext.tasks)
+
+    async def stk_fleet_setcfg(cmd: AdminCommandExecutor, selector: str, assignments: str):
+        changes = {}
+        try:
+            _assignments = shlex.split(assignments)
+        except ValueError as exc:
+            cmd.error(f'Cannot parse the assignments: {exc}', log=False)
+            return
+        for assignment in _assignments:
+            cfgkey, sep, value = assignment.partition('=')
+            if not sep or not cfgkey:
+                cmd.error(f'Expected key=value, got "{assignment}"', log=False)
+                return
+            changes[cfgkey] = value
+        _enhancers = select_enhancers(selector)
+        if not _enhancers:
+            cmd.error(f'No enhanced servers match "{selector}"', log=False)
+            return
+        _changed = []
+        _restart = []
+        for enhancer in _enhancers:
+            _values, _keys = await apply_changes(enhancer, changes)
+            if not _values:
+                continue
+            _changed.append(enhancer)
+            if _keys and not restart_pending(enhancer):
+                _restart.append(enhancer)
+        _results = await asyncio.gather(*(enhancer.write_serverconfig() for enhancer in _changed), return_exceptions=True)
+        for enhancer, result in zip(_changed, _results):
+            if isinstance(result, Exception):
+                cmd.error(f'Failed to write the config of {enhancer.name}: {result!r}', log=False)
+        cmd.print(f'{len(_changed)} of {len(_enhancers)} servers changed, '
+                  f'{len(_enhancers) - len(_changed)} already had these values')
+        if _restart:
+            schedule_rolling_restart(_restart)
+            cmd.print(f'{len(_restart)} running servers restart when empty, '
+                      f'{config.getint("Fleet", "restart_concurrency")} at a time: {", ".join(enhancer.name for enhancer in _restart)}')
+    ext.add_command(stk_fleet_setcfg, 'stk-fleet-setcfg', ((str, 'selector'), (None, 'key=value ...')),
+                    description='Sets the configuration values on all servers matching the selector: all, a glob or tag:<name>. '
+                                'Running servers are restarted when empty, a few at a time',
+                    atabcomplete=fleet_tab)
+
+    templates_path = ext.templates_path = os.path.join(ext.ace.extpath, config.get('Templates', 'path'))
+    for _dir in ('tags', 'servers'):
+        os.makedirs(os.path.join(templates_path, _dir), exist_ok=True)
+    ext.templates = stkw_advanced.module.TemplateCache()
+    effective_config = stkw_advanced.module.effective_config
+    tag_prefix = stkw_advanced.module.tag_prefix
+    # template files that trigger the rendering when they change
+    ext.watched_templates = set()
+
+    def template_paths(servername: str) -> MutableSequence[str]:
+        """Layers of the server config, the later ones override the earlier ones"""
+        _tags = [tag for tag in stkw_advanced.config['Tags']
+                 if select_servers(stkw_advanced.config, f'{tag_prefix}{tag}', (servername, ))]
+        return [stkw_advanced.stkdefaultxml_path,
+                *(os.path.join(templates_path, 'tags', f'{tag}.xml') for tag in _tags),
+                os.path.join(templates_path, 'servers', f'{servername}.xml')]
+
+    def templated_enhancers() -> MutableSequence:
+        return select_enhancers(config.get('Templates', 'servers'))
+
+    def watch_templates(paths: Sequence[str]):
+        if ext.file_watcher is None:
+            return
+        for path in paths:
+            if path not in ext.watched_templates:
+                ext.watched_templates.add(path)
+                ext.file_watcher.watch(path, _on_template_changed, owner='stkw_configedit')
+
+    async def render_servers(enhancers: Sequence, dry=False) -> Tuple[MutableSequence[Tuple[object, Sequence[str]]], MutableSequence]:
+        """
+        Renders the configs from the templates and writes the ones whose effective config has changed.
+        Running servers that need the restart are restarted when empty, a few at a time.
+        Returns the changed servers with their changed keys, and the servers that restart
+        """
+        _changed = []
+        _restart = []
+        for enhancer in enhancers:
+            _paths = template_paths(enhancer.name)
+            watch_templates(_paths)
+            try:
+                root, _effective = ext.templates.render(enhancer.name, _paths)
+            except (OSError, ElementTree.ParseError):
+                ext.logger.exception(f'Failed to render the config of {enhancer.name}')
+                continue
+            # the file could have been edited by hand meanwhile
+            enhancer.load_serverconfig()
+            _current = effective_config(enhancer.cfgindex)
+            _keys = sorted(cfgkey for cfgkey in _effective.keys() | _current.keys()
+                           if _effective.get(cfgkey) != _current.get(cfgkey))
+            if not _keys:
+                continue
+            _changed.append((enhancer, _keys))
+            if dry:
+                continue
+            enhancer.replace_config(copy.deepcopy(root))
+            if enhancer.server.active and not restart_pending(enhancer):
+                # removed keys can't be applied live
+                _live = {cfgkey: _effective[cfgkey].get('value', '') for cfgkey in _keys if cfgkey in _effective}
+                if len(_live) < len(_keys) or await apply_live(enhancer, _live):
+                    _restart.append(enhancer)
+        if dry:
+            return _changed, _restart
+        _results = await asyncio.gather(*(enhancer.write_serverconfig() for enhancer, _ in _changed), return_exceptions=True)
+        for (enhancer, _), result in zip(_changed, _results):
+            if isinstance(result, Exception):
+                ext.logger.error(f'Failed to write the rendered config of {enhancer.name}', exc_info=result)
+        if _restart:
+            schedule_rolling_restart(_restart)
+        if _changed:
+            ext.logger.info(f'Rendered configs of {len(_changed)} servers have changed, {len(_restart)} of them restart when empty')
+        return _changed, _restart
+    ext.render_servers = render_servers
+
+    async def _on_template_changed(path: str):
+        await render_servers(templated_enhancers())
+
+    def hook(enhancer):
+        if select_servers(stkw_advanced.config, config.get('Templates', 'servers'), (enhancer.name, )):
+            ext.ace.task_registry.spawn(render_servers((enhancer, )), owner='stkw_configedit',
+                                        description=f'render config of {enhancer.name}', tasks=ext.tasks)
+
+    async def selector_tab(cmd: AdminCommandExecutor, selector: str = '', *args, argl: str):
+        if args or (selector and argl):
+            return
+        return await fleet_tab(cmd, selector, argl=argl)
+
+    async def stk_render(cmd: AdminCommandExecutor, selector: str = '', dry=False):
+        _enhancers = select_enhancers(selector) if selector else templated_enhancers()
+        if not _enhancers:
+            cmd.error(f'No enhanced servers match "{selector or config.get("Templates", "servers")}"', log=False)
+            return
+        _changed, _restart = await render_servers(_enhancers, dry=dry)
+        cmd.print(f'{len(_changed)} of {len(_enhancers)} servers {"would change" if dry else "changed"}'
+                  + (f', {len(_restart)} restart when empty' if _restart else ''))
+        cmd.print(*(f'{enhancer.name}: {", ".join(_keys)}' for enhancer, _keys in _changed), sep='\n')
+    ext.add_command(stk_render, 'stk-render', optargs=((str, 'selector'), (bool, 'dry run?')),
+                    description='Renders the configs from stkdefault.xml and the overlays of the tags and the server, '
+                                'writes the changed ones and restarts those servers when empty. '
+                                'Without the selector, the servers of the Templates section are rendered',
+                    atabcomplete=selector_tab)
+
+    ext.file_watcher = getattr(ext.ace, 'file_watcher', None)
+    if ext.file_watcher is not None:
+        # tags of the servers could have changed
+        ext.file_watcher.watch(stkw_advanced.confpath, _on_template_changed, owner='stkw_configedit')
+    stkw_advanced.enhancer_created.append(hook)
+    ext.hook = hook
+    if templated_enhancers():
+        ext.ace.task_registry.spawn(render_servers(templated_enhancers()), owner='stkw_configedit',
+                                    description='render configs from the templates', tasks=ext.tasks)
+
 
 async def extension_cleanup(ext: AdminCommandExtension):
-    pass
+    stkw_advanced = ext.ace.extensions.get('stkw_advanced')
+    if stkw_advanced is not None and ext.hook in stkw_advanced.enhancer_created:
+        stkw_advanced.enhancer_created.remove(ext.hook)
+    if ext.file_watcher is not None:
+        ext.file_watcher.unwatch_owner('stkw_configedit')
@@ -0,0 +1,330 @@
+"""
+SuperTuxKart Wrapper Matches
+
+Records every game of the enhanced servers: mode, difficulty, start and end,
+stop and resume intervals, players and goals, into a SQLite database
+(extensions/matches.sqlite3 by default, see extensions/stkw_matches.conf).
+Per-player totals (goals, own goals, matches, wins) are updated on every event for all time,
+the current month, week and day, for every mode and for all modes together,
+so the leaderboards are read without scanning the history.
+The team of a player is only known from the goals: red for a goal of red, blue for an own goal of red.
+The win rate counts only the matches where the team of the player is known.
+"""
+from admin_console import AdminCommandExtension, AdminCommandExecutor, paginate_range
+from configparser import ConfigParser
+from functools import partial
+from typing import Optional, MutableMapping, MutableSet
+import weakref
+import os
+import sys
+import time
+import logging
+
+
+main = sys.modules['__main__']
+defaultconf = {
+    'Matches': {
+        'dbpath': 'matches.sqlite3',
+        'batch_size': 500,
+        'flush_interval': 2.0,
+        'max_queue': 100000
+    }
+}
+schema = """
+CREATE TABLE IF NOT EXISTS matches (
+    id INTEGER PRIMARY KEY,
+    server TEXT NOT NULL,
+    mode INTEGER NOT NULL,
+    difficulty INTEGER NOT NULL,
+    started_at REAL NOT NULL,
+    ended_at REAL,
+    score_red INTEGER,
+    score_blue INTEGER,
+    outcome TEXT
+);
+CREATE INDEX IF NOT EXISTS matches_started ON matches (started_at);
+CREATE TABLE IF NOT EXISTS match_pauses (
+    match_id INTEGER NOT NULL,
+    stopped_at REAL NOT NULL,
+    resumed_at REAL
+);
+CREATE INDEX IF NOT EXISTS match_pauses_match ON match_pauses (match_id);
+CREATE TABLE IF NOT EXISTS match_players (
+    match_id INTEGER NOT NULL,
+    username TEXT NOT NULL,
+    team TEXT,
+    PRIMARY KEY (match_id, username)
+);
+CREATE TABLE IF NOT EXISTS goals (
+    match_id INTEGER NOT NULL,
+    scored_at REAL NOT NULL,
+    username TEXT NOT NULL,
+    team TEXT NOT NULL,
+    own INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS goals_match ON goals (match_id);
+CREATE TABLE IF NOT EXISTS player_stats (
+    period TEXT NOT NULL,
+    period_key TEXT NOT NULL,
+    mode INTEGER NOT NULL,
+    username TEXT NOT NULL,
+    goals INTEGER NOT NULL DEFAULT 0,
+    own_goals INTEGER NOT NULL DEFAULT 0,
+    matches INTEGER NOT NULL DEFAULT 0,
+    rated INTEGER NOT NULL DEFAULT 0,
+    wins INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (period, period_key, mode, username)
+);
+CREATE INDEX IF NOT EXISTS player_stats_goals ON player_stats (period, period_key, mode, goals DESC);
+"""
+stats_upsert = """
+INSERT INTO player_stats (period, period_key, mode, username, goals, own_goals, matches, rated, wins)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (period, period_key, mode, username) DO UPDATE SET
+    goals = goals + excluded.goals, own_goals = own_goals + excluded.own_goals,
+    matches = matches + excluded.matches, rated = rated + excluded.rated, wins = wins + excluded.wins
+"""
+periods = ('all', 'month', 'week', 'day')
+# player_stats.mode of all modes together
+all_modes = -1
+aborted = 'aborted'
+
+
+def period_keys(at: float):
+    _t = time.localtime(at)
+    return (('all', ''), ('month', time.strftime('%Y-%m', _t)), ('week', time.strftime('%G-W%V', _t)),
+            ('day', time.strftime('%Y-%m-%d', _t)))
+
+
+def other_team(team: str) -> str:
+    return 'blue' if team == 'red' else 'red'
+
+
+class Match:
+    def __init__(self, id_: int, server: str, mode: int, started: float):
+        self.id = id_
+        self.server = server
+        self.mode = mode
+        self.started = started
+        self.players: MutableSet[str] = set()
+        self.teams: MutableMapping[str, str] = {}
+        self.paused: Optional[float] = None
+
+
+async def extension_init(ext: AdminCommandExtension):
+    stkw_advanced = weakref.proxy(ext.ace.extensions['stkw_advanced'])
+    stkserver_tab = stkw_advanced.module.stkserver_tab
+    gamemode_names = stkw_advanced.module.gamemode_names
+    difficulty_names = stkw_advanced.module.difficulty_names
+    ext.logger = ext.ace.logger.getChild('Matches')
+    ext.logger.propagate = True
+    ext.logger.setLevel(logging.INFO)
+    confpath = ext.confpath = os.path.join(ext.ace.extpath, 'stkw_matches.conf')
+    config = ext.config = ConfigParser(allow_no_value=True)
+
+    def load_config():
+        config.read_dict(defaultconf)
+        if os.path.isfile(confpath):
+            config.read(confpath)
+        else:
+            with open(confpath, 'x') as conffile:
+                config.write(conffile)
+    ext.load_config = load_config
+    load_config()
+    db = ext.db = main.WriteBehindDB(ext.logger, os.path.join(ext.ace.extpath, config.get('Matches', 'dbpath')), schema,
+                                     config.getint('Matches', 'batch_size'), config.getfloat('Matches', 'flush_interval'),
+                                     config.getint('Matches', 'max_queue'), ext.ace.metrics)
+    await db.open()
+    ext.matches: MutableMapping[str, Match] = {}
+    ext.next_id = (await db.query('SELECT COALESCE(MAX(id), 0) FROM matches'))[0][0]
+    ext.hooked: 'weakref.WeakKeyDictionary' = weakref.WeakKeyDictionary()
+
+    def add_stats(username: str, mode: int, at: float, goals=0, own_goals=0, matches=0, rated=0, wins=0):
+        for period, key in period_keys(at):
+            for _mode in (mode, all_modes):
+                db.write(stats_upsert, (period, key, _mode, username, goals, own_goals, matches, rated, wins))
+
+    def end_match(match: Match, outcome: str, score_red: Optional[int] = None, score_blue: Optional[int] = None):
+        _now = time.time()
+        del ext.matches[match.server]
+        if match.paused is not None:
+            db.write('UPDATE match_pauses SET resumed_at = ? WHERE match_id = ? AND resumed_at IS NULL', (_now, match.id))
+        db.write('UPDATE matches SET ended_at = ?, score_red = ?, score_blue = ?, outcome = ? WHERE id = ?',
+                 (_now, score_red, score_blue, outcome, match.id))
+        if outcome == aborted:
+            return
+        for username in match.players:
+            _team = match.teams.get(username)
+            db.write('INSERT OR REPLACE INTO match_players (match_id, username, team) VALUES (?, ?, ?)', (match.id, username, _team))
+            _rated = _team is not None and outcome in ('red', 'blue', 'draw')
+            add_stats(username, match.mode, _now, matches=1, rated=int(_rated), wins=int(_rated and _team == outcome))
+
+    async def on_game_start(server: str, event, enhancer, *args, **kwargs):
+        if server in ext.matches:
+            # the end of the previous game was not logged
+            end_match(ext.matches[server], aborted)
+        ext.next_id += 1
+        _now = time.time()
+        match = ext.matches[server] = Match(ext.next_id, server, enhancer.gamemode, _now)
+        match.players.update(enhancer.players)
+        db.write('INSERT INTO matches (id, server, mode, difficulty, started_at) VALUES (?, ?, ?, ?, ?)',
+                 (match.id, server, enhancer.gamemode, enhancer.difficulty, _now))
+
+    async def on_game_end(server: str, event, enhancer, *args, **kwargs):
+        match = ext.matches.get(server)
+        if match is None:
+            return
+        if isinstance(enhancer, stkw_advanced.STKSoccer):
+            _red, _blue = enhancer.score_red, enhancer.score_blue
+            end_match(match, 'red' if _red > _blue else 'blue' if _blue > _red else 'draw', _red, _blue)
+        else:
+            end_match(match, 'finished')
+
+    async def on_game_stop(server: str, event, enhancer, *args, **kwargs):
+        match = ext.matches.get(server)
+        if match is not None and match.paused is None:
+            match.paused = time.time()
+            db.write('INSERT INTO match_pauses (match_id, stopped_at) VALUES (?, ?)', (match.id, match.paused))
+
+    async def on_game_resume(server: str, event, enhancer, *args, **kwargs):
+        match = ext.matches.get(server)
+        if match is not None and match.paused is not None:
+            match.paused = None
+            db.write('UPDATE match_pauses SET resumed_at = ? WHERE match_id = ? AND resumed_at IS NULL', (time.time(), match.id))
+
+    async def on_join(server: str, event, username: str, *args, **kwargs):
+        match = ext.matches.get(server)
+        if match is not None:
+            match.players.add(username)
+
+    async def on_goal(server: str, event, username: str, *args, blue: bool, own: bool, **kwargs):
+        match = ext.matches.get(server)
+        if match is None:
+            return
+        _now = time.time()
+        _team = 'blue' if blue else 'red'
+        match.players.add(username)
+        match.teams[username] = other_team(_team) if own else _team
+        db.write('INSERT INTO goals (match_id, scored_at, username, team, own) VALUES (?, ?, ?, ?, ?)',
+                 (match.id, _now, username, _team, int(own)))
+        add_stats(username, match.mode, _now, goals=int(not own), own_goals=int(own))
+
+    def hook(enhancer):
+        if ext.ace.servers.get(enhancer.name) is None:
+            # not a managed server, for example a replay
+            return
+        _chains = [(enhancer.game_start, on_game_start), (enhancer.game_end, on_game_end), (enhancer.game_stop, on_game_stop),
+                   (enhancer.game_resume, on_game_resume), (enhancer.player_join, on_join)]
+        if isinstance(enhancer, stkw_advanced.STKSoccer):
+            _chains.append((enhancer.goal, on_goal))
+        for chain, handler in _chains:
+            _handler = ext.hooked[chain] = partial(handler, enhancer.name)
+            chain.add_handler(_handler)
+
+    # resume the games that are still running on re-attached servers
+    for _id, server, mode, started in await db.query(
+            'SELECT id, server, mode, started_at FROM matches WHERE ended_at IS NULL ORDER BY started_at'):
+        _enhancer = stkw_advanced.server_enhancers.get(server)
+        if server in ext.matches:
+            # only the last game of a server can be running
+            end_match(ext.matches[server], aborted)
+        match = ext.matches[server] = Match(_id, server, mode, started)
+        if _enhancer is None or not _enhancer.game_running:
+            end_match(match, aborted)
+            continue
+        match.players.update(_enhancer.players)
+        for username, team, own in await db.query('SELECT username, team, own FROM goals WHERE match_id = ?', (_id, )):
+            match.players.add(username)
+            match.teams[username] = other_team(team) if own else team
+        _pauses = await db.query('SELECT stopped_at FROM match_pauses WHERE match_id = ? AND resumed_at IS NULL', (_id, ))
+        if _enhancer.game_stopped:
+            if _pauses:
+                match.paused = _pauses[0][0]
+            else:
+                # stopped while the wrapper was down
+                match.paused = time.time()
+                db.write('INSERT INTO match_pauses (match_id, stopped_at) VALUES (?, ?)', (_id, match.paused))
+        elif _pauses:
+            # resumed while the wrapper was down
+            db.write('UPDATE match_pauses SET resumed_at = ? WHERE match_id = ? AND resumed_at IS NULL', (time.time(), _id))
+    for enhancer in tuple(stkw_advanced.server_enhancers.values()):
+        hook(enhancer)
+    stkw_advanced.enhancer_created.append(hook)
+    ext.hook = hook
+
+    def parse_mode(mode: str) -> Optional[int]:
+        if mode in ('', 'all', '*'):
+            return all_modes
+        if mode.isdigit():
+            return int(mode) if int(mode) < len(gamemode_names) else None
+        mode = mode.replace('_', ' ')
+        if mode in gamemode_names:
+            return gamemode_names.index(mode)
+        return None
+
+    async def mode_period_tab(cmd: AdminCommandExecutor, mode: str = '', period: str = '', *args, argl: str):
+        if args or (period and not argl):
+            return list(_period for _period in periods if _period.startswith(period))
+        if mode and argl:
+            return list(periods)
+        return list(_mode for _mode in ('all', *(name.replace(' ', '_') for name in gamemode_names)) if _mode.startswith(mode))
+
+    async def stk_leaderboard(cmd: AdminCommandExecutor, mode: str = 'all', period: str = 'all', cpage: int = 1):
+        _mode = parse_mode(mode)
+        if _mode is None:
+            cmd.error(f'Unknown mode "{mode}", use all, a number from 0 to {len(gamemode_names) - 1} or one of: '
+                      f'{", ".join(name.replace(" ", "_") for name in gamemode_names)}', log=False)
+            return
+        if period not in periods:
+            cmd.error(f'Unknown period "{period}", use one of: {", ".join(periods)}', log=False)
+            return
+        await db.flush()
+        _key = dict(period_keys(time.time()))[period]
+        _count = (await db.query('SELECT COUNT(*) FROM player_stats WHERE period = ? AND period_key = ? AND mode = ?',
+                                 (period, _key, _mode)))[0][0]
+        _maxpage, _start, _end = paginate_range(_count, 10, cpage)
+        _rows = await db.query(
+            'SELECT username, goals, own_goals, matches, rated, wins FROM player_stats '
+            'WHERE period = ? AND period_key = ? AND mode = ? ORDER BY goals DESC, wins DESC LIMIT ? OFFSET ?',
+            (period, _key, _mode, _end - _start, _start))
+        cmd.print(f'Leaderboard of {"all modes" if _mode == all_modes else gamemode_names[_mode]}, '
+                  f'{"all time" if period == "all" else f"this {period} ({_key})"} (page {cpage} of {_maxpage}):')
+        cmd.print(*(f'#{_start + i + 1}. {username}: {goals} goals, {own_goals} own goals, {matches} matches'
+                    f'{f", win rate {wins / rated * 100:.0f}%" if rated else ""}'
+                    for i, (username, goals, own_goals, matches, rated, wins) in enumerate(_rows)), sep='\n')
+    ext.add_command(stk_leaderboard, 'stk-leaderboard', optargs=((str, 'mode'), (str, 'period'), (int, 'page')),
+                    description='Shows the players with the most goals, of a mode or all modes, '
+                                'for all time or the current month, week or day',
+                    atabcomplete=mode_period_tab)
+
+    async def stk_matches(cmd: AdminCommandExecutor, server: str = '', cpage: int = 1):
+        _server = '' if server in ('', '*', 'all') else server
+        await db.flush()
+        _count = (await db.query('SELECT COUNT(*) FROM matches' + (' WHERE server = ?' if _server else ''),
+                                 (_server, ) if _server else ()))[0][0]
+        _maxpage, _start, _end = paginate_range(_count, 10, cpage)
+        _rows = await db.query(
+            'SELECT id, server, mode, difficulty, started_at, ended_at, score_red, score_blue, outcome, '
+            '(SELECT COALESCE(SUM(COALESCE(resumed_at, ended_at) - stopped_at), 0) FROM match_pauses WHERE match_id = matches.id) '
+            'FROM matches' + (' WHERE server = ?' if _server else '') + ' ORDER BY started_at DESC LIMIT ? OFFSET ?',
+            ((_server, ) if _server else ()) + (_end - _start, _start))
+        cmd.print(f'Recent matches{f" of {_server}" if _server else ""} (page {cpage} of {_maxpage}):')
+        cmd.print(*(f'#{_id} {time.strftime("%Y-%m-%d %H:%M", time.localtime(started))} {_srv}: '
+                    f'{gamemode_names[mode]}, {difficulty_names[difficulty]}, '
+                    f'{f"{(ended - started) / 60:.1f} min" if ended is not None else "running"}'
+                    f'{f" ({paused / 60:.1f} min stopped)" if paused else ""}'
+                    f'{f", {red} - {blue}" if red is not None else ""}{f", {outcome}" if outcome else ""}'
+                    for _id, _srv, mode, difficulty, started, ended, red, blue, outcome, paused in _rows), sep='\n')
+    ext.add_command(stk_matches, 'stk-matches', optargs=((str, 'server or all'), (int, 'page')),
+                    description='Shows the recent matches with their score',
+                    atabcomplete=stkserver_tab)
+
+
+async def extension_cleanup(ext: AdminCommandExtension):
+    stkw_advanced = ext.ace.extensions.get('stkw_advanced')
+    if stkw_advanced is not None and ext.hook in stkw_advanced.enhancer_created:
+        stkw_advanced.enhancer_created.remove(ext.hook)
+    for chain, handler in tuple(ext.hooked.items()):
+        chain.remove_handler(handler)
+    # running matches stay open, they are resumed or aborted by the next start
+    await ext.db.close()
@@ -0,0 +1,300 @@
+"""
+SuperTuxKart Wrapper Replay
+
+Records the raw stdout of a running server to a capture file
+and replays it through STKServer.handle_stdout and the enhancer, without running STK.
+Used to profile the enhancers offline and as a repeatable regression test:
+the enhancer state at the start and at the end of the capture is stored in the file,
+the replay starts from the first one and is compared with the second one.
+
+Capture file is a gzip-compressed text:
+#stkcapture {"server": ..., "enhancer": ..., "started": ..., "state": {...}}
+<seconds since the start>\t<raw stdout line>
+...
+#state {...}
+"""
+from admin_console import AdminCommandExtension, AdminCommandExecutor, paginate_range
+from configparser import ConfigParser
+from typing import Optional, MutableMapping, MutableSequence, Mapping, Any, Tuple
+import weakref
+import gzip
+import json
+import os
+import sys
+import asyncio
+import time
+import logging
+
+
+main = sys.modules['__main__']
+STKServer = main.STKServer
+TimedHandlerChain = main.TimedHandlerChain
+header_prefix = '#stkcapture '
+state_prefix = '#state '
+defaultconf = {
+    'Replay': {
+        'capturepath': 'captures',
+        # lines handled between the yields to the event loop at the maximum speed
+        'yield_every': 500
+    }
+}
+
+
+class Capture:
+    """Writes the stdout lines of a server with their time offsets, attached to STKServer.stdout_taps"""
+    def __init__(self, server: STKServer, path: str, enhancer=None):
+        self.server = server
+        self.path = path
+        self.enhancer = enhancer
+        self.lines = 0
+        self.started = time.monotonic()
+        self.file = gzip.open(path, 'wt', encoding='utf-8', newline='')
+        self.file.write(header_prefix + json.dumps({
+            'server': server.name,
+            'enhancer': type(enhancer).__name__ if enhancer is not None else None,
+            'started': time.time(),
+            'state': self.state()
+        }) + '\n')
+        server.stdout_taps.append(self.tap)
+
+    def state(self) -> MutableMapping[str, Any]:
+        return {
+            'peer_count': self.server.peer_count,
+            'enhancer': self.enhancer.export_state() if self.enhancer is not None else None
+        }
+
+    def tap(self, line: str):
+        if not line:
+            return
+        if not line.endswith('\n'):
+            line += '\n'
+        self.file.write(f'{time.monotonic() - self.started:.3f}\t{line}')
+        self.lines += 1
+
+    def close(self):
+        try:
+            self.server.stdout_taps.remove(self.tap)
+        except ValueError:
+            pass
+        self.file.write(state_prefix + json.dumps(self.state()) + '\n')
+        self.file.close()
+
+
+def read_capture(path: str) -> Tuple[Mapping[str, Any], MutableSequence[Tuple[float, str]], Optional[Mapping[str, Any]]]:
+    """Returns the header, the lines with their offsets and the final state, if the capture was finished"""
+    header = None
+    records = []
+    state = None
+    with gzip.open(path, 'rt', encoding='utf-8', newline='') as file:
+        try:
+            for record in file:
+                if record.startswith(header_prefix):
+                    header = json.loads(record[len(header_prefix):])
+                elif record.startswith(state_prefix):
+                    state = json.loads(record[len(state_prefix):])
+                else:
+                    _offset, _, line = record.partition('\t')
+                    records.append((float(_offset), line))
+        except EOFError:
+            # the wrapper has exited without stopping the capture
+            pass
+    if header is None:
+        raise ValueError(f'"{path}" is not a capture file')
+    return header, records, state
+
+
+def compare_state(expected: Mapping[str, Any], actual: Mapping[str, Any]) -> MutableSequence[str]:
+    """Returns the differences between two states, player lists are compared as sets"""
+    differences = []
+    for key, value in expected.items():
+        _actual = actual.get(key)
+        if isinstance(value, list) and isinstance(_actual, list):
+            if set(value) != set(_actual):
+                _missing = ', '.join(sorted(set(value) - set(_actual))) or '-'
+                _extra = ', '.join(sorted(set(_actual) - set(value))) or '-'
+                differences.append(f'{key}: missing {_missing}, unexpected {_extra}')
+        elif value != _actual:
+            differences.append(f'{key}: expected {value!r}, got {_actual!r}')
+    return differences
+
+
+class ReplayStdin:
+    """Accepts the commands sent by the enhancers during the replay"""
+    def __init__(self):
+        self.commands: MutableSequence[bytes] = []
+
+    def write(self, data: bytes):
+        self.commands.append(data)
+
+    async def drain(self):
+        pass
+
+
+class ReplayProcess:
+    """Stands for the STK process during the replay"""
+    pid = None
+    returncode = None
+
+    def __init__(self):
+        self.stdin = ReplayStdin()
+
+
+async def extension_init(ext: AdminCommandExtension):
+    stkw_advanced = weakref.proxy(ext.ace.extensions['stkw_advanced'])
+    stkserver_tab = stkw_advanced.module.stkserver_tab
+    confpath = ext.confpath = os.path.join(ext.ace.extpath, 'stkw_replay.conf')
+    config = ext.config = ConfigParser(allow_no_value=True)
+    ext.captures: MutableMapping[str, Capture] = {}
+    # replayed lines are not logged, the logging of a real server is not what is profiled
+    ext.replay_logger = logging.getLogger('stkw_replay')
+    ext.replay_logger.addHandler(logging.NullHandler())
+    ext.replay_logger.propagate = False
+
+    def load_config():
+        config.read_dict(defaultconf)
+        if os.path.isfile(confpath):
+            config.read(confpath)
+        else:
+            with open(confpath, 'x') as conffile:
+                config.write(conffile)
+    ext.load_config = load_config
+    load_config()
+
+    def stop_capture(name: str) -> Capture:
+        capture = ext.captures.pop(name)
+        capture.close()
+        ext.logmsg(f'Capture of {name} stopped, {capture.lines} lines written to "{capture.path}"')
+        return capture
+
+    async def stk_capture(cmd: AdminCommandExecutor, name: str, path: str = ''):
+        if name not in ext.ace.servers:
+            cmd.error('Server doesn\'t exist', log=False)
+            return
+        if name in ext.captures:
+            cmd.error(f'Server is already captured to "{ext.captures[name].path}"', log=False)
+            return
+        if not path:
+            _dir = config.get('Replay', 'capturepath')
+            os.makedirs(_dir, exist_ok=True)
+            path = os.path.join(_dir, f'{name}-{time.strftime("%Y%m%d-%H%M%S")}.stkcap.gz')
+        # the enhancer is not created here if the server is not enhanced
+        ext.captures[name] = Capture(ext.ace.servers[name], path, stkw_advanced.server_enhancers.get(name))
+        cmd.print(f'Capturing the output of {name} to "{path}"')
+    ext.add_command(stk_capture, 'stk-capture', ((str, 'name'), ), ((None, 'path'), ),
+                    description='Starts recording the raw output of the server to a capture file for stk-replay',
+                    atabcomplete=stkserver_tab)
+
+    async def captured_tab(cmd: AdminCommandExecutor, name: str = '', *args, argl: str):
+        if args:
+            return
+        return list(_name for _name in ext.captures.keys() if _name.startswith(name))
+
+    async def stk_capture_stop(cmd: AdminCommandExecutor, name: str):
+        if name not in ext.captures:
+            cmd.error('Server is not captured', log=False)
+            return
+        capture = stop_capture(name)
+        cmd.print(f'Capture stopped, {capture.lines} lines written to "{capture.path}"')
+    ext.stop_capture = stop_capture
+    ext.add_command(stk_capture_stop, 'stk-capture-stop', ((str, 'name'), ),
+                    description='Stops the capture and stores the final enhancer state as the expected replay result',
+                    atabcomplete=captured_tab)
+
+    async def stk_captures(cmd: AdminCommandExecutor, cpage: int = 1):
+        _captures = tuple(ext.captures.values())
+        _maxpage, _start, _end = paginate_range(len(_captures), 10, cpage)
+        cmd.print(f'Running captures (page {cpage} of {_maxpage}):')
+        _now = time.monotonic()
+        cmd.print(*(f'{capture.server.name}: {capture.lines} lines in {_now - capture.started:.0f} s to "{capture.path}"'
+                    for capture in _captures[_start:_end]), sep='\n')
+    ext.add_command(stk_captures, 'stk-captures', optargs=((int, 'page'), ), description='Shows the running captures')
+
+    async def replay(speed: float, template: STKServer, header: Mapping[str, Any],
+                     records: MutableSequence[Tuple[float, str]]):
+        _class = header.get('enhancer')
+        _enhancer_class = getattr(stkw_advanced, _class) if _class in ('ServerEnhancer', 'STKSoccer') else None
+        _timing = TimedHandlerChain.enabled
+        # the chains of the replayed server are always timed, for the report
+        TimedHandlerChain.enabled = True
+        try:
+            server = STKServer(
+                ext.replay_logger, template.writeln, f'{template.name}~replay', cfgpath=template.cfgpath,
+                datapath=template.datapath, executable_path=template.executable_path, cwd=template.cwd,
+                autorestart=False, global_logignores=template.global_logignores, logignores=template.log_ignores
+            )
+            server.process = ReplayProcess()
+            server.active = True
+            _state = header.get('state') or {}
+            server.peer_count = _state.get('peer_count', 0)
+            if server.peer_count:
+                server.empty_server.clear()
+            if _state.get('enhancer') is not None:
+                server.attached_state['enhancer'] = _state['enhancer']
+            enhancer = _enhancer_class(server) if _enhancer_class is not None else None
+        finally:
+            TimedHandlerChain.enabled = _timing
+        _yield_every = config.getint('Replay', 'yield_every')
+        _start = time.perf_counter()
+        try:
+            for i, (offset, line) in enumerate(records):
+                if speed:
+                    _delay = offset / speed - (time.perf_counter() - _start)
+                    if _delay > 0:
+                        await asyncio.sleep(_delay)
+                elif not i % _yield_every:
+                    # keep the wrapper responsive
+                    await asyncio.sleep(0)
+                await server.handle_stdout(main.ansi_escape.sub('', line))
+            _elapsed = time.perf_counter() - _start
+            # before the cleanup removes the handlers with their stats
+            _stats = sorted(((chain, stats) for chain in tuple(TimedHandlerChain.chains) if chain.server == server.name
+                             for stats in chain.stats.values() if stats.calls),
+                            key=lambda row: row[1].total, reverse=True)
+        finally:
+            server.active = False
+            if enhancer is not None:
+                enhancer.cleanup()
+        return server, enhancer, _elapsed, _stats
+
+    async def stk_replay(cmd: AdminCommandExecutor, path: str, speed: float = 0.0, name: str = ''):
+        if not os.path.isfile(path):
+            cmd.error(f'File "{path}" not found', log=False)
+            return
+        try:
+            header, records, expected = await asyncio.to_thread(read_capture, path)
+        except (OSError, ValueError):
+            cmd.error(f'Failed to read the capture "{path}"', log=False)
+            return
+        name = name or header['server']
+        if name not in ext.ace.servers:
+            cmd.error(f'Server "{name}" doesn\'t exist, specify the server with the config of the captured one', log=False)
+            return
+        server, enhancer, _elapsed, _stats = await replay(speed, ext.ace.servers[name], header, records)
+        _captured = records[-1][0] if records else 0.0
+        cmd.print(f'Replayed {len(records)} lines ({_captured:.1f} s captured) of {header["server"]} '
+                  f'{f"at {speed:g}x speed" if speed else "at the maximum speed"} in {_elapsed:.3f} s: '
+                  f'{len(records) / _elapsed if _elapsed else 0.0:.0f} lines/s, '
+                  f'{len(server.process.stdin.commands)} commands sent to the server')
+        if _stats:
+            cmd.print(*(f'{chain.name} {stats.name}: {stats.calls} calls, avg {stats.total / stats.calls * 1000:.3f} ms, '
+                        f'max {stats.max * 1000:.3f} ms, total {stats.total:.3f} s, {stats.errors} errors'
+                        for chain, stats in _stats), sep='\n')
+        if expected is None:
+            cmd.print('The capture was not stopped, there is no expected state to compare with')
+            return
+        _actual = {'peer_count': server.peer_count, 'enhancer': enhancer.export_state() if enhancer is not None else None}
+        _differences = compare_state({'peer_count': expected['peer_count']}, _actual)
+        if expected.get('enhancer') is not None and enhancer is not None:
+            _differences.extend(compare_state(expected['enhancer'], _actual['enhancer']))
+        if _differences:
+            cmd.error('The state after the replay differs from the captured one:\n' + '\n'.join(_differences), log=False)
+        else:
+            cmd.print('The state after the replay matches the captured one')
+    ext.add_command(stk_replay, 'stk-replay', ((str, 'path'), ), ((float, 'speed'), (str, 'server name')),
+                    description='Replays a capture through the server output handling and the enhancer without running STK. '
+                                'Speed 1 is real time, 0 is the maximum speed')
+
+
+async def extension_cleanup(ext: AdminCommandExtension):
+    for name in tuple(ext.captures.keys()):
+        ext.stop_capture(name)
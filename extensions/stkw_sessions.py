@@ -0,0 +1,241 @@
+"""
+SuperTuxKart Wrapper Sessions
+
+Records the sessions of the players on the enhanced servers: join with the online id,
+validation and leave, with their time and server, into a SQLite database
+(extensions/sessions.sqlite3 by default, see extensions/stkw_sessions.conf).
+Writes are queued and committed in batches, so the log handlers never wait for the disk.
+Sessions that are still open when the wrapper exits are resumed if the player is still online
+on a re-attached server, otherwise they are closed as lost.
+"""
+from admin_console import AdminCommandExtension, AdminCommandExecutor, paginate_range
+from configparser import ConfigParser
+from functools import partial
+from typing import Optional, MutableMapping, Tuple
+import weakref
+import os
+import sys
+import time
+import logging
+
+
+main = sys.modules['__main__']
+defaultconf = {
+    'Sessions': {
+        'dbpath': 'sessions.sqlite3',
+        'batch_size': 500,
+        'flush_interval': 2.0,
+        'max_queue': 100000
+    }
+}
+schema = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    server TEXT NOT NULL,
+    username TEXT NOT NULL,
+    online_id INTEGER,
+    joined_at REAL NOT NULL,
+    validated_at REAL,
+    left_at REAL,
+    end_reason TEXT
+);
+CREATE INDEX IF NOT EXISTS sessions_username ON sessions (username, joined_at);
+CREATE INDEX IF NOT EXISTS sessions_joined ON sessions (joined_at);
+CREATE INDEX IF NOT EXISTS sessions_open ON sessions (server) WHERE left_at IS NULL;
+"""
+# lost sessions have no real leave time, they are excluded from the lengths
+lost_reason = 'lost'
+bar_width = 40
+
+
+def concurrency_history(connection, start: float, end: float, bucket: float, server: str):
+    """Maximum number of concurrent sessions in every bucket between start and end"""
+    _server = 'AND server = ?' if server else ''
+    events = []
+    for joined, left in connection.execute(
+            f'SELECT joined_at, COALESCE(left_at, ?) FROM sessions WHERE joined_at < ? AND (left_at IS NULL OR left_at > ?) {_server}',
+            (end, end, start, server) if server else (end, end, start)):
+        events.append((joined, 1))
+        events.append((left, -1))
+    # leaves go first at the same moment
+    events.sort()
+    buckets = [0] * max(int((end - start) // bucket) + 1, 1)
+    count = 0
+    i = 0
+    # sessions that have started before the range
+    while i < len(events) and events[i][0] < start:
+        count += events[i][1]
+        i += 1
+    for j in range(len(buckets)):
+        _bucket_end = start + (j + 1) * bucket
+        _peak = count
+        while i < len(events) and events[i][0] < _bucket_end:
+            count += events[i][1]
+            _peak = max(_peak, count)
+            i += 1
+        buckets[j] = _peak
+    return buckets
+
+
+async def extension_init(ext: AdminCommandExtension):
+    stkw_advanced = weakref.proxy(ext.ace.extensions['stkw_advanced'])
+    stkserver_tab = stkw_advanced.module.stkserver_tab
+    ext.logger = ext.ace.logger.getChild('Sessions')
+    ext.logger.propagate = True
+    ext.logger.setLevel(logging.INFO)
+    confpath = ext.confpath = os.path.join(ext.ace.extpath, 'stkw_sessions.conf')
+    config = ext.config = ConfigParser(allow_no_value=True)
+
+    def load_config():
+        config.read_dict(defaultconf)
+        if os.path.isfile(confpath):
+            config.read(confpath)
+        else:
+            with open(confpath, 'x') as conffile:
+                config.write(conffile)
+    ext.load_config = load_config
+    load_config()
+    db = ext.db = main.WriteBehindDB(ext.logger, os.path.join(ext.ace.extpath, config.get('Sessions', 'dbpath')), schema,
+                                     config.getint('Sessions', 'batch_size'), config.getfloat('Sessions', 'flush_interval'),
+                                     config.getint('Sessions', 'max_queue'), ext.ace.metrics)
+    await db.open()
+    # (server, username): (session id, join time)
+    ext.open_sessions: MutableMapping[Tuple[str, str], Tuple[int, float]] = {}
+    ext.next_id = (await db.query('SELECT COALESCE(MAX(id), 0) FROM sessions'))[0][0]
+    # handlers added to the events of the enhancers, removed on cleanup
+    ext.hooked: 'weakref.WeakKeyDictionary' = weakref.WeakKeyDictionary()
+
+    def close_session(key: Tuple[str, str], reason: str, at: Optional[float] = None):
+        _id, _ = ext.open_sessions.pop(key)
+        db.write('UPDATE sessions SET left_at = ?, end_reason = ? WHERE id = ?', (at or time.time(), reason, _id))
+
+    async def on_join(server: str, event, username: str, *args, _match=None, **kwargs):
+        key = (server, username)
+        _now = time.time()
+        if key in ext.open_sessions:
+            close_session(key, 'rejoin', _now)
+        ext.next_id += 1
+        ext.open_sessions[key] = (ext.next_id, _now)
+        db.write('INSERT INTO sessions (id, server, username, online_id, joined_at) VALUES (?, ?, ?, ?, ?)',
+                 (ext.next_id, server, username, int(_match.group('online_id')) if _match is not None else None, _now))
+
+    async def on_validate(server: str, event, username: str, *args, **kwargs):
+        _session = ext.open_sessions.get((server, username))
+        if _session is not None:
+            db.write('UPDATE sessions SET validated_at = ? WHERE id = ?', (time.time(), _session[0]))
+
+    async def on_leave(server: str, event, username: str, *args, _match=None, **kwargs):
+        if (server, username) in ext.open_sessions:
+            # without a log line the player is gone because the server has been restarted
+            close_session((server, username), 'leave' if _match is not None else 'restart')
+
+    def hook(enhancer):
+        if ext.ace.servers.get(enhancer.name) is None:
+            # not a managed server, for example a replay
+            return
+        for chain, handler in ((enhancer.player_join, on_join), (enhancer.player_validate, on_validate),
+                               (enhancer.player_leave, on_leave)):
+            _handler = ext.hooked[chain] = partial(handler, enhancer.name)
+            chain.add_handler(_handler)
+
+    # resume the sessions of the players that are still online
+    _online = set((name, username) for name, enhancer in tuple(stkw_advanced.server_enhancers.items())
+                  for username in enhancer.players)
+    _lost = 0
+    _now = time.time()
+    for _id, server, username, joined in await db.query('SELECT id, server, username, joined_at FROM sessions WHERE left_at IS NULL'):
+        ext.open_sessions[(server, username)] = (_id, joined)
+        if (server, username) not in _online:
+            close_session((server, username), lost_reason, _now)
+            _lost += 1
+    if _lost:
+        ext.logger.info(f'{_lost} sessions were open when the wrapper exited, closed as lost')
+    for enhancer in tuple(stkw_advanced.server_enhancers.values()):
+        hook(enhancer)
+    stkw_advanced.enhancer_created.append(hook)
+    ext.hook = hook
+
+    def _server_filter(server: str) -> str:
+        return '' if server in ('', '*', 'all') else server
+
+    async def stk_sessions(cmd: AdminCommandExecutor, server: str = '', cpage: int = 1):
+        server = _server_filter(server)
+        _now = time.time()
+        _open = sorted(((key, joined) for key, (_, joined) in ext.open_sessions.items() if not server or key[0] == server),
+                       key=lambda row: row[1])
+        _maxpage, _start, _end = paginate_range(len(_open), 10, cpage)
+        cmd.print(f'Session store: {len(db.queue)} queued, {db.written} written in {db.batches} batches, {db.errors} failed batches, {db.dropped} dropped')
+        cmd.print(f'Online players (page {cpage} of {_maxpage}):')
+        cmd.print(*(f'{_server}: {username} for {(_now - joined) / 60:.0f} min' for (_server, username), joined in _open[_start:_end]),
+                  sep='\n')
+    ext.add_command(stk_sessions, 'stk-sessions', optargs=((str, 'server or all'), (int, 'page')),
+                    description='Shows the open player sessions and the state of the session store',
+                    atabcomplete=stkserver_tab)
+
+    async def stk_sessions_concurrency(cmd: AdminCommandExecutor, server: str = '', hours: float = 24.0, bucket: float = 60.0):
+        server = _server_filter(server)
+        if hours <= 0 or bucket <= 0:
+            cmd.error('Hours and bucket minutes must be positive', log=False)
+            return
+        await db.flush()
+        _end = time.time()
+        _start = _end - hours * 3600
+        buckets = await db.transaction(partial(concurrency_history, start=_start, end=_end, bucket=bucket * 60, server=server))
+        _peak = max(buckets, default=0)
+        cmd.print(f'Concurrent players of {server or "all servers"} for the last {hours:g} hours, peak {_peak}:')
+        cmd.print(*(f'{time.strftime("%m-%d %H:%M", time.localtime(_start + i * bucket * 60))} {count:>4} '
+                    f'{"#" * (round(count / _peak * bar_width) if _peak else 0)}'
+                    for i, count in enumerate(buckets)), sep='\n')
+    ext.add_command(stk_sessions_concurrency, 'stk-sessions-concurrency',
+                    optargs=((str, 'server or all'), (float, 'hours'), (float, 'bucket minutes')),
+                    description='Shows the maximum number of concurrent players over time',
+                    atabcomplete=stkserver_tab)
+
+    async def stk_sessions_lengths(cmd: AdminCommandExecutor, server: str = '', days: float = 7.0):
+        server = _server_filter(server)
+        await db.flush()
+        _since = time.time() - days * 86400
+        _lengths = [row[0] for row in await db.query(
+            'SELECT left_at - joined_at FROM sessions WHERE joined_at >= ? AND left_at IS NOT NULL AND end_reason != ?'
+            + (' AND server = ?' if server else '') + ' ORDER BY 1',
+            (_since, lost_reason, server) if server else (_since, lost_reason))]
+        if not _lengths:
+            cmd.print(f'No finished sessions of {server or "all servers"} for the last {days:g} days')
+            return
+        _p50, _p90, _p99 = main.percentiles(_lengths)
+        cmd.print(f'{len(_lengths)} sessions of {server or "all servers"} for the last {days:g} days: '
+                  f'average {sum(_lengths) / len(_lengths) / 60:.1f} min, median {_p50 / 60:.1f} min, '
+                  f'p90 {_p90 / 60:.1f} min, p99 {_p99 / 60:.1f} min, longest {_lengths[-1] / 60:.1f} min')
+    ext.add_command(stk_sessions_lengths, 'stk-sessions-lengths', optargs=((str, 'server or all'), (float, 'days')),
+                    description='Shows the statistics of the session lengths',
+                    atabcomplete=stkserver_tab)
+
+    async def stk_sessions_visitors(cmd: AdminCommandExecutor, server: str = '', days: float = 30.0, cpage: int = 1):
+        server = _server_filter(server)
+        await db.flush()
+        _since = time.time() - days * 86400
+        _rows = await db.query(
+            'SELECT username, COUNT(*), COUNT(DISTINCT date(joined_at, \'unixepoch\')), MAX(joined_at) FROM sessions '
+            'WHERE joined_at >= ?' + (' AND server = ?' if server else '') + ' GROUP BY username ORDER BY 2 DESC, 4 DESC',
+            (_since, server) if server else (_since, ))
+        _repeat = tuple(row for row in _rows if row[1] > 1)
+        cmd.print(f'{len(_rows)} players of {server or "all servers"} for the last {days:g} days, '
+                  f'{len(_repeat)} of them came more than once')
+        _maxpage, _start, _end = paginate_range(len(_repeat), 10, cpage)
+        cmd.print(f'Repeat visitors (page {cpage} of {_maxpage}):')
+        cmd.print(*(f'{username}: {sessions} sessions on {days_} days, last {time.strftime("%Y-%m-%d %H:%M", time.localtime(last))}'
+                    for username, sessions, days_, last in _repeat[_start:_end]), sep='\n')
+    ext.add_command(stk_sessions_visitors, 'stk-sessions-visitors',
+                    optargs=((str, 'server or all'), (float, 'days'), (int, 'page')),
+                    description='Shows the players that came back, by their number of sessions',
+                    atabcomplete=stkserver_tab)
+
+
+async def extension_cleanup(ext: AdminCommandExtension):
+    stkw_advanced = ext.ace.extensions.get('stkw_advanced')
+    if stkw_advanced is not None and ext.hook in stkw_advanced.enhancer_created:
+        stkw_advanced.enhancer_created.remove(ext.hook)
+    for chain, handler in tuple(ext.hooked.items()):
+        chain.remove_handler(handler)
+    # open sessions stay open, they are resumed or closed by the next start
+    await ext.db.close()
@@ -4,16 +4,40 @@
 * Author: DernisNW (a.k.a. NobWow)
 """
 import asyncio
+import base64
+import ctypes
+import ctypes.util
+import datetime
+import fcntl
+import hashlib
+import heapq
+import inspect
+import json
 import logging
+import math
+import random
+import time
 import traceback
 import os
 import re
 import shlex
+import signal
+import socket
+import sqlite3
+import stat
+import struct
+import subprocess
+import sys
+import termios
+import warnings
+import weakref
 # import traceback
 # from shutil import rmtree
 # from zipfile import ZipFile
 # from math import floor
 # from defusedxml import ElementTree as dElementTree
+from abc import ABC, abstractmethod
+from array import array
 from logging.handlers import TimedRotatingFileHandler
 from admin_console import AdminCommandExecutor, AdminCommandExtension, basic_command_set, paginate_range
 from admin_console.ainput import colors, ARILogHandler
@@ -23,7 +47,11 @@ from enum import IntEnum
 from packaging.version import parse as parseVersion
 from functools import partial
 from contextlib import asynccontextmanager
-from typing import Sequence, MutableSequence, Optional, Mapping, MutableMapping, Callable, Any
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from typing import Sequence, MutableSequence, Optional, Mapping, MutableMapping, Callable, Any, Tuple, Union, Deque, Set
+from urllib.parse import parse_qs, urlsplit
 
 
 ansi_escape = re.compile(r'(?:\x9B|\x1B\[)[0-?]*[ -\/]*[@-~]')
@@ -95,6 +123,18 @@ def load_config(ace: AdminCommandExecutor):
     ace.config['timed_autorestart_interval'] = ace.config.get('timed_autorestart_interval', False)
     ace.config['extra_env'] = ace.config.get('extra_env', None)
     ace.config['extra_args'] = ace.config.get('extra_args', [])  # json doesn't support immutable sequences, use mutable instead
+    ace.config['watchdog_interval'] = ace.config.get('watchdog_interval', 30.0)
+    ace.config['watchdog_timeout'] = ace.config.get('watchdog_timeout', 15.0)
+    ace.config['watchdog_max_latency'] = ace.config.get('watchdog_max_latency', 10.0)
+    ace.config['watchdog_max_failures'] = ace.config.get('watchdog_max_failures', 3)
+    ace.config['detached'] = ace.config.get('detached', False)
+    ace.config['statedir'] = ace.config.get('statedir', 'state')
+    ace.config['log_verbosity'] = ace.config.get('log_verbosity', 'auto')
+    ace.config['reader_budget_lines'] = ace.config.get('reader_budget_lines', 200)
+    ace.config['reader_budget_ms'] = ace.config.get('reader_budget_ms', 10.0)
+    ace.config['stats_interval'] = ace.config.get('stats_interval', 60.0)
+    ace.config['stats_jitter'] = ace.config.get('stats_jitter', 10.0)
+    ace.config['stats_history'] = ace.config.get('stats_history', 360)
     _global_logignores = ace.config['global_logignores'] = ace.config.get('global_logignores', {})
     ace.save_config()
     ace.global_logignores = make_logignores(_global_logignores)
@@ -107,15 +147,17 @@ def load_config(ace: AdminCommandExecutor):
         if servername in ace.servers:
             server: STKServer = ace.servers[servername]
             for item in server_attribs:
-                setattr(server, item, serverdata[item])
+                # only the values that differ from the global ones are saved
+                setattr(server, item, serverdata.get(item, ace.config.get(item, getattr(server, item))))
             local_logignore: dict = server.log_ignores.maps[0]
             assert type(local_logignore) is dict, 'because first mapping must be mutable'
             local_logignore.clear()
             local_logignore.update(make_logignores(serverdata.get('log_ignores', {})))
+            server.log_verbosity = server_services(ace, serverdata)['log_verbosity']
         else:
             ace.servers[servername] = STKServer(
-                ace.logger, ace.ainput.writeln, servername, cfgpath=serverdata['cfgpath'],
-                restarter_cond=ace.server_restart_cond, start_stop_guard=ace.start_stop_guard,
+                ace.logger, ace.writeln, servername, cfgpath=serverdata['cfgpath'],
+                **server_services(ace, serverdata),
                 datapath=serverdata.get('datapath', ace.config['datapath']),
                 executable_path=serverdata.get('executable_path', ace.config['executable_path']),
                 cwd=serverdata.get('cwd', ace.config.get('cwd', os.getcwd())),
@@ -131,6 +173,42 @@ def load_config(ace: AdminCommandExecutor):
             )
 
 
+def server_services(ace: AdminCommandExecutor, serverdata: Optional[Mapping[str, Any]] = None) -> MutableMapping[str, Any]:
+    """
+    Keyword arguments shared by every STKServer that is managed by the wrapper.
+    Settings from serverdata override the defaults from config.json
+    """
+    if serverdata is None:
+        serverdata = {}
+    _log_verbosity = serverdata.get('log_verbosity', ace.config['log_verbosity'])
+    try:
+        _log_verbosity = parse_log_verbosity(_log_verbosity)
+    except ValueError:
+        ace.logger.error(f'log_verbosity {_log_verbosity!r} is not "auto", empty, a number from 0 to 5 '
+                         f'or one of {", ".join(stk_verbosity_names)}, using "auto"')
+        _log_verbosity = 'auto'
+    return {
+        'restarter_cond': ace.server_restart_cond,
+        'start_stop_guard': ace.start_stop_guard,
+        'metrics': ace.metrics,
+        'events': ace.events,
+        'scheduler': ace.scheduler,
+        'watchdog_interval': serverdata.get('watchdog_interval', ace.config['watchdog_interval']),
+        'watchdog_timeout': serverdata.get('watchdog_timeout', ace.config['watchdog_timeout']),
+        'watchdog_max_latency': serverdata.get('watchdog_max_latency', ace.config['watchdog_max_latency']),
+        'watchdog_max_failures': serverdata.get('watchdog_max_failures', ace.config['watchdog_max_failures']),
+        'statedir': (os.path.abspath(ace.config['statedir'])
+                     if serverdata.get('detached', ace.config['detached']) else None),
+        'log_verbosity': _log_verbosity,
+        'reader_budget_lines': serverdata.get('reader_budget_lines', ace.config['reader_budget_lines']),
+        'reader_budget_ms': serverdata.get('reader_budget_ms', ace.config['reader_budget_ms']),
+        'reader_weight': serverdata.get('reader_weight', 1.0),
+        'stats_interval': serverdata.get('stats_interval', ace.config['stats_interval']),
+        'stats_jitter': serverdata.get('stats_jitter', ace.config['stats_jitter']),
+        'stats_history': serverdata.get('stats_history', ace.config['stats_history']),
+    }
+
+
 def make_logignores(logignores: Mapping[str, Mapping[str, Sequence[str]]]) -> MutableMapping[str, MutableMapping[int, MutableSequence[re.Pattern]]]:
     res = dict(
         (modname, dict((int(level), list(re.compile(pattern) for pattern in patterns)) for level, patterns in modignores.items()))
@@ -139,38 +217,1723 @@ def make_logignores(logignores: Mapping[str, Mapping[str, Sequence[str]]]) -> Mu
     return res
 
 
-async def _trigger_restart(ace) -> bool:
+async def _trigger_restart(ace) -> bool:
+    try:
+        async with ace.server_restart_cond:
+            ace.server_restart_cond.notify_all()
+        return True
+    except RuntimeError:
+        return False
+
+
+def server_restart_clk(ace):
+    """
+    This is called every time when the server needs to be restarted
+    But automatic server restart will only happen if no players are online at the moment
+    """
+    ace.task_registry.spawn(_trigger_restart(ace), description='restart trigger', tasks=ace.tasks)
+
+
+class STKLogFilter(logging.Filter):
+    def __init__(self, ace: AdminCommandExecutor, *args, **kwargs):
+        self.ace = ace
+        super().__init__(*args, **kwargs)
+
+    def filter(record: logging.LogRecord):
+        pass
+
+
+class LogLevel(IntEnum):
+    DEBUG = logging.DEBUG
+    INFO = logging.INFO
+    WARNING = logging.WARNING
+    ERROR = logging.ERROR
+    FATAL = logging.FATAL
+
+
+stk_verbosity_names = ('debug', 'verbose', 'info', 'warning', 'error', 'fatal')
+
+
+def stk_log_verbosity(level: int) -> int:
+    """STK --log value that makes the server print the lines of the wrapper log level, verbose lines are handled as DEBUG"""
+    if level <= logging.DEBUG:
+        return 0
+    elif level <= logging.INFO:
+        return 2
+    elif level <= logging.WARNING:
+        return 3
+    elif level <= logging.ERROR:
+        return 4
+    return 5
+
+
+def parse_log_verbosity(value: Union[str, int, None]) -> Union[str, int, None]:
+    """
+    Checks log_verbosity from the config: "auto", None or an empty string, a number from 0 to 5
+    or one of stk_verbosity_names. Raises ValueError otherwise
+    """
+    if value is None or value == '' or value == 'auto':
+        return value
+    if isinstance(value, str) and value.strip().lower() in stk_verbosity_names:
+        return stk_verbosity_names.index(value.strip().lower())
+    if isinstance(value, bool):
+        raise ValueError(f'log_verbosity {value!r} is not a number')
+    level = int(value)
+    if not 0 <= level < len(stk_verbosity_names):
+        raise ValueError(f'log_verbosity {value!r} is not between 0 and {len(stk_verbosity_names) - 1}')
+    return level
+
+
+class MetricsRegistry:
+    """
+    In-memory registry of numeric gauges and counters.
+    Every value is identified by the metric name and its labels,
+    exported in Prometheus text format by stk-metrics or into metrics_textfile
+    """
+    def __init__(self):
+        self.values: MutableMapping[str, MutableMapping[Tuple[Tuple[str, str], ...], float]] = defaultdict(dict)
+        self.kinds: MutableMapping[str, str] = {}
+        self.descriptions: MutableMapping[str, str] = {}
+
+    @staticmethod
+    def _labelkey(labels: Mapping[str, Any]) -> Tuple[Tuple[str, str], ...]:
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def describe(self, name: str, kind: str, description: str = ''):
+        self.kinds[name] = kind
+        self.descriptions[name] = description
+
+    def set(self, name: str, value: float, **labels):
+        self.kinds.setdefault(name, 'gauge')
+        self.values[name][self._labelkey(labels)] = value
+
+    def inc(self, name: str, value: float = 1.0, **labels):
+        self.kinds.setdefault(name, 'counter')
+        _values = self.values[name]
+        _key = self._labelkey(labels)
+        _values[_key] = _values.get(_key, 0.0) + value
+
+    def get(self, name: str, default: Optional[float] = None, **labels) -> Optional[float]:
+        return self.values.get(name, {}).get(self._labelkey(labels), default)
+
+    def remove(self, name: str, **labels):
+        self.values.get(name, {}).pop(self._labelkey(labels), None)
+
+    def export_text(self, prefix: str = '') -> str:
+        lines = []
+        for name in sorted(self.values):
+            if not name.startswith(prefix):
+                continue
+            if name in self.descriptions:
+                lines.append(f'# HELP {name} {self.descriptions[name]}')
+            lines.append(f'# TYPE {name} {self.kinds.get(name, "untyped")}')
+            for labels, value in sorted(self.values[name].items()):
+                _labels = ','.join(f'{key}="{value_}"' for key, value_ in labels)
+                lines.append(f'{name}{{{_labels}}} {value}' if _labels else f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path: str):
+        _tmppath = f'{path}.tmp'
+        with open(_tmppath, 'w') as file:
+            file.write(self.export_text())
+        os.replace(_tmppath, path)
+
+
+async def _metrics_writer(ace: AdminCommandExecutor):
+    if not ace.config['metrics_textfile']:
+        ace.scheduler.remove_job('metrics:textfile')
+        return
+    try:
+        ace.metrics.write_textfile(ace.config['metrics_textfile'])
+    except OSError:
+        ace.logger.exception('Failed to write metrics textfile:')
+
+
+def percentiles(values: Sequence[float], quantiles: Sequence[float] = (0.5, 0.9, 0.99)) -> Tuple[float, ...]:
+    if not values:
+        return tuple(0.0 for _ in quantiles)
+    _sorted = sorted(values)
+    return tuple(_sorted[min(int(len(_sorted) * quantile), len(_sorted) - 1)] for quantile in quantiles)
+
+
+class SeriesTier:
+    """
+    Ring buffer of the averages of fixed time buckets.
+    The bucket number is the time divided by the resolution, its slot is the bucket number modulo the capacity
+    """
+    __slots__ = ('resolution', 'values', 'last_bucket', '_sum', '_count')
+
+    def __init__(self, resolution: int, capacity: int):
+        self.resolution = resolution
+        self.values = array('d', (math.nan, )) * capacity
+        self.last_bucket = -1
+        self._sum = 0.0
+        self._count = 0
+
+    @property
+    def span(self) -> int:
+        return self.resolution * len(self.values)
+
+    def add(self, when: float, value: float):
+        bucket = int(when // self.resolution)
+        if bucket < self.last_bucket:
+            # late sample of a finished bucket
+            return
+        _capacity = len(self.values)
+        if bucket > self.last_bucket:
+            # buckets without samples
+            for _bucket in range(max(self.last_bucket + 1, bucket - _capacity + 1), bucket):
+                self.values[_bucket % _capacity] = math.nan
+            self.last_bucket = bucket
+            self._sum = 0.0
+            self._count = 0
+        self._sum += value
+        self._count += 1
+        self.values[bucket % _capacity] = self._sum / self._count
+
+    def window(self, start: float, end: float) -> MutableSequence[float]:
+        """Averages of the buckets between start and end, NaN for the buckets without samples"""
+        _capacity = len(self.values)
+        _last = int(end // self.resolution)
+        _oldest = self.last_bucket - _capacity
+        return [self.values[bucket % _capacity] if _oldest < bucket <= self.last_bucket else math.nan
+                for bucket in range(max(int(start // self.resolution), _last - _capacity + 1), _last + 1)]
+
+    def state(self) -> MutableMapping[str, Any]:
+        """Copy of the tier with the raw values, cheap enough for the event loop, see encode_state"""
+        return {'resolution': self.resolution, 'capacity': len(self.values), 'last_bucket': self.last_bucket,
+                'sum': self._sum, 'count': self._count, 'values': self.values.tobytes()}
+
+    @staticmethod
+    def encode_state(state: Mapping[str, Any]) -> MutableMapping[str, Any]:
+        return dict(state, values=base64.b64encode(state['values']).decode())
+
+    def to_json(self) -> MutableMapping[str, Any]:
+        return self.encode_state(self.state())
+
+    @classmethod
+    def from_json(cls, data: Mapping[str, Any]) -> 'SeriesTier':
+        tier = cls(data['resolution'], data['capacity'])
+        _values = array('d')
+        _values.frombytes(base64.b64decode(data['values']))
+        if len(_values) != data['capacity']:
+            raise ValueError('snapshot values do not match the capacity')
+        tier.values = _values
+        tier.last_bucket = data['last_bucket']
+        tier._sum = data['sum']
+        tier._count = data['count']
+        return tier
+
+
+class TimeSeries:
+    """Every sample goes into all tiers, so that the coarse tiers are downsampled as the samples arrive"""
+    __slots__ = ('tiers', )
+
+    def __init__(self, tiers: Sequence[SeriesTier]):
+        self.tiers = sorted(tiers, key=lambda tier: tier.resolution)
+
+    def add(self, when: float, value: float):
+        for tier in self.tiers:
+            tier.add(when, value)
+
+    def query(self, start: float, end: float) -> Tuple[int, MutableSequence[float]]:
+        """Returns the resolution and the values of the finest tier that covers the range"""
+        for tier in self.tiers:
+            if end - start <= tier.span:
+                break
+        return tier.resolution, tier.window(start, end)
+
+
+class TimeSeriesStore:
+    """
+    Time series of the numeric samples per (server, metric) with bounded memory:
+    each series is a few ring buffers of fixed size, 1 minute, 10 minutes and 1 hour buckets by default.
+    Samples of the servers are taken every timeseries_interval seconds by sample_servers,
+    extensions can add their own with record(). The store is saved into a snapshot file and loaded on start
+    """
+    default_tiers = ((60, 720), (600, 1008), (3600, 720))
+
+    def __init__(self, logger: logging.Logger, path: Optional[str] = None, tiers: Sequence[Sequence[int]] = default_tiers):
+        self.logger = logger
+        self.path = path
+        self.tiers = tuple(tuple(tier) for tier in tiers)
+        self.series: MutableMapping[Tuple[str, str], TimeSeries] = {}
+        # server name: (time, cpu seconds, lines read) of the previous sample
+        self._previous: MutableMapping[str, Tuple[float, Optional[float], int]] = {}
+
+    def record(self, server: str, metric: str, value: float, when: Optional[float] = None):
+        _series = self.series.get((server, metric))
+        if _series is None:
+            _series = self.series[(server, metric)] = TimeSeries(
+                tuple(SeriesTier(resolution, capacity) for resolution, capacity in self.tiers))
+        _series.add(time.time() if when is None else when, value)
+
+    def metrics(self, server: str) -> MutableSequence[str]:
+        return sorted(metric for _server, metric in self.series if _server == server)
+
+    def query(self, server: str, metric: str, seconds: float, end: Optional[float] = None) -> Optional[Tuple[int, MutableSequence[float]]]:
+        _series = self.series.get((server, metric))
+        if _series is None:
+            return None
+        if end is None:
+            end = time.time()
+        return _series.query(end - seconds, end)
+
+    def sample_servers(self, servers: Mapping[str, 'STKServer']):
+        """Records peers, CPU usage, RSS, stdout line rate, network speeds and the highest ping of the started games"""
+        _now = time.time()
+        for name, server in tuple(servers.items()):
+            self.record(name, 'peers', server.peer_count, _now)
+            _pid = getattr(server.process, 'pid', None)
+            _usage = _process_usage(_pid) if _pid is not None else None
+            _previous = self._previous.get(name)
+            self._previous[name] = (_now, _usage[0] if _usage is not None else None, server.lines_read)
+            if _usage is not None:
+                self.record(name, 'rss_mb', _usage[1] / 1048576, _now)
+            if _previous is None or _now <= _previous[0]:
+                continue
+            _elapsed = _now - _previous[0]
+            if _usage is not None and _previous[1] is not None and _usage[0] >= _previous[1]:
+                self.record(name, 'cpu_percent', (_usage[0] - _previous[1]) / _elapsed * 100, _now)
+            if server.lines_read >= _previous[2]:
+                self.record(name, 'lines_per_s', (server.lines_read - _previous[2]) / _elapsed, _now)
+            for when, upload, download in server.speed_samples:
+                if when > _previous[0]:
+                    self.record(name, 'upload_kbps', upload, when)
+                    self.record(name, 'download_kbps', download, when)
+            for when, ping in server.ping_samples:
+                if when > _previous[0]:
+                    self.record(name, 'ping_max_ms', ping, when)
+        for name in tuple(self._previous):
+            if name not in servers:
+                del self._previous[name]
+
+    def copy(self) -> MutableSequence[Tuple[str, str, Sequence[Mapping[str, Any]]]]:
+        """Copies the tiers of every series, so that they can be serialized outside the event loop"""
+        return [(server, metric, tuple(tier.state() for tier in series.tiers)) for (server, metric), series in self.series.items()]
+
+    def dump(self, copy: Optional[Sequence[Tuple[str, str, Sequence[Mapping[str, Any]]]]] = None) -> str:
+        return json.dumps({'tiers': self.tiers, 'series': [
+            {'server': server, 'metric': metric, 'tiers': [SeriesTier.encode_state(state) for state in states]}
+            for server, metric, states in (self.copy() if copy is None else copy)]})
+
+    def load(self):
+        if self.path is None or not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, 'r') as file:
+                data = json.load(file)
+            if [list(tier) for tier in self.tiers] != data['tiers']:
+                self.logger.warning(f'Time series snapshot "{self.path}" has different tiers, it is not loaded')
+                return
+            for item in data['series']:
+                self.series[(item['server'], item['metric'])] = TimeSeries(tuple(SeriesTier.from_json(tier) for tier in item['tiers']))
+        except (OSError, ValueError, KeyError):
+            self.logger.exception(f'Failed to load time series snapshot "{self.path}"')
+
+    def _write(self, data: str):
+        _tmppath = f'{self.path}.tmp'
+        with open(_tmppath, 'w') as file:
+            file.write(data)
+        os.replace(_tmppath, self.path)
+
+    def save(self, copy: Optional[Sequence[Tuple[str, str, Sequence[Mapping[str, Any]]]]] = None):
+        if self.path is not None:
+            self._write(self.dump(copy))
+
+    async def snapshot(self):
+        """Copies the series on the event loop, then encodes and writes them in a thread"""
+        if self.path is None:
+            return
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.save, self.copy())
+        except OSError:
+            self.logger.exception(f'Failed to write time series snapshot "{self.path}"')
+
+
+sparkline_chars = '▁▂▃▄▅▆▇█'
+
+
+def sparkline(values: Sequence[float], width: int = 60) -> str:
+    """One character per value, averaged down to width characters. Gaps are blank"""
+    if len(values) > width:
+        _step = math.ceil(len(values) / width)
+        _groups = (tuple(value for value in values[i:i + _step] if not math.isnan(value)) for i in range(0, len(values), _step))
+        values = tuple(sum(group) / len(group) if group else math.nan for group in _groups)
+    _known = tuple(value for value in values if not math.isnan(value))
+    if not _known:
+        return ' ' * len(values)
+    _low = min(_known)
+    _range = max(_known) - _low
+    return ''.join(' ' if math.isnan(value) else
+                   sparkline_chars[round((value - _low) / _range * (len(sparkline_chars) - 1)) if _range else 0]
+                   for value in values)
+
+
+def parse_duration(text: str) -> float:
+    """Seconds of 90s, 30m, 6h, 7d or a plain number of seconds"""
+    _units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    if text and text[-1] in _units:
+        return float(text[:-1]) * _units[text[-1]]
+    return float(text)
+
+
+def format_duration(seconds: float) -> str:
+    """30 s, 10 min, 6 h or 7 d, in the largest unit that the duration is a whole number of"""
+    for unit, size in (('d', 86400), ('h', 3600), ('min', 60)):
+        if seconds >= size and seconds % size == 0:
+            return f'{int(seconds // size)} {unit}'
+    return f'{seconds:g} s'
+
+
+async def _timeseries_sampler(ace: AdminCommandExecutor):
+    ace.timeseries.sample_servers(ace.servers)
+
+
+def _reload_wrapper_config(ace: AdminCommandExecutor, path: str):
+    ace.logger.info(f'"{path}" was changed outside the wrapper, reloading')
+    load_config(ace)
+
+
+def _save_wrapper_config(ace: AdminCommandExecutor, save_config: Callable[..., Any], *args, **kwargs):
+    save_config(*args, **kwargs)
+    if ace.file_watcher is not None:
+        ace.file_watcher.note_written(_cfgfile_path)
+
+
+async def _cleanup_watcher(ace: AdminCommandExecutor):
+    if ace.file_watcher is not None:
+        ace.file_watcher.close()
+
+
+async def _cleanup_timeseries(ace: AdminCommandExecutor):
+    if ace.timeseries is None:
+        return
+    try:
+        ace.timeseries.save()
+    except OSError:
+        ace.logger.exception('Failed to write time series snapshot:')
+
+
+class SlowCallback:
+    def __init__(self, duration: float, description: str, stack: Sequence[str]):
+        self.time = time.time()
+        self.duration = duration
+        self.description = description
+        self.stack = stack
+
+
+class LoopLagMonitor:
+    """
+    Measures the event loop lag as the delay of a periodic wakeup. With slow_callback set, also records
+    the callbacks and task steps that block the loop for longer than slow_callback seconds. That replaces
+    asyncio.Handle._run for the whole process, so it is a debugging aid, like loop.slow_callback_duration
+    of the asyncio debug mode, and is off by default
+    """
+    quantiles = (0.5, 0.9, 0.99)
+
+    def __init__(self, logger: logging.Logger, metrics: Optional[MetricsRegistry] = None, interval=0.5, threshold=0.1,
+                 slow_callback=0.0, report_interval=60.0, history=50):
+        self.logger = logger
+        self.metrics = metrics
+        self.interval = interval
+        self.threshold = threshold
+        self.slow_callback = slow_callback
+        self.report_interval = report_interval
+        self.samples = deque(maxlen=max(int(report_interval / interval), 1))
+        self.slow_callbacks = deque(maxlen=history)
+        self.slow_total = 0
+        self.task: Optional[asyncio.Task] = None
+        self._original_run: Optional[Callable] = None
+        if metrics is not None:
+            metrics.describe('stk_loop_lag_seconds', 'gauge', 'Event loop wakeup delay over the last report interval')
+            metrics.describe('stk_loop_slow_callbacks_total', 'counter', 'Callbacks that blocked the event loop for too long')
+
+    def start(self):
+        if self.slow_callback and self._original_run is None:
+            self._install()
+        self.task = asyncio.create_task(self._sampler())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        if self._original_run is not None:
+            asyncio.events.Handle._run = self._original_run
+            self._original_run = None
+
+    def _install(self):
+        monitor = self
+        _original = self._original_run = asyncio.events.Handle._run
+        _perf_counter = time.perf_counter
+
+        def _run(handle: asyncio.Handle):
+            _start = _perf_counter()
+            _original(handle)
+            _duration = _perf_counter() - _start
+            if _duration >= monitor.slow_callback:
+                monitor._record_slow(handle, _duration)
+        asyncio.events.Handle._run = _run
+
+    def _record_slow(self, handle: asyncio.Handle, duration: float):
+        callback = getattr(handle, '_callback', None)
+        owner = getattr(callback, '__self__', None)
+        if isinstance(owner, asyncio.Task):
+            _coro = owner.get_coro()
+            description = f'task {owner.get_name()} running {getattr(_coro, "__qualname__", _coro)}'
+            # where the task is suspended now, right after the slow step
+            stack = tuple(f'{frame.f_code.co_filename}:{frame.f_lineno} in {frame.f_code.co_name}'
+                          for frame in owner.get_stack(limit=8))
+        else:
+            description = f'callback {getattr(callback, "__qualname__", repr(callback))}'
+            stack = ()
+        self.slow_total += 1
+        self.slow_callbacks.append(SlowCallback(duration, description, stack))
+        if self.metrics is not None:
+            self.metrics.inc('stk_loop_slow_callbacks_total')
+
+    def lag_percentiles(self) -> Tuple[float, ...]:
+        return percentiles(self.samples, self.quantiles)
+
+    async def _sampler(self):
+        # loop.time() of uvloop has a millisecond resolution
+        _last_report = time.perf_counter()
+        while True:
+            _start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            _now = time.perf_counter()
+            self.samples.append(max(_now - _start - self.interval, 0.0))
+            if _now - _last_report >= self.report_interval:
+                self.report(_last_report)
+                _last_report = _now
+
+    def report(self, since: float):
+        _percentiles = self.lag_percentiles()
+        _max = max(self.samples, default=0.0)
+        if self.metrics is not None:
+            for quantile, value in zip(self.quantiles, _percentiles):
+                self.metrics.set('stk_loop_lag_seconds', value, quantile=quantile)
+            self.metrics.set('stk_loop_lag_seconds', _max, quantile=1)
+        if _percentiles[-1] < self.threshold:
+            return
+        _since = time.time() - (time.perf_counter() - since)
+        _slow = sorted((slow for slow in self.slow_callbacks if slow.time >= _since), key=lambda slow: slow.duration, reverse=True)
+        self.logger.warning(
+            f'Event loop lag p50 {_percentiles[0] * 1000:.1f} ms, p90 {_percentiles[1] * 1000:.1f} ms, '
+            f'p99 {_percentiles[2] * 1000:.1f} ms, max {_max * 1000:.1f} ms exceeds {self.threshold * 1000:.0f} ms. '
+            f'{len(_slow)} slow callbacks' + ''.join(f'\n  {slow.duration * 1000:.1f} ms {slow.description}' for slow in _slow[:3])
+        )
+
+
+class HandlerStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.errors = 0
+
+
+def _handler_name(handler: Callable) -> str:
+    _func = handler.func if isinstance(handler, partial) else handler
+    return f'{getattr(_func, "__module__", "?")}.{getattr(_func, "__qualname__", repr(_func))}'
+
+
+class TimedHandlerChain(AIOHandlerChain):
+    """
+    AIOHandlerChain that records call count, total and max time and exceptions of every handler.
+    Only the handlers added while the timing is enabled (handler_timing in config.json) are wrapped,
+    otherwise it costs nothing
+    """
+    enabled = False
+    chains: 'weakref.WeakSet[TimedHandlerChain]' = weakref.WeakSet()
+
+    def __init__(self, name: str, server: str = '', *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.name = name
+        self.server = server
+        self.stats: MutableMapping[Callable, HandlerStats] = {}
+        self._wrappers: MutableMapping[Callable, Callable] = {}
+        self.chains.add(self)
+
+    def add_handler(self, handler: Callable, *args, **kwargs):
+        if not self.enabled:
+            return super().add_handler(handler, *args, **kwargs)
+        stats = self.stats[handler] = HandlerStats(_handler_name(handler))
+
+        async def _timed(*hargs, **hkwargs):
+            _start = time.perf_counter()
+            try:
+                _result = handler(*hargs, **hkwargs)
+                if inspect.isawaitable(_result):
+                    _result = await _result
+                return _result
+            except Exception:
+                stats.errors += 1
+                raise
+            finally:
+                _duration = time.perf_counter() - _start
+                stats.calls += 1
+                stats.total += _duration
+                if _duration > stats.max:
+                    stats.max = _duration
+        self._wrappers[handler] = _timed
+        return super().add_handler(_timed, *args, **kwargs)
+
+    def remove_handler(self, handler: Callable, *args, **kwargs):
+        self.stats.pop(handler, None)
+        return super().remove_handler(self._wrappers.pop(handler, handler), *args, **kwargs)
+
+
+class ManagedTask:
+    def __init__(self, task: asyncio.Task, owner: str, description: str):
+        self.task = task
+        self.name = task.get_name()
+        self.owner = owner
+        self.description = description
+        self.started = time.monotonic()
+        self.finished: Optional[float] = None
+        self.outcome = 'running'
+
+    @property
+    def runtime(self) -> float:
+        return (self.finished if self.finished is not None else time.monotonic()) - self.started
+
+
+class TaskRegistry:
+    """
+    Background tasks of the wrapper and the extensions, with their owner and run time.
+    Finished tasks are removed automatically and kept in a bounded history, their exceptions are logged.
+    The task is also put into the given tasks mapping (ace.tasks or ext.tasks) while it runs
+    """
+    def __init__(self, logger: logging.Logger, history=100):
+        self.logger = logger
+        self.running: MutableMapping[str, ManagedTask] = {}
+        self.history = deque(maxlen=history)
+
+    def spawn(self, coro, owner: str = '', description: str = '',
+              tasks: Optional[MutableMapping[str, asyncio.Task]] = None) -> asyncio.Task:
+        _tsk = asyncio.create_task(coro)
+        entry = self.running[_tsk.get_name()] = ManagedTask(_tsk, owner, description or getattr(coro, '__qualname__', repr(coro)))
+        if tasks is not None:
+            tasks[entry.name] = _tsk
+        _tsk.add_done_callback(partial(self._done, entry, tasks))
+        return _tsk
+
+    def _done(self, entry: ManagedTask, tasks: Optional[MutableMapping[str, asyncio.Task]], task: asyncio.Task):
+        self.running.pop(entry.name, None)
+        if tasks is not None and tasks.get(entry.name) is task:
+            del tasks[entry.name]
+        entry.finished = time.monotonic()
+        if task.cancelled():
+            entry.outcome = 'cancelled'
+        elif task.exception() is not None:
+            _exc = task.exception()
+            entry.outcome = f'failed: {type(_exc).__name__}: {_exc}'
+            self.logger.error(f'Task {entry.name} ({entry.description}) of {entry.owner or "the wrapper"} failed:',
+                              exc_info=_exc)
+        else:
+            entry.outcome = 'done'
+        self.history.append(entry)
+
+    def cancel(self, name: str) -> bool:
+        if name not in self.running:
+            return False
+        return self.running[name].task.cancel()
+
+
+class WriteBehindDB:
+    """
+    SQLite database of the extensions, used from a single worker thread.
+    write() only queues the statement, so it is safe to call from the log handlers;
+    the queue is committed in one transaction when batch_size statements are queued or flush_interval seconds pass.
+    While the disk or the database stalls, at most max_queue statements are kept, the newer ones are dropped and counted.
+    query() and transaction() wait in the same thread, call flush() first to see the queued writes
+    """
+    def __init__(self, logger: logging.Logger, path: str, schema: str = '', batch_size=500, flush_interval=2.0,
+                 max_queue=100000, metrics: Optional[MetricsRegistry] = None):
+        self.logger = logger
+        self.path = path
+        self.schema = schema
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.metrics = metrics
+        self.queue: deque = deque()
+        self.written = 0
+        self.batches = 0
+        self.errors = 0
+        self.dropped = 0
+        self._dropping = False
+        if metrics is not None:
+            metrics.describe('stk_db_dropped_writes_total', 'counter', 'Statements dropped because the write queue was full')
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'sqlite:{os.path.basename(path)}')
+        self._connection: Optional[sqlite3.Connection] = None
+        self._pending = asyncio.Event()
+        self._full = asyncio.Event()
+        self._commit_lock = asyncio.Lock()
+        self._writer_task: Optional[asyncio.Task] = None
+
+    def _connect(self):
+        self._connection = sqlite3.connect(self.path)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        if self.schema:
+            self._connection.executescript(self.schema)
+
+    async def _run(self, func: Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def open(self):
+        await self._run(self._connect)
+        self._writer_task = asyncio.create_task(self._writer())
+
+    def write(self, sql: str, params: Sequence[Any] = ()):
+        if self.max_queue and len(self.queue) >= self.max_queue:
+            if not self._dropping:
+                self._dropping = True
+                self.logger.warning(f'Write queue of "{self.path}" is full ({self.max_queue} statements), dropping the new writes')
+            self.dropped += 1
+            if self.metrics is not None:
+                self.metrics.inc('stk_db_dropped_writes_total', db=os.path.basename(self.path))
+            return
+        self.queue.append((sql, params))
+        self._pending.set()
+        if len(self.queue) >= self.batch_size:
+            self._full.set()
+
+    def _execute_batch(self, batch: Sequence[Tuple[str, Sequence[Any]]]):
+        with self._connection:
+            # consecutive statements of the same kind are executed at once
+            for sql, group in groupby(batch, key=lambda statement: statement[0]):
+                self._connection.executemany(sql, (params for _, params in group))
+
+    async def _commit(self):
+        async with self._commit_lock:
+            if not self.queue:
+                return
+            batch = tuple(self.queue)
+            self.queue.clear()
+            self._dropping = False
+            self._pending.clear()
+            self._full.clear()
+            try:
+                await self._run(self._execute_batch, batch)
+                self.written += len(batch)
+                self.batches += 1
+            except sqlite3.Error:
+                self.errors += 1
+                self.logger.exception(f'Failed to write {len(batch)} statements to "{self.path}":')
+
+    async def _writer(self):
+        while True:
+            await self._pending.wait()
+            try:
+                await asyncio.wait_for(self._full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self._commit()
+
+    async def flush(self):
+        await self._commit()
+
+    def _query(self, sql: str, params: Sequence[Any]):
+        return self._connection.execute(sql, params).fetchall()
+
+    async def query(self, sql: str, params: Sequence[Any] = ()) -> MutableSequence[Tuple[Any, ...]]:
+        return await self._run(self._query, sql, params)
+
+    def _transaction(self, func: Callable[[sqlite3.Connection], Any]):
+        with self._connection:
+            return func(self._connection)
+
+    async def transaction(self, func: Callable[[sqlite3.Connection], Any]) -> Any:
+        """Runs func(connection) in the worker thread inside a transaction"""
+        return await self._run(self._transaction, func)
+
+    async def close(self):
+        if self._writer_task is not None:
+            self._writer_task.cancel()
+            self._writer_task = None
+        await self._commit()
+        if self._connection is not None:
+            await self._run(self._connection.close)
+            self._connection = None
+        self._executor.shutdown(wait=False)
+
+
+async def _cleanup_looplag(ace: AdminCommandExecutor):
+    if ace.looplag is not None:
+        ace.looplag.stop()
+
+
+class ScheduleRule(ABC):
+    """
+    Describes when a scheduled job fires.
+    next_after returns the UNIX timestamp of the next run after the given moment, or None if there are no more runs
+    """
+    kind = ''
+
+    @abstractmethod
+    def next_after(self, when: float) -> Optional[float]:
+        ...
+
+    @abstractmethod
+    def to_json(self) -> MutableMapping[str, Any]:
+        ...
+
+    @staticmethod
+    def from_json(data: Mapping[str, Any]) -> 'ScheduleRule':
+        return schedule_rules[data['kind']].from_json(data)
+
+
+class OneShot(ScheduleRule):
+    kind = 'oneshot'
+
+    def __init__(self, at: float):
+        self.at = at
+
+    def next_after(self, when: float) -> Optional[float]:
+        return self.at if self.at > when else None
+
+    def to_json(self):
+        return {'kind': self.kind, 'at': self.at}
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data['at'])
+
+    def __str__(self):
+        return f'once at {datetime.datetime.fromtimestamp(self.at).ctime()}'
+
+
+class Interval(ScheduleRule):
+    kind = 'interval'
+
+    def __init__(self, seconds: float):
+        if seconds <= 0:
+            raise ValueError('interval must be positive')
+        self.seconds = seconds
+
+    def next_after(self, when: float) -> Optional[float]:
+        return when + self.seconds
+
+    def to_json(self):
+        return {'kind': self.kind, 'seconds': self.seconds}
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data['seconds'])
+
+    def __str__(self):
+        return f'every {self.seconds} s'
+
+
+class Cron(ScheduleRule):
+    """
+    Cron-like rule: "minute hour day-of-month month day-of-week"
+    Every field supports *, */n, a-b, a-b/n and comma separated lists. Day of week is 0-6 starting from Sunday (7 is Sunday as well)
+    """
+    kind = 'cron'
+    field_ranges = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expr: str):
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError(f'cron expression must have 5 fields, got "{expr}"')
+        self.expr = expr
+        (self.minutes, self.hours, self.days,
+         self.months, self.weekdays) = (self._parse(field, *limits) for field, limits in zip(fields, self.field_ranges))
+        if 7 in self.weekdays:
+            self.weekdays.add(0)
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    @staticmethod
+    def _parse(field: str, low: int, high: int) -> set:
+        values = set()
+        for item in field.split(','):
+            _range, _, _step = item.partition('/')
+            step = int(_step) if _step else 1
+            if _range == '*':
+                start, end = low, high
+            elif '-' in _range:
+                start, end = (int(value) for value in _range.split('-', 1))
+            else:
+                start = end = int(_range)
+            if start < low or end > high or start > end or step < 1:
+                raise ValueError(f'cron field "{field}" is out of range {low}-{high}')
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, moment: datetime.datetime) -> bool:
+        _day = moment.day in self.days
+        _weekday = (moment.weekday() + 1) % 7 in self.weekdays
+        if self.any_day:
+            return _weekday
+        if self.any_weekday:
+            return _day
+        return _day or _weekday
+
+    def next_after(self, when: float) -> Optional[float]:
+        moment = datetime.datetime.fromtimestamp(when).replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        limit = moment + datetime.timedelta(days=366 * 4)
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + datetime.timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += datetime.timedelta(minutes=1)
+            else:
+                return moment.timestamp()
+        return None
+
+    def to_json(self):
+        return {'kind': self.kind, 'expr': self.expr}
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data['expr'])
+
+    def __str__(self):
+        return f'cron "{self.expr}"'
+
+
+schedule_rules = {rule.kind: rule for rule in (OneShot, Interval, Cron)}
+
+
+class ScheduledJob:
+    def __init__(self, job_id: str, callback: Callable[[], Any], rule: ScheduleRule,
+                 jitter: float = 0.0, persist=True, catch_up=True, owner: str = ''):
+        self.id = job_id
+        self.callback = callback
+        self.rule = rule
+        self.jitter = jitter
+        self.persist = persist
+        self.catch_up = catch_up
+        self.owner = owner
+        self.next_run: Optional[float] = None
+        self.last_run: Optional[float] = None
+        self.last_duration: Optional[float] = None
+        self.max_duration = 0.0
+        self.runs = 0
+        self.failures = 0
+        self.task: Optional[asyncio.Task] = None
+
+    def state(self) -> MutableMapping[str, Any]:
+        return {'rule': self.rule.to_json(), 'next_run': self.next_run, 'last_run': self.last_run,
+                'last_duration': self.last_duration, 'runs': self.runs, 'owner': self.owner}
+
+
+class Scheduler:
+    """
+    Runs the jobs of the wrapper and its extensions from a single task.
+    Jobs are kept in a heap ordered by the next run time, their schedules are saved into statepath
+    so that they resume after the wrapper restart.
+    """
+    def __init__(self, logger: logging.Logger, statepath: Optional[str] = None, jitter: float = 0.0):
+        self.logger = logger
+        self.statepath = statepath
+        self.jitter = jitter
+        self.jobs: MutableMapping[str, ScheduledJob] = {}
+        self.persisted: MutableMapping[str, MutableMapping[str, Any]] = {}
+        self._heap = []
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self._dirty = False
+        self.closed = False
+        self.task: Optional[asyncio.Task] = None
+        self.load_state()
+
+    def load_state(self):
+        if self.statepath is None or not os.path.isfile(self.statepath):
+            return
+        try:
+            with open(self.statepath, 'r') as file:
+                self.persisted = json.load(file)
+        except (OSError, ValueError):
+            self.logger.exception(f'Scheduler: failed to load "{self.statepath}", schedules are not resumed')
+
+    def save_state(self):
+        self._dirty = False
+        if self.statepath is None:
+            return
+        _tmppath = f'{self.statepath}.tmp'
+        try:
+            with open(_tmppath, 'w') as file:
+                json.dump(self.persisted, file, indent=1)
+            os.replace(_tmppath, self.statepath)
+        except OSError:
+            self.logger.exception(f'Scheduler: failed to save "{self.statepath}"')
+
+    def _jittered(self, job: ScheduledJob, when: Optional[float]) -> Optional[float]:
+        if when is None or not job.jitter or isinstance(job.rule, OneShot):
+            return when
+        return when + random.uniform(0, job.jitter)
+
+    def _push(self, job: ScheduledJob):
+        if job.persist:
+            self.persisted[job.id] = job.state()
+            self._dirty = True
+        if job.next_run is None:
+            return
+        self._seq += 1
+        heapq.heappush(self._heap, (job.next_run, self._seq, job))
+        self._wakeup.set()
+
+    def add_job(self, job_id: str, callback: Callable[[], Any], rule: ScheduleRule, jitter: Optional[float] = None,
+                persist=True, catch_up=True, resume=True, owner: str = '') -> ScheduledJob:
+        """
+        Registers the job, replacing the job with the same id.
+        When resume is True and the saved schedule has the same rule, the saved next run time is used.
+        Overdue saved runs fire immediately if catch_up is True, otherwise the next run is calculated from now.
+        """
+        if job_id in self.jobs:
+            self.remove_job(job_id, forget=False)
+        job = ScheduledJob(job_id, callback, rule, self.jitter if jitter is None else jitter, persist, catch_up, owner)
+        _now = time.time()
+        _saved = self.persisted.get(job_id)
+        if resume and persist and _saved is not None and _saved['rule'] == rule.to_json():
+            job.last_run = _saved.get('last_run')
+            job.last_duration = _saved.get('last_duration')
+            job.runs = _saved.get('runs', 0)
+            job.next_run = _saved.get('next_run')
+            if job.next_run is not None and job.next_run < _now and not catch_up:
+                job.next_run = self._jittered(job, rule.next_after(_now))
+        else:
+            job.next_run = self._jittered(job, rule.next_after(_now))
+        self.jobs[job_id] = job
+        self._push(job)
+        return job
+
+    def remove_job(self, job_id: str, forget=True) -> Optional[ScheduledJob]:
+        """Unregisters the job. Its saved schedule is forgotten unless the scheduler is closed or forget is False"""
+        job = self.jobs.pop(job_id, None)
+        if forget and not self.closed and self.persisted.pop(job_id, None) is not None:
+            self._dirty = True
+            self._wakeup.set()
+        return job
+
+    def reschedule(self, job_id: str, rule: ScheduleRule):
+        job = self.jobs[job_id]
+        self.add_job(job_id, job.callback, rule, job.jitter, job.persist, job.catch_up, resume=False, owner=job.owner)
+
+    def start(self) -> asyncio.Task:
+        self.task = asyncio.create_task(self._run_loop())
+        return self.task
+
+    def stop(self):
+        """Stops dispatching jobs and saves their schedules as is"""
+        if self.closed:
+            return
+        self.closed = True
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+        self.save_state()
+
+    async def _run_job(self, job: ScheduledJob, scheduled: float):
+        _start = time.monotonic()
+        job.last_run = time.time()
+        job.runs += 1
+        if job.last_run - scheduled > 1.0:
+            self.logger.debug(f'Scheduler: job {job.id} runs {job.last_run - scheduled:.1f} seconds late')
+        try:
+            _res = job.callback()
+            if asyncio.iscoroutine(_res):
+                await _res
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            job.failures += 1
+            self.logger.exception(f'Scheduler: job {job.id} failed:')
+        finally:
+            job.last_duration = time.monotonic() - _start
+            job.max_duration = max(job.max_duration, job.last_duration)
+            if job.persist and self.jobs.get(job.id) is job:
+                self.persisted[job.id] = job.state()
+                self._dirty = True
+                self._wakeup.set()
+
+    async def _run_loop(self):
+        while True:
+            self._wakeup.clear()
+            if self._dirty:
+                self.save_state()
+            _now = time.time()
+            while self._heap:
+                when, _, job = self._heap[0]
+                if self.jobs.get(job.id) is not job or job.next_run != when:
+                    # stale entry of a removed or rescheduled job
+                    heapq.heappop(self._heap)
+                    continue
+                if when > _now:
+                    break
+                heapq.heappop(self._heap)
+                if job.task is not None and not job.task.done():
+                    self.logger.warning(f'Scheduler: job {job.id} is still running, skipping the run')
+                else:
+                    job.task = asyncio.create_task(self._run_job(job, when))
+                job.next_run = self._jittered(job, job.rule.next_after(max(_now, when)))
+                if job.next_run is None:
+                    self.jobs.pop(job.id, None)
+                    if job.persist:
+                        self.persisted.pop(job.id, None)
+                        self._dirty = True
+                else:
+                    self._push(job)
+            if self._dirty:
+                self.save_state()
+            _timeout = self._heap[0][0] - time.time() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), _timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+class EventSubscriber:
+    """
+    Bounded queue of the events for one client, filtered by the server names and the event types (empty means all).
+    With the "sample" policy only every sample_every-th event is kept once the queue is half full,
+    and the events are dropped when it is full. With the "drop" policy a full queue closes the subscriber
+    """
+    def __init__(self, bus: 'EventBus', servers: Set[str], types: Set[str], peer: str = ''):
+        self.bus = bus
+        self.servers = servers
+        self.types = types
+        self.peer = peer
+        self.queue: asyncio.Queue = asyncio.Queue(bus.queue_size)
+        self.delivered = 0
+        # dropped since the last notice to the client, and the total
+        self.dropped = 0
+        self.dropped_total = 0
+        self.closed = False
+        self._offered = 0
+
+    def wants(self, server: str, type_: str) -> bool:
+        return (not self.servers or server in self.servers) and (not self.types or type_ in self.types)
+
+    def offer(self, event: Mapping[str, Any]):
+        if self.closed:
+            return
+        _size = self.queue.qsize()
+        if _size >= self.bus.queue_size:
+            if self.bus.slow_policy == 'drop':
+                self.bus.logger.warning(f'EventBus: subscriber {self.peer} is too slow, disconnecting')
+                self.close()
+                return
+            self._drop()
+            return
+        if _size >= self.bus.queue_size // 2 and self.bus.slow_policy == 'sample':
+            self._offered += 1
+            if self._offered % self.bus.sample_every:
+                self._drop()
+                return
+        else:
+            self._offered = 0
+        self.queue.put_nowait(event)
+
+    def _drop(self):
+        self.dropped += 1
+        self.dropped_total += 1
+        if self.bus.metrics is not None:
+            self.bus.metrics.inc('stk_events_dropped_total')
+
+    def close(self):
+        """Makes the client stop after the events that are already queued"""
+        if self.closed:
+            return
+        self.closed = True
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+
+class EventBus:
+    """
+    Structured events of the servers and the extensions for the local subscribers, see EventStreamServer.
+    publish() never waits and costs nothing without subscribers, slow subscribers lose the events instead
+    """
+    slow_policies = ('sample', 'drop')
+
+    def __init__(self, logger: logging.Logger, queue_size: int = 256, slow_policy: str = 'sample', sample_every: int = 10,
+                 metrics: Optional[MetricsRegistry] = None):
+        self.logger = logger
+        self.queue_size = max(queue_size, 2)
+        self.slow_policy = slow_policy if slow_policy in self.slow_policies else 'sample'
+        self.sample_every = max(sample_every, 1)
+        self.metrics = metrics
+        self.subscribers: Set[EventSubscriber] = set()
+        self.published = 0
+
+    def subscribe(self, servers: Sequence[str] = (), types: Sequence[str] = (), peer: str = '') -> EventSubscriber:
+        subscriber = EventSubscriber(self, set(servers), set(types), peer)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: EventSubscriber):
+        self.subscribers.discard(subscriber)
+        subscriber.close()
+
+    def publish(self, type_: str, server: str = '', **data):
+        if not self.subscribers:
+            return
+        self.published += 1
+        _event = None
+        for subscriber in self.subscribers:
+            if not subscriber.wants(server, type_):
+                continue
+            if _event is None:
+                _event = {'id': self.published, 'type': type_, 'server': server, 'time': time.time(), 'data': data}
+            subscriber.offer(_event)
+
+
+class FileWatcher:
+    """
+    Calls the callbacks of a file some time after it has changed, when no more changes follow.
+    Uses inotify on the parent directories, so that files replaced with rename are noticed too,
+    or one task that polls the modification times of all files when inotify isn't available.
+    Callbacks run only if the content has changed, writes of the wrapper itself that happen
+    inside a callback or are reported with note_written don't trigger it again
+    """
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_DELETE = 0x200
+    IN_IGNORED = 0x8000
+    IN_NONBLOCK = os.O_NONBLOCK
+    IN_CLOEXEC = os.O_CLOEXEC
+    event_header = struct.Struct('iIII')
+    watch_mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+
+    def __init__(self, logger: logging.Logger, mode: str = 'auto', debounce: float = 1.0, poll_interval: float = 2.0):
+        self.logger = logger
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        # path: [(callback, owner)]
+        self.callbacks: MutableMapping[str, MutableSequence[Tuple[Callable[[str], Any], str]]] = defaultdict(list)
+        # path: digest of the content that the callbacks have seen
+        self.digests: MutableMapping[str, Optional[bytes]] = {}
+        self._timers: MutableMapping[str, asyncio.TimerHandle] = {}
+        self._running: MutableMapping[str, asyncio.Task] = {}
+        self._fd: Optional[int] = None
+        self._libc = None
+        # directory: watch descriptor and back
+        self._wds: MutableMapping[str, int] = {}
+        self._dirs: MutableMapping[int, str] = {}
+        self._poll_task: Optional[asyncio.Task] = None
+        self._stats: MutableMapping[str, Optional[Tuple[int, int, int]]] = {}
+        self.mode = self._start_inotify() if mode in ('auto', 'inotify') else 'poll'
+        if mode == 'inotify' and self.mode != 'inotify':
+            self.logger.warning('FileWatcher: inotify is not available, polling the files instead')
+
+    def _start_inotify(self) -> str:
+        try:
+            self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            _fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return 'poll'
+        if _fd < 0:
+            return 'poll'
+        self._fd = _fd
+        asyncio.get_running_loop().add_reader(_fd, self._read_events)
+        return 'inotify'
+
+    @staticmethod
+    def _digest(path: str) -> Optional[bytes]:
+        try:
+            with open(path, 'rb') as file:
+                return hashlib.blake2b(file.read(), digest_size=16).digest()
+        except OSError:
+            return None
+
+    @staticmethod
+    def _stat(path: str) -> Optional[Tuple[int, int, int]]:
+        try:
+            _stat = os.stat(path)
+        except OSError:
+            return None
+        return _stat.st_mtime_ns, _stat.st_size, _stat.st_ino
+
+    def watch(self, path: str, callback: Callable[[str], Any], owner: str = ''):
+        path = os.path.abspath(path)
+        if path not in self.callbacks:
+            self.digests[path] = self._digest(path)
+            if self.mode == 'inotify':
+                self._add_dir(os.path.dirname(path))
+            else:
+                self._stats[path] = self._stat(path)
+                if self._poll_task is None:
+                    self._poll_task = asyncio.create_task(self._poller())
+        self.callbacks[path].append((callback, owner))
+
+    def unwatch(self, path: str, callback: Optional[Callable[[str], Any]] = None):
+        """Removes the callback of the file, or all of them"""
+        path = os.path.abspath(path)
+        _callbacks = self.callbacks.get(path)
+        if _callbacks is None:
+            return
+        _callbacks[:] = [entry for entry in _callbacks if callback is not None and entry[0] != callback]
+        if not _callbacks:
+            self._forget(path)
+
+    def unwatch_owner(self, owner: str):
+        for path, _callbacks in tuple(self.callbacks.items()):
+            _callbacks[:] = [entry for entry in _callbacks if entry[1] != owner]
+            if not _callbacks:
+                self._forget(path)
+
+    def note_written(self, path: str):
+        """Remembers the content that the wrapper has written itself, so that it isn't handled as a change"""
+        path = os.path.abspath(path)
+        if path in self.digests:
+            self.digests[path] = self._digest(path)
+        if path in self._stats:
+            self._stats[path] = self._stat(path)
+
+    def _forget(self, path: str):
+        del self.callbacks[path]
+        self.digests.pop(path, None)
+        self._stats.pop(path, None)
+        _timer = self._timers.pop(path, None)
+        if _timer is not None:
+            _timer.cancel()
+        _dir = os.path.dirname(path)
+        if _dir in self._wds and not any(os.path.dirname(_path) == _dir for _path in self.callbacks):
+            self._libc.inotify_rm_watch(self._fd, self._wds.pop(_dir))
+
+    def _add_dir(self, directory: str):
+        if directory in self._wds:
+            return
+        _wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), self.watch_mask)
+        if _wd < 0:
+            _errno = ctypes.get_errno()
+            self.logger.warning(f'FileWatcher: cannot watch "{directory}": {os.strerror(_errno)}')
+            return
+        self._wds[directory] = _wd
+        self._dirs[_wd] = directory
+
+    def _read_events(self):
+        try:
+            _data = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return
+        _offset = 0
+        while _offset + self.event_header.size <= len(_data):
+            _wd, _mask, _, _length = self.event_header.unpack_from(_data, _offset)
+            _offset += self.event_header.size
+            _name = os.fsdecode(_data[_offset:_offset + _length].rstrip(b'\0'))
+            _offset += _length
+            _dir = self._dirs.get(_wd)
+            if _dir is None:
+                continue
+            if _mask & self.IN_IGNORED:
+                # the directory is gone
+                del self._dirs[_wd]
+                self._wds.pop(_dir, None)
+                continue
+            _path = os.path.join(_dir, _name)
+            if _path in self.callbacks:
+                self._changed(_path)
+
+    async def _poller(self):
+        while self.callbacks:
+            await asyncio.sleep(self.poll_interval)
+            for path in tuple(self._stats):
+                _stat = self._stat(path)
+                if _stat != self._stats[path]:
+                    self._stats[path] = _stat
+                    self._changed(path)
+        self._poll_task = None
+
+    def _changed(self, path: str):
+        """Restarts the debounce timer of the file"""
+        _timer = self._timers.get(path)
+        if _timer is not None:
+            _timer.cancel()
+        self._timers[path] = asyncio.get_running_loop().call_later(self.debounce, self._fire, path)
+
+    def _fire(self, path: str):
+        self._timers.pop(path, None)
+        if path in self._running and not self._running[path].done():
+            # the callbacks are still handling the previous change, check again later
+            self._changed(path)
+            return
+        _digest = self._digest(path)
+        if _digest == self.digests.get(path):
+            return
+        self.digests[path] = _digest
+        self._running[path] = asyncio.create_task(self._run_callbacks(path))
+
+    async def _run_callbacks(self, path: str):
+        self.logger.info(f'FileWatcher: "{path}" has changed')
+        for callback, owner in tuple(self.callbacks.get(path, ())):
+            try:
+                _res = callback(path)
+                if asyncio.iscoroutine(_res):
+                    await _res
+            except Exception:
+                self.logger.exception(f'FileWatcher: callback of {owner or "wrapper"} for "{path}" failed:')
+        if path in self.digests:
+            # the callbacks may have rewritten the file, that is not a change to handle
+            self.digests[path] = self._digest(path)
+        self._running.pop(path, None)
+
+    def close(self):
+        for _timer in self._timers.values():
+            _timer.cancel()
+        self._timers.clear()
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+        if self._fd is not None:
+            asyncio.get_running_loop().remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
+
+
+def pidfd_supported() -> bool:
+    if not hasattr(os, 'pidfd_open'):
+        return False
+    try:
+        _fd = os.pidfd_open(os.getpid())
+    except OSError:
+        return False
+    os.close(_fd)
+    return True
+
+
+def event_loop_factory(name: str) -> Tuple[Optional[Callable[[], asyncio.AbstractEventLoop]], str]:
+    """
+    Returns the event loop factory and the name of the loop to run the wrapper on.
+    "uvloop" and "auto" use uvloop when it is installed, otherwise the asyncio loop is used
+    """
+    if name not in ('uvloop', 'auto'):
+        return None, 'asyncio'
     try:
-        async with ace.server_restart_cond:
-            ace.server_restart_cond.notify_all()
-        return True
-    except RuntimeError:
-        return False
+        import uvloop
+    except ImportError:
+        if name == 'uvloop':
+            print('uvloop is not installed, falling back to the asyncio event loop')
+        return None, 'asyncio'
+    return uvloop.new_event_loop, 'uvloop'
 
 
-def server_restart_clk(ace):
+def run(coro, event_loop: str = 'asyncio'):
+    _factory, _ = event_loop_factory(event_loop)
+    if hasattr(asyncio, 'Runner'):
+        with asyncio.Runner(loop_factory=_factory) as runner:
+            return runner.run(coro)
+    if _factory is not None:
+        # Python < 3.11
+        asyncio.set_event_loop_policy(sys.modules['uvloop'].EventLoopPolicy())
+    return asyncio.run(coro)
+
+
+def install_child_watcher(kind: str, logger: logging.Logger) -> str:
     """
-    This is called every time when the server needs to be restarted
-    But automatic server restart will only happen if no players are online at the moment
+    Selects how the exits of STK processes are detected, returns the name of the watcher in use.
+    "pidfd" waits for every process with a pidfd polled by the event loop (Linux 5.3+),
+    instead of a waitpid thread per process like the default watcher of Python < 3.12 does.
+    "auto" picks pidfd when it is supported, "threaded" and "default" keep the thread per process
     """
-    asyncio.create_task(_trigger_restart(ace))
+    if type(asyncio.get_running_loop()).__module__.startswith('uvloop'):
+        # uvloop watches its processes by itself
+        return 'uvloop'
+    if kind == 'default' or sys.platform != 'linux':
+        return 'default'
+    if not hasattr(asyncio, 'set_child_watcher'):
+        # Python 3.14+ doesn't have child watchers and always prefers pidfd
+        return 'pidfd' if pidfd_supported() else 'default'
+    if kind in ('pidfd', 'auto') and not pidfd_supported():
+        if kind == 'pidfd':
+            logger.warning('pidfd is not supported by this system, falling back to the default child watcher')
+        return 'default'
+    if kind == 'threaded':
+        _watcher = asyncio.ThreadedChildWatcher()
+    elif sys.version_info >= (3, 12):
+        # asyncio already uses pidfd when it is supported
+        return 'pidfd'
+    else:
+        _watcher = asyncio.PidfdChildWatcher()
+    with warnings.catch_warnings():
+        # child watchers are deprecated since Python 3.12
+        warnings.simplefilter('ignore', DeprecationWarning)
+        asyncio.set_child_watcher(_watcher)
+    # set_child_watcher only attaches the watcher when the main thread has a loop set
+    _watcher.attach_loop(asyncio.get_running_loop())
+    return kind if kind != 'auto' else 'pidfd'
 
 
-class STKLogFilter(logging.Filter):
-    def __init__(self, ace: AdminCommandExecutor, *args, **kwargs):
-        self.ace = ace
-        super().__init__(*args, **kwargs)
+def _process_usage(pid: int) -> Optional[Tuple[float, int]]:
+    """CPU time in seconds and resident memory in bytes of the process"""
+    try:
+        with open(f'/proc/{pid}/stat', 'r') as file:
+            _fields = file.read().rpartition(')')[2].split()
+        return (int(_fields[11]) + int(_fields[12])) / os.sysconf('SC_CLK_TCK'), int(_fields[21]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, IndexError, ValueError):
+        return None
 
-    def filter(record: logging.LogRecord):
-        pass
 
+def _process_starttime(pid: int) -> Optional[str]:
+    """Start time of the process in clock ticks since boot, tells apart the processes that reused a pid"""
+    try:
+        with open(f'/proc/{pid}/stat', 'r') as file:
+            return file.read().rpartition(')')[2].split()[19]
+    except (OSError, IndexError):
+        return None
 
-class LogLevel(IntEnum):
-    DEBUG = logging.DEBUG
-    INFO = logging.INFO
-    WARNING = logging.WARNING
-    ERROR = logging.ERROR
-    FATAL = logging.FATAL
+
+class LineReaderProtocol(asyncio.StreamReaderProtocol):
+    """
+    Feeds the reader whole lines only, the incomplete last line is kept in tail until its end arrives.
+    With keep_tail set, the tail is not fed at the EOF, so that the next reader can continue the line
+    """
+    max_tail = 65536
+
+    def __init__(self, reader: asyncio.StreamReader, tail: bytes = b''):
+        super().__init__(reader)
+        self.tail = bytearray(tail)
+        self.keep_tail = False
+
+    def data_received(self, data: bytes):
+        self.tail += data
+        _end = self.tail.rfind(b'\n') + 1
+        if not _end and len(self.tail) < self.max_tail:
+            return
+        if not _end:
+            # no line end in sight, let the reader deal with the long line
+            _end = len(self.tail)
+        super().data_received(bytes(self.tail[:_end]))
+        del self.tail[:_end]
+
+    def _feed_tail(self):
+        if self.tail and not self.keep_tail:
+            super().data_received(bytes(self.tail))
+            self.tail.clear()
+
+    def eof_received(self):
+        self._feed_tail()
+        return super().eof_received()
+
+    def connection_lost(self, exc: Optional[Exception]):
+        self._feed_tail()
+        super().connection_lost(exc)
+
+
+class DetachedProcess:
+    """
+    STK process that survives the wrapper exit. Its stdin, stdout and stderr are FIFOs in the state directory,
+    the process keeps both ends of every FIFO open, so it never gets EOF or SIGPIPE while no wrapper is attached,
+    and the output written meanwhile stays in the pipe buffer until the wrapper attaches again.
+    Provides the part of asyncio.subprocess.Process interface used by STKServer
+    """
+    fifo_names = ('stdin', 'stdout', 'stderr')
+    pidfile_name = 'stk.pid'
+    statefile_name = 'state.json'
+    pipe_size = 1048576
+    poll_interval = 1.0
+
+    def __init__(self, pid: int, statedir: str, popen: Optional[subprocess.Popen] = None):
+        self.pid = pid
+        self.statedir = statedir
+        self.returncode: Optional[int] = None
+        self.stdin: Optional[asyncio.StreamWriter] = None
+        self.stdout: Optional[asyncio.StreamReader] = None
+        self.stderr: Optional[asyncio.StreamReader] = None
+        # only set when the process is a child of this wrapper, so that its exit status is available
+        self._popen = popen
+        self._transports = []
+        self._protocols: MutableMapping[str, LineReaderProtocol] = {}
+        self._pidfd: Optional[int] = None
+        self._poll_task: Optional[asyncio.Task] = None
+        self._exited: Optional[asyncio.Future] = None
+        # the stdout pipe was full when attaching: STK was blocked writing its log
+        self.output_stalled = False
+
+    @classmethod
+    def paths(cls, statedir: str) -> Tuple[str, ...]:
+        return tuple(os.path.join(statedir, name) for name in cls.fifo_names)
+
+    @classmethod
+    async def spawn(cls, statedir: str, args: Sequence[str], env: Mapping[str, str], cwd: str) -> 'DetachedProcess':
+        os.makedirs(statedir, exist_ok=True)
+        _paths = cls.paths(statedir)
+        for path in _paths:
+            if os.path.lexists(path):
+                os.remove(path)
+            os.mkfifo(path, 0o600)
+        # O_RDWR doesn't block on a FIFO and keeps it open for both reading and writing in the child
+        _fds = tuple(os.open(path, os.O_RDWR) for path in _paths)
+        try:
+            for _fd in _fds:
+                try:
+                    fcntl.fcntl(_fd, getattr(fcntl, 'F_SETPIPE_SZ', 1031), cls.pipe_size)
+                except OSError:
+                    # limited by /proc/sys/fs/pipe-max-size
+                    pass
+            # a new session keeps the process away from the signals sent to the terminal of the wrapper
+            _popen = subprocess.Popen(args, stdin=_fds[0], stdout=_fds[1], stderr=_fds[2],
+                                      env=env, cwd=cwd, start_new_session=True)
+        finally:
+            for _fd in _fds:
+                os.close(_fd)
+        self = cls(_popen.pid, statedir, _popen)
+        with open(os.path.join(statedir, cls.pidfile_name), 'w') as file:
+            file.write(f'{self.pid}\n')
+        self.save_state({})
+        await self._connect()
+        return self
+
+    @classmethod
+    async def attach(cls, statedir: str) -> Optional['DetachedProcess']:
+        """Connects to the process that was launched by the previous wrapper, returns None if it is not running anymore"""
+        _pidfile = os.path.join(statedir, cls.pidfile_name)
+        try:
+            with open(_pidfile, 'r') as file:
+                pid = int(file.read().strip())
+            state = cls.load_state(statedir)
+        except (OSError, ValueError):
+            return None
+        _starttime = _process_starttime(pid)
+        if _starttime is None or _starttime != state.get('starttime') or \
+                not all(os.path.exists(path) and stat.S_ISFIFO(os.stat(path).st_mode) for path in cls.paths(statedir)):
+            # the process has exited, or its pid is used by another process now
+            cls.remove_state(statedir)
+            return None
+        self = cls(pid, statedir)
+        await self._connect(state.get('tails', {}))
+        return self
+
+    @classmethod
+    def load_state(cls, statedir: str) -> MutableMapping[str, Any]:
+        with open(os.path.join(statedir, cls.statefile_name), 'r') as file:
+            return json.load(file)
+
+    def save_state(self, state: Mapping[str, Any]):
+        _path = os.path.join(self.statedir, self.statefile_name)
+        with open(f'{_path}.tmp', 'w') as file:
+            json.dump(dict(state, pid=self.pid, starttime=_process_starttime(self.pid)), file)
+        os.replace(f'{_path}.tmp', _path)
+
+    @classmethod
+    def remove_state(cls, statedir: str):
+        for name in (cls.pidfile_name, cls.statefile_name, *cls.fifo_names):
+            try:
+                os.remove(os.path.join(statedir, name))
+            except FileNotFoundError:
+                pass
+
+    async def _connect(self, tails: Optional[Mapping[str, str]] = None):
+        """Connects to the FIFOs. tails are the incomplete lines that the previous wrapper has read, see close_output"""
+        _loop = asyncio.get_running_loop()
+        _stdin, _stdout, _stderr = self.paths(self.statedir)
+        self._exited = _loop.create_future()
+        # doesn't fail with ENXIO, because the process holds the reading end
+        _transport, _protocol = await _loop.connect_write_pipe(
+            asyncio.streams.FlowControlMixin, os.fdopen(os.open(_stdin, os.O_WRONLY | os.O_NONBLOCK), 'wb', buffering=0)
+        )
+        self._transports.append(_transport)
+        self.stdin = asyncio.StreamWriter(_transport, _protocol, None, _loop)
+        for attr, path in (('stdout', _stdout), ('stderr', _stderr)):
+            _reader = asyncio.StreamReader()
+            # the beginning of the line, the rest is still in the pipe
+            _tail = base64.b64decode(tails[attr]) if tails and attr in tails else b''
+            _fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+            if attr == 'stdout':
+                self.output_stalled = self._pipe_full(_fd)
+            _transport, _protocol = await _loop.connect_read_pipe(
+                partial(LineReaderProtocol, _reader, _tail), os.fdopen(_fd, 'rb', buffering=0)
+            )
+            self._transports.append(_transport)
+            self._protocols[attr] = _protocol
+            setattr(self, attr, _reader)
+        try:
+            self._pidfd = os.pidfd_open(self.pid)
+            _loop.add_reader(self._pidfd, self._on_exit)
+        except (AttributeError, OSError):
+            self._pidfd = None
+            self._poll_task = asyncio.create_task(self._poll_exit())
+
+    @staticmethod
+    def _pipe_full(fd: int) -> bool:
+        try:
+            _size = fcntl.fcntl(fd, getattr(fcntl, 'F_GETPIPE_SZ', 1032))
+            _pending = struct.unpack('i', fcntl.ioctl(fd, termios.FIONREAD, b'\0\0\0\0'))[0]
+        except OSError:
+            return False
+        # a write of a whole line doesn't fit anymore
+        return _pending >= _size - 4096
+
+    async def _poll_exit(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            if self._popen is not None:
+                if self._popen.poll() is not None:
+                    break
+            elif _process_starttime(self.pid) is None:
+                break
+        self._on_exit()
+
+    def _stop_watching(self):
+        if self._pidfd is not None:
+            asyncio.get_running_loop().remove_reader(self._pidfd)
+            os.close(self._pidfd)
+            self._pidfd = None
+        if self._poll_task is not None and self._poll_task is not asyncio.current_task():
+            self._poll_task.cancel()
+        self._poll_task = None
+
+    def _on_exit(self):
+        self._stop_watching()
+        if self._popen is not None:
+            self.returncode = self._popen.wait()
+        else:
+            # the exit status of a process started by another wrapper is not available
+            self.returncode = 255
+        self.remove_state(self.statedir)
+        if not self._exited.done():
+            self._exited.set_result(self.returncode)
+
+    async def wait(self) -> int:
+        return await asyncio.shield(self._exited)
+
+    def send_signal(self, sig: int):
+        if self.returncode is None:
+            os.kill(self.pid, sig)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+    def close_output(self) -> MutableMapping[str, str]:
+        """
+        Stops reading stdout and stderr, the output that isn't read yet stays in the FIFOs for the next wrapper,
+        and the lines that are already read can still be handled until the EOF.
+        Returns the incomplete last lines, base64 encoded for the state file
+        """
+        tails = {}
+        for attr, _protocol in self._protocols.items():
+            # a line cut in half would be handled as two broken lines
+            _protocol.keep_tail = True
+            if _protocol.tail:
+                tails[attr] = base64.b64encode(bytes(_protocol.tail)).decode()
+        # the protocols feed EOF to the readers when the transports are closed
+        for _transport in self._transports[1:]:
+            _transport.close()
+        return tails
+
+    def detach(self):
+        """Disconnects from the process, leaving it running"""
+        self._stop_watching()
+        for _transport in self._transports:
+            _transport.close()
+        self._transports.clear()
+        if self._exited is not None and not self._exited.done():
+            self._exited.cancel()
 
 
 class STKServer:
@@ -181,13 +1944,25 @@ class STKServer:
     ready_objectname = 'ServerLobby'
     ready_pattern = re.compile(r'Server (\d+) is now online.')
     joinleave_objectname = 'STKHost'
-    joinleave_pattern = re.compile(r'[a-f0-9.:]+ has just (?:dis)?connected. There are now (\d+) peers.')
+    joinleave_pattern = re.compile(r'([a-f0-9.:]+) has just (dis)?connected. There are now (\d+) peers.')
     extra_leave_patterns = [
         ('STKHost', logging.INFO, re.compile(r'[a-f0-9.:]+ has not been validated for more than [0-9.]+ seconds, disconnect it by force.')),
         ('STKHost', logging.INFO, re.compile(r'[a-f0-9.:]+ \S+ with ping \d+ is higher than \d+ ms when not in game, kick.')),
         ('ServerLobby', logging.INFO, re.compile(r'\S+ banned by .+: \S+ (rowid: \d+, description: \S+).')),
     ]
+    # plain answers of the network console, see sample_stats
+    listpeers_pattern = re.compile(r'(\d+): (\S+) ?(.*)')
+    nopeers_line = 'No peers exist'
+    speedstats_pattern = re.compile(r'Upload speed \(KBps\): ([0-9.]+) +Download speed \(KBps\): ([0-9.]+)')
+    stats_command = b'listpeers\nspeedstats\n'
+    # logged at every game start, the only ping that STK prints
+    maxping_objectname = 'ServerLobby'
+    maxping_pattern = re.compile(r'Max ping from peers: (\d+), jitter tolerance: \d+')
+    # delay of the sample after a forced disconnect, so that the peer is gone when it is listed
+    resample_delay = 2.0
     stop_command = b'quit\n'
+    # seconds to handle the buffered output before the detach
+    detach_drain_timeout = 10.0
 
     def __init__(self, logger: logging.Logger, writeln: Callable[[str], Any],
                  name: str, cfgpath: str, datapath: str, executable_path: str,
@@ -200,8 +1975,23 @@ class STKServer:
                  extra_args: Optional[Sequence[str]] = tuple(),
                  global_logignores: Optional[Mapping[str, Mapping[int, Sequence[re.Pattern]]]] = None,
                  logignores: Optional[MutableMapping[str, MutableMapping[int, MutableSequence[re.Pattern]]]] = None,
-                 start_stop_guard: Optional[asyncio.Lock] = None):
-        self.process: Optional[asyncio.subprocess.Process] = None
+                 start_stop_guard: Optional[asyncio.Lock] = None,
+                 metrics: Optional[MetricsRegistry] = None,
+                 events: Optional[EventBus] = None,
+                 scheduler: Optional[Scheduler] = None,
+                 watchdog_interval: float = 0.0,
+                 watchdog_timeout: float = 15.0,
+                 watchdog_max_latency: float = 0.0,
+                 watchdog_max_failures: int = 3,
+                 statedir: Optional[str] = None,
+                 log_verbosity: Union[str, int, None] = 'auto',
+                 reader_budget_lines: int = 200,
+                 reader_budget_ms: float = 10.0,
+                 reader_weight: float = 1.0,
+                 stats_interval: float = 0.0,
+                 stats_jitter: float = 0.0,
+                 stats_history: int = 360):
+        self.process: Optional[Union[asyncio.subprocess.Process, DetachedProcess]] = None
         if not os.path.isfile(executable_path):
             raise FileNotFoundError(f'supertuxkart executable "{executable_path}" not found', 'executable_path', executable_path)
         self.executable_path = executable_path
@@ -221,15 +2011,69 @@ class STKServer:
         self.shutdown_timeout = shutdown_timeout
         self.empty_server = asyncio.Event()
         self.empty_server.set()
+        self.peer_count = 0
+        # address: user version of the peer, None until the peer is listed by the network console
+        self.peers: MutableMapping[str, Optional[str]] = {}
+        self.metrics = metrics
+        # lifecycle events: launch, ready, exit, restart
+        self.events = events
+        self.scheduler = scheduler
+        # liveness watchdog, see _watchdog
+        self.watchdog_interval = watchdog_interval
+        self.watchdog_timeout = watchdog_timeout
+        self.watchdog_max_latency = watchdog_max_latency
+        self.watchdog_max_failures = watchdog_max_failures
+        self.probe_failures = 0
+        self.probe_latency: Optional[float] = None
+        self.last_stdout = time.monotonic()
+        self._probe: Optional[asyncio.Future] = None
+        self._forced_restart = False
+        # detached mode, see DetachedProcess
+        self.statedir = os.path.join(statedir, name) if statedir is not None else None
+        # set while the buffered output is handled before the detach, the readers end at the EOF
+        self._detaching = False
+        # extensions keep here the state that has to survive the wrapper restart, filled on detach_event
+        self.attached_state: MutableMapping[str, Any] = {}
+        self.detach_event = TimedHandlerChain('detach_event', name, cancellable=False)
         self.name = name
         self.cfgpath = cfgpath
         if not os.path.isdir(datapath):
             raise FileNotFoundError(f'assets directory "{datapath}" not found', 'datapath', datapath)
         self.datapath = datapath
         self.logger = logger
-        self.log_event = AIOHandlerChain()
+        self.log_event = TimedHandlerChain('log_event', name)
         self.log_event.on_handler_error = self._loghandler_error
-        self.ready_event = AIOHandlerChain(cancellable=False)
+        self.ready_event = TimedHandlerChain('ready_event', name, cancellable=False)
+        # called with every raw stdout line before it is handled, e.g. by the log capture of stkw_replay
+        self.stdout_taps: MutableSequence[Callable[[str], Any]] = []
+        # "auto" passes the lowest --log level that the subscriptions need, a number is passed as is, None passes nothing
+        self.log_verbosity = log_verbosity
+        self.running_verbosity: Optional[int] = None
+        # fair share of the event loop, see _reader. 0 disables the limit
+        self.reader_budget_lines = reader_budget_lines
+        self.reader_budget_ms = reader_budget_ms
+        self.reader_weight = reader_weight
+        self.reader_overruns = 0
+        self.lines_read = 0
+        self._turn_lines = 0
+        self._turn_start = 0.0
+        self._reader_yielded = False
+        # network console sampler, see sample_stats. 0 disables the periodic sample
+        self.stats_interval = stats_interval
+        self.stats_jitter = stats_jitter
+        # (time, upload KBps, download KBps)
+        self.speed_samples: Deque[Tuple[float, float, float]] = deque(maxlen=stats_history)
+        # (time, ping ms) of the slowest peer at every game start, listpeers of STK doesn't show the ping of the peers
+        self.ping_samples: Deque[Tuple[float, int]] = deque(maxlen=stats_history)
+        self.stats_history = stats_history
+        self.peer_corrections = 0
+        self._sample: Optional[Tuple[MutableMapping[str, Optional[int]], asyncio.Future]] = None
+        self._resample_task: Optional[asyncio.Task] = None
+        # owner: [(objectname, level, reason)], see subscribe_log
+        self.log_subscriptions: MutableMapping[str, MutableSequence[Tuple[str, int, str]]] = defaultdict(list)
+        self.subscribe_log('STKServer', self.ready_objectname, self.ready_loglevel, 'ready detection')
+        self.subscribe_log('STKServer', self.joinleave_objectname, logging.INFO, 'peer count')
+        self.subscribe_log('STKServer', self.maxping_objectname, logging.INFO, 'highest ping of the games')
         self.restarter_task: Optional[asyncio.Task] = None
         self.restarter_cond = restarter_cond
         self.reader_task: Optional[asyncio.Task] = None
@@ -267,6 +2111,42 @@ class STKServer:
     def del_logignore(self, modname: str, level: int, id_: int):
         del self.log_ignores[modname][level][id_]
 
+    def subscribe_log(self, owner: str, objectname: str, level: int, reason: str = ''):
+        """
+        Declares that the log_event handlers of owner need the lines of objectname at level and above.
+        The server is started with the lowest STK log level that the subscriptions need, see required_log_level
+        """
+        self.log_subscriptions[owner].append((objectname, level, reason))
+        if self.running_verbosity is not None and stk_log_verbosity(level) < self.running_verbosity:
+            self.logger.warning(f'STK {self.name} is running with --log={self.running_verbosity}, {owner} gets '
+                                f'{logging.getLevelName(level).lower()} lines of {objectname} after the restart')
+
+    def unsubscribe_log(self, owner: str):
+        self.log_subscriptions.pop(owner, None)
+
+    def required_log_level(self) -> Tuple[int, MutableSequence[Tuple[str, str, int, str]]]:
+        """
+        The lowest wrapper log level needed from STK, and the subscriptions (owner, objectname, level, reason) that need it.
+        Lines below the level of the wrapper logger are only needed by the subscriptions
+        """
+        _level = self.logger.getEffectiveLevel()
+        _needs = [('logging', '*', _level, f'level of the "{self.logger.name}" logger')]
+        for owner, subscriptions in self.log_subscriptions.items():
+            for objectname, level, reason in subscriptions:
+                _needs.append((owner, objectname, level, reason))
+                _level = min(_level, level)
+        return _level, [need for need in _needs if stk_log_verbosity(need[2]) == stk_log_verbosity(_level)]
+
+    def launch_verbosity(self) -> Optional[int]:
+        """The --log value to start the server with, None if it is not passed"""
+        if any(arg.startswith('--log=') for arg in self.extra_args):
+            return None
+        if self.log_verbosity == 'auto':
+            return stk_log_verbosity(self.required_log_level()[0])
+        elif self.log_verbosity is None or self.log_verbosity == '':
+            return None
+        return int(self.log_verbosity)
+
     async def launch(self):
         if self.process is not None:
             if self.process.returncode is not None:
@@ -284,26 +2164,121 @@ class STKServer:
         if self.start_stop_guard is not None:
             await self.start_stop_guard.acquire()
             self.server_ready_task = asyncio.create_task(self._waitready(self.startup_timeout))
-        self.process = await asyncio.create_subprocess_exec(
-            self.executable_path,
-            f'--server-config={self.cfgpath}',
-            *self.extra_args,
-            '--network-console',
-            stdin=asyncio.subprocess.PIPE,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-            env=_env,
-            cwd=self.cwd
-        )
+        self.running_verbosity = self.launch_verbosity()
+        _args = (self.executable_path, f'--server-config={self.cfgpath}',
+                 *((f'--log={self.running_verbosity}', ) if self.running_verbosity is not None else ()),
+                 *self.extra_args, '--network-console')
+        if self.statedir is not None:
+            self.process = await DetachedProcess.spawn(self.statedir, _args, _env, self.cwd)
+        else:
+            self.process = await asyncio.create_subprocess_exec(
+                *_args,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                env=_env,
+                cwd=self.cwd
+            )
         self.restart = self.autorestart
+        self.attached_state.clear()
+        self._supervise()
+        self.start_readers()
+        if self.events is not None:
+            self.events.publish('launch', self.name, pid=self.process.pid)
+
+    def _supervise(self):
+        """Starts the timers and jobs of a running process"""
+        self._forced_restart = False
+        self.probe_failures = 0
         self.active = True
-        self.reader_task = asyncio.create_task(self._reader(self.process.stdout))
-        self.errreader_task = asyncio.create_task(self._error_reader(self.process.stderr))
+        self.last_stdout = time.monotonic()
         if self.timed_autorestart:
-            self.timer_task = asyncio.create_task(self._timed_restarter())
+            self.start_timed_restart()
+        if self.watchdog_interval and self.scheduler is not None:
+            self.scheduler.add_job(self.watchdog_job, self._watchdog, Interval(self.watchdog_interval),
+                                   persist=False, owner=self.name)
+        if self.stats_interval and self.scheduler is not None:
+            self.scheduler.add_job(self.stats_job, self._stats_sampler, Interval(self.stats_interval),
+                                   jitter=self.stats_jitter, persist=False, owner=self.name)
         if self.restarter_cond is not None:
             self.restarter_task = asyncio.create_task(self._restarter())
 
+    def start_readers(self):
+        self.reader_task = asyncio.create_task(self._reader(self.process.stdout))
+        self.errreader_task = asyncio.create_task(self._error_reader(self.process.stderr))
+
+    async def attach(self, start_reading=True) -> bool:
+        """
+        Detached mode: takes over the process left running by the previous wrapper.
+        Returns False if there is no such process.
+        With start_reading=False, call start_readers() when the log handlers are ready
+        """
+        if self.statedir is None or self.active:
+            return False
+        process = await DetachedProcess.attach(self.statedir)
+        if process is None:
+            return False
+        self.process = process
+        state = DetachedProcess.load_state(self.statedir)
+        self.restart = state.get('restart', self.autorestart)
+        self.attached_state = state.get('attached_state', {})
+        self.peers = state.get('peers', {})
+        self.running_verbosity = state.get('log_verbosity')
+        self.set_peer_count(state.get('peer_count', 0))
+        self.ready = state.get('ready', False)
+        if process.output_stalled:
+            self.logger.warning(f'STK {self.name} output pipe is full, the server has been blocked on writing its log '
+                                f'while no wrapper was attached. Lower log_verbosity of the detached servers')
+            if self.metrics is not None:
+                self.metrics.inc('stk_detached_output_stalls_total', server=self.name)
+        if not self.ready and self.start_stop_guard is not None:
+            await self.start_stop_guard.acquire()
+            self.server_ready_task = asyncio.create_task(self._waitready(self.startup_timeout))
+        self._supervise()
+        if start_reading:
+            self.start_readers()
+        self.logger.info(f'STK {self.name} re-attached to the running process {process.pid}')
+        return True
+
+    async def detach(self) -> bool:
+        """
+        Detached mode: saves the state and disconnects from the process, leaving it running.
+        Used instead of stop() when the wrapper exits
+        """
+        if not self.active or not isinstance(self.process, DetachedProcess) or self.process.returncode is not None:
+            return False
+        # the lines that are already read are handled first, so that the saved state includes them
+        self._detaching = True
+        _tails = self.process.close_output()
+        _readers = tuple(task for task in (self.reader_task, self.errreader_task) if task is not None and not task.done())
+        if _readers:
+            await asyncio.wait(_readers, timeout=self.detach_drain_timeout)
+        self._detaching = False
+        await self.detach_event.emit()
+        self.process.save_state({
+            'tails': _tails,
+            'ready': self.ready,
+            'restart': self.restart,
+            'peer_count': self.peer_count,
+            'peers': self.peers,
+            'log_verbosity': self.running_verbosity,
+            'attached_state': self.attached_state
+        })
+        self.active = False
+        for task in (self.reader_task, self.errreader_task, self.restarter_task, self.server_ready_task, self._resample_task):
+            if task is not None and not task.done():
+                task.cancel()
+        if self.scheduler is not None:
+            self.scheduler.remove_job(self.watchdog_job)
+            self.scheduler.remove_job(self.stats_job)
+        self.cancel_timed_restart(forget=False)
+        self.process.detach()
+        self.logger.info(f'STK {self.name} detached from the process {self.process.pid}, it keeps running')
+        self.process = None
+        self.ready = False
+        self.running_verbosity = None
+        return True
+
     async def _waitready(self, timeout: Optional[float] = None):
         """
         Releases the start_stop_guard lock when the server becomes ready.
@@ -339,9 +2314,8 @@ class STKServer:
             if self.restarter_task is not None:
                 self.restarter_task.cancel()
                 self.restarter_task = None
-            if self.timer_task is not None and not from_timer:
-                self.timer_task.cancel()
-                self.timer_task = None
+            if not from_timer:
+                self.cancel_timed_restart()
             if timeout == 0:
                 # Forcibly stop a server
                 self.logger.warning(f'STK {self.name} was forcefully shut down.')
@@ -390,27 +2364,71 @@ class STKServer:
             else:
                 self.handle_stderr(line.decode())
 
+    def _mark_yield(self):
+        self._reader_yielded = True
+
+    def _reader_budget_exhausted(self) -> bool:
+        _lines = self.reader_budget_lines * self.reader_weight
+        _seconds = self.reader_budget_ms * self.reader_weight / 1000
+        return bool((_lines and self._turn_lines >= _lines)
+                    or (_seconds and time.perf_counter() - self._turn_start >= _seconds))
+
     async def _reader(self, _stdout: asyncio.StreamReader):
+        """
+        Reads and handles the output line by line.
+        readline() doesn't yield to the event loop while the lines are buffered, so a chatty server
+        yields itself after handling reader_budget_lines lines or spending reader_budget_ms milliseconds
+        (both scaled by reader_weight) in a row, and the other servers get their turn
+        """
         self.logger.debug('_reader: start')
+        _loop = asyncio.get_running_loop()
+        self._turn_lines = 0
+        self._turn_start = time.perf_counter()
         while not _stdout.at_eof():
             try:
+                if self._reader_budget_exhausted():
+                    self.reader_overruns += 1
+                    if self.metrics is not None:
+                        self.metrics.inc('stk_reader_budget_overruns_total', server=self.name)
+                    await asyncio.sleep(0)
+                    self._turn_lines = 0
+                    self._turn_start = time.perf_counter()
                 async with self.lock:
                     pass
                 self.idle_cancellable = True
                 async with self.lock:
-                    line = await _stdout.readline()
+                    # runs only if readline() has waited for the output, which starts a new turn
+                    self._reader_yielded = False
+                    _yield = _loop.call_soon(self._mark_yield)
+                    try:
+                        line = await _stdout.readline()
+                    finally:
+                        _yield.cancel()
+                    if self._reader_yielded:
+                        self._turn_lines = 0
+                        self._turn_start = time.perf_counter()
+                    self._turn_lines += 1
+                    self.lines_read += 1
                     self.idle_cancellable = False
+                    self.last_stdout = time.monotonic()
+                    _line = line.decode()
+                    for tap in self.stdout_taps:
+                        tap(_line)
                     if asyncio.iscoroutinefunction(self.handle_stdout):
-                        await self.handle_stdout(ansi_escape_.sub('', line.decode()))
+                        await self.handle_stdout(ansi_escape_.sub('', _line))
                     else:
-                        self.handle_stdout(ansi_escape_.sub('', line.decode()))
+                        self.handle_stdout(ansi_escape_.sub('', _line))
             except asyncio.CancelledError:
                 if not self.active:
+                    # stopped or detached
                     return
                 else:
                     continue
             except Exception:
                 self.logger.error(f'_reader: exception caught\n{traceback.format_exc()}')
+        if self._detaching:
+            # the process keeps running, the rest of its output is read by the next wrapper
+            return
         _returncode = self.process.returncode
         if _returncode is None:
             self.idle_cancellable = True
@@ -424,18 +2442,232 @@ class STKServer:
         self.process = None
         self.ready = False
         self.active = False
-        self.empty_server.set()
-        if self.autorestart and self.restart:
+        self.running_verbosity = None
+        self.peers.clear()
+        self.ping_samples.clear()
+        self.set_peer_count(0)
+        if self.scheduler is not None:
+            self.scheduler.remove_job(self.watchdog_job)
+            self.scheduler.remove_job(self.stats_job)
+        if self._probe is not None and not self._probe.done():
+            self._probe.cancel()
+        if self._sample is not None and not self._sample[1].done():
+            self._sample[1].cancel()
+        if self._resample_task is not None and not self._resample_task.done():
+            self._resample_task.cancel()
+        _restart = (self.autorestart and self.restart) or self._forced_restart
+        if self.events is not None:
+            self.events.publish('exit', self.name, returncode=_returncode, restart=_restart)
+        if not _restart:
+            self.cancel_timed_restart()
+        if _restart:
             if _returncode != 0:
                 self.logger.info(f'Server {self.name} returned non-zero returncode, restart delay applied: {self.autorestart_pause}')
                 await asyncio.sleep(self.autorestart_pause)
+            if self.events is not None:
+                self.events.publish('restart', self.name, returncode=_returncode)
             self.logger.debug('_reader: restart server')
             await self.launch()
         self.logger.debug('_reader: end')
 
+    @property
+    def watchdog_job(self) -> str:
+        return f'watchdog:{self.name}'
+
+    async def probe(self, timeout: Optional[float] = None) -> Optional[float]:
+        """
+        Sends idle_command to the network console and waits for its "Unknown command" echo.
+        Returns the round-trip time in seconds, or None if the server didn't answer within a timeout
+        """
+        if self.process is None:
+            return None
+        _loop = asyncio.get_running_loop()
+        if self._probe is None or self._probe.done():
+            self._probe = _loop.create_future()
+        _probe = self._probe
+        _start = time.perf_counter()
+
+        async def _roundtrip():
+            self.process.stdin.write(self.idle_command.encode() + b'\n')
+            await self.process.stdin.drain()
+            # unlike awaiting directly, asyncio.wait doesn't cancel the probe on timeout
+            await asyncio.wait((_probe, ))
+        try:
+            await asyncio.wait_for(_roundtrip(), timeout)
+        except (asyncio.TimeoutError, ConnectionError):
+            return None
+        if _probe.cancelled():
+            return None
+        return time.perf_counter() - _start
+
+    async def _watchdog(self):
+        """
+        Liveness check of the STK process: a hung server keeps its pipes open,
+        so it is killed and restarted when probes fail watchdog_max_failures times in a row
+        or the probe latency exceeds watchdog_max_latency
+        """
+        if not self.active or self.process is None or not self.ready:
+            return
+        _latency = self.probe_latency = await self.probe(self.watchdog_timeout)
+        _silence = time.monotonic() - self.last_stdout
+        if self.metrics is not None:
+            self.metrics.set('stk_stdout_silence_seconds', _silence, server=self.name)
+        if not self.active:
+            return
+        if _latency is None:
+            self.probe_failures += 1
+            self.logger.warning(f'STK {self.name} did not answer the watchdog probe within {self.watchdog_timeout} seconds '
+                                f'({self.probe_failures} of {self.watchdog_max_failures}), stdout is silent for {_silence:.0f} seconds')
+        else:
+            self.probe_failures = 0
+        if self.metrics is not None:
+            self.metrics.set('stk_probe_failures', self.probe_failures, server=self.name)
+            if _latency is not None:
+                self.metrics.set('stk_probe_latency_seconds', _latency, server=self.name)
+        if self.probe_failures >= self.watchdog_max_failures:
+            self.watchdog_restart(f'{self.probe_failures} watchdog probes failed in a row')
+        elif _latency is not None and self.watchdog_max_latency and _latency > self.watchdog_max_latency:
+            self.watchdog_restart(f'watchdog probe latency {_latency:.3f} s exceeds {self.watchdog_max_latency} s')
+
+    def watchdog_restart(self, reason: str):
+        self.logger.error(f'STK {self.name} is considered hung: {reason}. Killing and restarting.')
+        if self.metrics is not None:
+            self.metrics.inc('stk_watchdog_restarts_total', server=self.name)
+        self._forced_restart = True
+        self.restart = True
+        if self.process is not None and self.process.returncode is None:
+            self.process.kill()
+
+    def set_peer_count(self, count: int):
+        self.peer_count = count
+        if count:
+            self.empty_server.clear()
+        else:
+            self.empty_server.set()
+        if self.metrics is not None:
+            self.metrics.set('stk_peers', count, server=self.name)
+
+    @property
+    def stats_job(self) -> str:
+        return f'stats:{self.name}'
+
+    async def sample_stats(self, timeout: Optional[float] = None) -> bool:
+        """
+        Sends listpeers and speedstats to the network console and corrects the peer set with the answers.
+        The answers are plain lines, speedstats comes last and completes the sample, see handle_stdout.
+        Returns False if the server didn't answer within a timeout
+        """
+        if self.process is None or not self.ready:
+            return False
+        if self._sample is not None:
+            # already sampling, wait for the same answer
+            _future = self._sample[1]
+        else:
+            _future = asyncio.get_running_loop().create_future()
+            self._sample = ({}, _future)
+            try:
+                self.process.stdin.write(self.stats_command)
+                await self.process.stdin.drain()
+            except ConnectionError:
+                self._sample = None
+                return False
+        try:
+            await asyncio.wait_for(asyncio.shield(_future), timeout)
+        except asyncio.TimeoutError:
+            if self._sample is not None and self._sample[1] is _future:
+                self._sample = None
+                _future.cancel()
+            return False
+        except asyncio.CancelledError:
+            if _future.cancelled():
+                return False
+            raise
+        return True
+
+    def _apply_sample(self, upload: float, download: float):
+        """Replaces the peer set with the listed one and records the speeds"""
+        _peers, _future = self._sample
+        self._sample = None
+        _now = time.time()
+        if len(_peers) != self.peer_count:
+            self.peer_corrections += 1
+            self.logger.info(f'STK {self.name}: {len(_peers)} peers are connected, corrected from {self.peer_count}')
+            if self.metrics is not None:
+                self.metrics.inc('stk_peer_corrections_total', server=self.name)
+        self.peers = _peers
+        self.set_peer_count(len(_peers))
+        self.speed_samples.append((_now, upload, download))
+        if self.metrics is not None:
+            self.metrics.set('stk_upload_kbps', upload, server=self.name)
+            self.metrics.set('stk_download_kbps', download, server=self.name)
+        if not _future.done():
+            _future.set_result(None)
+
+    def _sample_line(self, line: str) -> bool:
+        """Collects an answer of the network console into the sample in progress, returns False for other lines"""
+        _peers = self._sample[0]
+        _match = self.listpeers_pattern.fullmatch(line)
+        if _match is not None:
+            _peers[_match.group(2)] = _match.group(3) or None
+            return True
+        if line == self.nopeers_line:
+            return True
+        _match = self.speedstats_pattern.fullmatch(line)
+        if _match is not None:
+            self._apply_sample(float(_match.group(1)), float(_match.group(2)))
+            return True
+        return False
+
+    async def _stats_sampler(self):
+        if not self.active or not self.ready:
+            return
+        if not await self.sample_stats(self.watchdog_timeout or None):
+            self.logger.debug(f'STK {self.name} did not answer listpeers and speedstats')
+
+    def resample_soon(self):
+        """Samples the peers after resample_delay, used when a peer is disconnected without the usual log line"""
+        if self._resample_task is None or self._resample_task.done():
+            self._resample_task = asyncio.create_task(self._resample())
+
+    async def _resample(self):
+        await asyncio.sleep(self.resample_delay)
+        await self._stats_sampler()
+
+    @property
+    def timed_restart_job(self) -> str:
+        return f'restart:{self.name}'
+
+    def start_timed_restart(self):
+        """Schedules the restart every timed_autorestart_interval seconds, with scheduler if available"""
+        self.cancel_timed_restart(forget=False)
+        if self.scheduler is None:
+            self.timer_task = asyncio.create_task(self._timed_restarter())
+            return
+        self.logger.info(f'Timed autorestarter for server {self.name} scheduled. Interval = {self.timed_autorestart_interval}')
+        self.scheduler.add_job(self.timed_restart_job, self._timed_restart, Interval(self.timed_autorestart_interval),
+                               catch_up=False, owner=self.name)
+
+    def cancel_timed_restart(self, forget=True) -> bool:
+        """Cancels the timed autorestart, returns True if it was active"""
+        _cancelled = False
+        if self.timer_task is not None:
+            if not self.timer_task.done():
+                self.timer_task.cancel()
+                _cancelled = True
+            self.timer_task = None
+        if self.scheduler is not None and self.timed_restart_job in self.scheduler.jobs:
+            self.scheduler.remove_job(self.timed_restart_job, forget=forget)
+            _cancelled = True
+        return _cancelled
+
     async def _timed_restarter(self):
         self.logger.info(f'Timed autorestarter for server {self.name} launched. Interval = {self.timed_autorestart_interval}')
         await asyncio.sleep(self.timed_autorestart_interval)
+        await self._timed_restart()
+
+    async def _timed_restart(self):
+        if not self.active:
+            return
         try:
             self.logger.info(f'Timed autorestarter for server {self.name} schedules the restart')
             # async with self.restarter_cond:
@@ -465,13 +2697,17 @@ class STKServer:
         self.logger.error(f'STK-Stderr {self.name}: {line}')
 
     async def handle_stdout(self, line: str):
-        if self.ignore_idle.fullmatch(line):
+        if self.ignore_idle.fullmatch(line.rstrip('\r\n')):
+            if self._probe is not None and not self._probe.done():
+                self._probe.set_result(None)
             return
         # handle log message
         _match = self.logstrip.fullmatch(line)
         if _match:
             levelname, objectname, message = _match.groups()
         else:
+            if self._sample is not None and self._sample_line(line.rstrip('\r\n')):
+                return
             # self.logger.info(f'STK [{self.name}] {line[:-1]}')
             if self.show_plain:
                 self.writeln(line[:-1])
@@ -479,16 +2715,32 @@ class STKServer:
         if self.joinleave_objectname == objectname:
             _matchjl = self.joinleave_pattern.fullmatch(message)
             if _matchjl:
-                _curPeers = int(_matchjl.groups()[0])
-                if _curPeers:
-                    self.empty_server.clear()
-                else:
-                    self.empty_server.set()
+                _address, _left, _curPeers = _matchjl.groups()
+                # a sample in progress may have listed the peers before this line
+                for _peers in ((self.peers, self._sample[0]) if self._sample is not None else (self.peers, )):
+                    if _left:
+                        _peers.pop(_address, None)
+                    else:
+                        _peers.setdefault(_address, None)
+                self.set_peer_count(int(_curPeers))
         level = getattr(logging, levelname.upper(), logging.DEBUG)
+        for _objectname, _level, _pattern in self.extra_leave_patterns:
+            if _objectname == objectname and _level == level and _pattern.fullmatch(message):
+                # kicks and bans are not always followed by the disconnect line, the network console has the truth
+                self.resample_soon()
+                break
         if self.ready_objectname == objectname and self.ready_loglevel == level:
             _matchready = self.ready_pattern.fullmatch(message)
             if _matchready is not None:
+                if self.events is not None:
+                    self.events.publish('ready', self.name, port=int(_matchready.group(1)))
                 await self.ready_event.emit(int(_matchready.group(1)))
+        if self.maxping_objectname == objectname and level == logging.INFO:
+            _matchping = self.maxping_pattern.fullmatch(message)
+            if _matchping is not None:
+                self.ping_samples.append((time.time(), int(_matchping.group(1))))
+                if self.metrics is not None:
+                    self.metrics.set('stk_peer_ping_max_ms', int(_matchping.group(1)), server=self.name)
         if not (await self.log_event.emit(message, levelname=levelname, level=level, objectname=objectname)):
             return
         # 'STKHost': {logging.WARNING: [re.compile(r'bad addon: asdasdasd')]}
@@ -581,8 +2833,7 @@ def stkwrapper_command_set(ace: AdminCommandExecutor):
             if item:
                 _kwargs[name] = item
         try:
-            _server = STKServer(ace.logger, ace.ainput.writeln, name, restarter_cond=ace.server_restart_cond,
-                                start_stop_guard=ace.start_stop_guard, **_kwargs)
+            _server = STKServer(ace.logger, ace.writeln, name, **server_services(ace), **_kwargs)
         except FileNotFoundError as exc:
             cmd.error(f'Failed, {exc}, re-check the path', log=False)
             return
@@ -781,7 +3032,7 @@ def stkwrapper_command_set(ace: AdminCommandExecutor):
                 cmd.print('Server successfully edited.')
             else:
                 _server = STKServer(
-                    cmd.logger, cmd.ainput.writeln, name,
+                    cmd.logger, ace.writeln, name,
                     cfgpath=cfgpath,
                     datapath=datapath,
                     executable_path=executable_path,
@@ -792,7 +3043,7 @@ def stkwrapper_command_set(ace: AdminCommandExecutor):
                     timed_autorestart_interval=timed_autorestart_interval,
                     startup_timeout=startup_timeout,
                     shutdown_timeout=shutdown_timeout,
-                    restarter_cond=ace.server_restart_cond, start_stop_guard=ace.start_stop_guard,
+                    **server_services(ace),
                     extra_env=extra_env,
                     extra_args=extra_args
                 )
@@ -819,8 +3070,7 @@ def stkwrapper_command_set(ace: AdminCommandExecutor):
         if _server.active:
             cmd.error(f'Server {name} is already running. To stop it, do stk-stop {name}', log=False)
             return
-        _tsk = asyncio.create_task(_server.launch())
-        ace.tasks[_tsk.get_name()] = _tsk
+        ace.task_registry.spawn(_server.launch(), owner=name, description='start', tasks=ace.tasks)
         cmd.print(f'Starting STK Server {name}')
     ace.add_command(start_server, 'stk-start', ((str, 'name'), ), ((bool, 'autorestart?'), ), 'Launch an STK server', stkserver_tab)
 
@@ -838,8 +3088,7 @@ def stkwrapper_command_set(ace: AdminCommandExecutor):
             cmd.error(f'Server {name} currently has players. To stop it anyway, specify second argument as yes', log=False)
             return
         _server.restart = False
-        _tsk = asyncio.create_task(_server.stop(timeout))
-        ace.tasks[_tsk.get_name()] = _tsk
+        ace.task_registry.spawn(_server.stop(timeout), owner=name, description='stop', tasks=ace.tasks)
         cmd.print(f'Stopping server {name}')
     ace.add_command(stop_server, 'stk-stop', ((str, 'name'), ), ((bool, 'even if players'), (float, 'timeout'), ), 'Stop an STK server. When timeout reaches, the process is killed', stkserver_tab)
 
@@ -855,8 +3104,7 @@ def stkwrapper_command_set(ace: AdminCommandExecutor):
             cmd.error(f'Server {name} currently has players. To stop it anyway, specify second argument as yes', log=False)
             return
         _server.restart = True
-        _tsk = asyncio.create_task(_server.stop(60))
-        ace.tasks[_tsk.get_name()] = _tsk
+        ace.task_registry.spawn(_server.stop(60), owner=name, description='restart', tasks=ace.tasks)
         cmd.print(f'Restarting server {name}')
     ace.add_command(restart_server, 'stk-restart', ((str, 'name'), ), ((bool, 'force'), ), 'Restart an STK server.', stkserver_tab)
 
@@ -896,18 +3144,229 @@ def stkwrapper_command_set(ace: AdminCommandExecutor):
         _len = len(ace.servers)
         _maxpage, _start, _end = paginate_range(_len, 10, cpage)
         cmd.print(f'STK servers: (page {cpage} or {_maxpage})')
-        cmd.print('\n'.join(f'{name}: pid {getattr(server.process, "pid", -1)}' for name, server in tuple(ace.servers.items())[_start:_end]))
+        cmd.print('\n'.join(f'{name}: pid {getattr(server.process, "pid", -1)}, {server.peer_count} peers'
+                            f'{f", probe {server.probe_latency:.3f} s" if server.probe_latency is not None else ""}'
+                            f'{f", {server.reader_overruns} reader budget overruns" if server.reader_overruns else ""}'
+                            for name, server in tuple(ace.servers.items())[_start:_end]))
     ace.add_command(list_servers, 'stk-servers', optargs=((int, 'page'), ))
 
+    async def show_peers(cmd: AdminCommandExecutor, name: str):
+        if name not in ace.servers:
+            cmd.error('Server doesn\'t exist', log=False)
+            return
+        _server: STKServer = ace.servers[name]
+        if not _server.active:
+            cmd.error(f'Server {name} is stopped. To start it, do stk-start {name}', log=False)
+            return
+        if not await _server.sample_stats(_server.watchdog_timeout or None):
+            cmd.error(f'Server {name} did not answer listpeers and speedstats, showing the tracked peers', log=False)
+        cmd.print(f'{name}: {_server.peer_count} peers, peer count corrected {_server.peer_corrections} times')
+        if _server.speed_samples:
+            _, _upload, _download = _server.speed_samples[-1]
+            _uploads = tuple(sample[1] for sample in _server.speed_samples)
+            cmd.print(f'Upload {_upload:.1f} KBps (peak {max(_uploads):.1f}), download {_download:.1f} KBps '
+                      f'in the last {len(_server.speed_samples)} samples')
+        if _server.ping_samples:
+            _, _ping = _server.ping_samples[-1]
+            _pings = tuple(sample[1] for sample in _server.ping_samples)
+            cmd.print(f'Highest ping at the last game start {_ping} ms, average {sum(_pings) / len(_pings):.0f} ms '
+                      f'in the last {len(_pings)} games')
+        for address, version in sorted(_server.peers.items()):
+            cmd.print(f'{address}: {version or "not listed yet"}')
+    ace.add_command(show_peers, 'stk-peers', ((str, 'server name'), ),
+                    description='Samples and shows the connected peers, the network speed and the ping of the games of the server',
+                    atabcomplete=stkserver_tab)
+
+    async def show_verbosity(cmd: AdminCommandExecutor, name: str):
+        if name not in ace.servers:
+            cmd.error('Server doesn\'t exist', log=False)
+            return
+        server: STKServer = ace.servers[name]
+        _level, _needs = server.required_log_level()
+        _verbosity = server.launch_verbosity()
+        if _verbosity is None:
+            _reason = ('extra_args set it' if any(arg.startswith('--log=') for arg in server.extra_args)
+                       else 'log_verbosity is empty')
+            cmd.print(f'{name} is started without --log, {_reason}')
+        elif server.log_verbosity != 'auto':
+            cmd.print(f'{name} is started with --log={_verbosity} ({stk_verbosity_names[_verbosity]}), set by log_verbosity')
+        else:
+            cmd.print(f'{name} is started with --log={_verbosity} ({stk_verbosity_names[_verbosity]}), needed by:')
+            cmd.print(*(f'  {logging.getLevelName(level).lower()} lines of {objectname} - {owner}: {reason}'
+                        for owner, objectname, level, reason in _needs), sep='\n')
+        if server.active:
+            _running = server.running_verbosity
+            cmd.print(f'The running process was started with {f"--log={_running}" if _running is not None else "its default log level"}'
+                      f'{", restart to apply" if _running != _verbosity else ""}')
+        if _verbosity is None:
+            return
+        # lines below the level are not printed by STK anymore
+        _redundant = sorted(set(f'{objectname} {logging.getLevelName(level).lower()}'
+                                for logignores in (server.log_ignores, server.global_logignores or {})
+                                for objectname, levels in logignores.items()
+                                for level, patterns in levels.items() if patterns and stk_log_verbosity(level) < _verbosity))
+        if _redundant:
+            cmd.print(f'Log-ignores that are redundant at this level: {", ".join(_redundant)}')
+    ace.add_command(show_verbosity, 'stk-verbosity', ((str, 'server name'), ),
+                    description='Explains the STK log level that the server is started with',
+                    atabcomplete=stkserver_tab)
+
+    async def show_metrics(cmd: AdminCommandExecutor, prefix: str = ''):
+        cmd.print(ace.metrics.export_text(prefix).rstrip('\n'))
+    ace.add_command(show_metrics, 'stk-metrics', optargs=((str, 'name prefix'), ),
+                    description='Shows the exported metrics in Prometheus text format')
+
+    async def show_graph(cmd: AdminCommandExecutor, name: str, metric: str, timerange: str = '1h'):
+        if ace.timeseries is None:
+            cmd.error('Time series are not collected', log=False)
+            return
+        try:
+            _seconds = parse_duration(timerange)
+        except ValueError:
+            cmd.error(f'Invalid range "{timerange}", expected a number of seconds or 30m, 6h, 7d', log=False)
+            return
+        if _seconds <= 0:
+            cmd.error('Range must be positive', log=False)
+            return
+        _result = ace.timeseries.query(name, metric, _seconds)
+        if _result is None:
+            _metrics = ace.timeseries.metrics(name)
+            cmd.error(f'No time series {metric} of {name}. '
+                      + (f'Available: {", ".join(_metrics)}' if _metrics else 'This server has no time series'), log=False)
+            return
+        _resolution, _values = _result
+        _known = tuple(value for value in _values if not math.isnan(value))
+        cmd.print(f'{name} {metric} for the last {timerange}, {format_duration(_resolution)} buckets'
+                  + (f': min {min(_known):g}, average {sum(_known) / len(_known):g}, max {max(_known):g}, last {_known[-1]:g}'
+                     if _known else ': no samples'))
+        cmd.print(sparkline(_values))
+
+    async def graph_tab(cmd: AdminCommandExecutor, name: str = '', metric: str = '', *args, argl: str):
+        if not metric and not (name and argl):
+            return await stkserver_tab(cmd, name, argl=argl)
+        if ace.timeseries is None:
+            return
+        if argl and not metric:
+            return ace.timeseries.metrics(name)
+        return list(filter(lambda _metric: _metric.startswith(metric), ace.timeseries.metrics(name)))
+    ace.add_command(show_graph, 'stk-graph', ((str, 'server name'), (str, 'metric')), ((str, 'range'), ),
+                    description='Draws the time series of the server metric for the last hour or range (30m, 6h, 7d)',
+                    atabcomplete=graph_tab)
+
+    async def show_schedule(cmd: AdminCommandExecutor, cpage: int = 1):
+        _scheduler: Scheduler = ace.scheduler
+        _now = time.time()
+        _lines = []
+        for job in sorted(_scheduler.jobs.values(), key=lambda job: job.next_run or float('inf')):
+            if job.task is not None and not job.task.done():
+                _when = 'running now'
+            elif job.next_run is None:
+                _when = 'no more runs'
+            elif job.next_run < _now:
+                _when = f'OVERDUE by {_now - job.next_run:.0f} s'
+            else:
+                _when = f'in {job.next_run - _now:.0f} s'
+            _duration = f'{job.last_duration:.3f} s' if job.last_duration is not None else '-'
+            _lines.append(f'{job.id} ({job.rule}): {_when}, last run took {_duration}, max {job.max_duration:.3f} s, '
+                          f'{job.runs} runs, {job.failures} failed')
+        for job_id, state in _scheduler.persisted.items():
+            if job_id in _scheduler.jobs:
+                continue
+            _overdue = state['next_run'] is not None and state['next_run'] < _now
+            _lines.append(f'{job_id} ({ScheduleRule.from_json(state["rule"])}): '
+                          f'{"OVERDUE, " if _overdue else ""}saved, waiting for its owner to register it')
+        _maxpage, _start, _end = paginate_range(len(_lines), 10, cpage)
+        cmd.print(f'Scheduled jobs (page {cpage} of {_maxpage}):')
+        cmd.print(*_lines[_start:_end], sep='\n')
+    ace.add_command(show_schedule, 'stk-schedule', optargs=((int, 'page'), ),
+                    description='Shows upcoming and overdue scheduled jobs with their run durations')
+
+    async def show_looplag(cmd: AdminCommandExecutor, cpage: int = 1):
+        _monitor: LoopLagMonitor = ace.looplag
+        if _monitor is None:
+            cmd.error('Event loop lag monitor is disabled, set looplag_interval in config.json', log=False)
+            return
+        _p50, _p90, _p99 = _monitor.lag_percentiles()
+        cmd.print(f'Event loop lag over the last {len(_monitor.samples) * _monitor.interval:.0f} seconds: '
+                  f'p50 {_p50 * 1000:.1f} ms, p90 {_p90 * 1000:.1f} ms, p99 {_p99 * 1000:.1f} ms, '
+                  f'max {max(_monitor.samples, default=0.0) * 1000:.1f} ms. '
+                  + (f'{_monitor.slow_total} callbacks took longer than {_monitor.slow_callback * 1000:.0f} ms' if _monitor.slow_callback
+                     else 'Slow callbacks are not recorded, set looplag_slow_callback in config.json to find them'))
+        _slow = tuple(reversed(_monitor.slow_callbacks))
+        if not _slow:
+            return
+        _maxpage, _start, _end = paginate_range(len(_slow), 5, cpage)
+        cmd.print(f'Recent slow callbacks (page {cpage} of {_maxpage}):')
+        for slow in _slow[_start:_end]:
+            cmd.print(f'{time.strftime("%H:%M:%S", time.localtime(slow.time))} {slow.duration * 1000:.1f} ms {slow.description}')
+            cmd.print(*(f'    {frame}' for frame in slow.stack), sep='\n')
+    ace.add_command(show_looplag, 'stk-looplag', optargs=((int, 'page'), ),
+                    description='Shows the event loop lag percentiles and the recent slow callbacks')
+
+    async def show_handlers(cmd: AdminCommandExecutor, name: str = '', cpage: int = 1):
+        if not TimedHandlerChain.enabled:
+            cmd.error('Handler timing is disabled, set handler_timing to true in config.json and restart the wrapper', log=False)
+            return
+        _rows = sorted(((chain, stats) for chain in tuple(TimedHandlerChain.chains) if not name or chain.server == name
+                        for stats in chain.stats.values() if stats.calls),
+                       key=lambda row: row[1].max, reverse=True)
+        _maxpage, _start, _end = paginate_range(len(_rows), 10, cpage)
+        cmd.print(f'Slowest handlers{f" of {name}" if name else ""} (page {cpage} of {_maxpage}):')
+        cmd.print(*(f'{chain.server or "-"} {chain.name} {stats.name}: {stats.calls} calls, '
+                    f'avg {stats.total / stats.calls * 1000:.3f} ms, max {stats.max * 1000:.3f} ms, '
+                    f'total {stats.total:.3f} s, {stats.errors} errors'
+                    for chain, stats in _rows[_start:_end]), sep='\n')
+    ace.add_command(show_handlers, 'stk-handlers', optargs=((str, 'server name'), (int, 'page')),
+                    description='Shows the slowest event handlers, of all servers or of one server',
+                    atabcomplete=stkserver_tab)
+
+    async def show_tasks(cmd: AdminCommandExecutor, cpage: int = 1):
+        _registry: TaskRegistry = ace.task_registry
+        _lines = [f'{entry.name} [{entry.owner or "wrapper"}] {entry.description}: running for {entry.runtime:.1f} s'
+                  for entry in sorted(_registry.running.values(), key=lambda entry: entry.started)]
+        _lines.extend(f'{entry.name} [{entry.owner or "wrapper"}] {entry.description}: {entry.outcome} after {entry.runtime:.1f} s'
+                      for entry in reversed(_registry.history))
+        _maxpage, _start, _end = paginate_range(len(_lines), 10, cpage)
+        cmd.print(f'{len(_registry.running)} running tasks, then the finished ones (page {cpage} of {_maxpage}):')
+        cmd.print(*_lines[_start:_end], sep='\n')
+    ace.add_command(show_tasks, 'stk-tasks', optargs=((int, 'page'), ),
+                    description='Shows the running background tasks and the recently finished ones')
+
+    async def task_cancel_tab(cmd: AdminCommandExecutor, name: str = '', *, argl: str):
+        return [_name for _name in ace.task_registry.running if _name.startswith(name)]
+
+    async def cancel_task(cmd: AdminCommandExecutor, name: str):
+        if not ace.task_registry.cancel(name):
+            cmd.error(f'Task {name} is not running', log=False)
+            return
+        cmd.print(f'Task {name} cancelled')
+    ace.add_command(cancel_task, 'stk-tasks-cancel', ((str, 'task name'), ),
+                    description='Cancels a running background task', atabcomplete=task_cancel_tab)
+
+    async def show_events(cmd: AdminCommandExecutor, cpage: int = 1):
+        _bus: EventBus = ace.events
+        if ace.event_stream is None:
+            cmd.print('Event stream is disabled, set events_port in config.json and restart the wrapper')
+        else:
+            cmd.print(f'Event stream is listening on http://{ace.event_stream.host}:{ace.event_stream.port}/events')
+        _subscribers = sorted(_bus.subscribers, key=lambda subscriber: subscriber.peer)
+        _maxpage, _start, _end = paginate_range(len(_subscribers), 10, cpage)
+        cmd.print(f'{_bus.published} events published, {len(_subscribers)} subscribers '
+                  f'(queue {_bus.queue_size}, {_bus.slow_policy} when slow, page {cpage} of {_maxpage}):')
+        cmd.print(*(f'{subscriber.peer}: servers {",".join(sorted(subscriber.servers)) or "all"}, '
+                    f'types {",".join(sorted(subscriber.types)) or "all"}, {subscriber.queue.qsize()} queued, '
+                    f'{subscriber.delivered} delivered, {subscriber.dropped_total} dropped'
+                    for subscriber in _subscribers[_start:_end]), sep='\n')
+    ace.add_command(show_events, 'stk-events', optargs=((int, 'page'), ),
+                    description='Shows the subscribers of the event stream and their queues')
+
     async def server_norestart(cmd: AdminCommandExecutor, name: str):
         if name not in ace.servers:
             cmd.error('Server doesn\'t exist', log=False)
             return
         _server: STKServer = ace.servers[name]
-        if _server.timer_task is not None:
-            if not _server.timer_task.done():
-                _server.timer_task.cancel()
-                cmd.print(f'Timer task has been killed for {name}')
+        if _server.cancel_timed_restart():
+            cmd.print(f'Timer task has been killed for {name}')
         if _server.autorestart:
             cmd.print(f'Autorestart for server "{name}" has been disabled.')
             _server.autorestart = False
@@ -921,23 +3380,20 @@ def stkwrapper_command_set(ace: AdminCommandExecutor):
             cmd.error('Server doesn\'t exist', log=False)
             return
         _server: STKServer = ace.servers[name]
-        if _server.timer_task is not None:
-            if not _server.timer_task.done():
-                _server.timer_task.cancel()
-                cmd.print(f'Timer task has been killed for {name}')
+        if _server.cancel_timed_restart():
+            cmd.print(f'Timer task has been killed for {name}')
         _server.timed_autorestart = True
         _server.timed_autorestart_interval = interval_mins * 60
-        _server.timer_task = asyncio.create_task(_server._timed_restarter())
+        _server.start_timed_restart()
         cmd.print(f'Restarter enabled with {interval_mins} minutes.')
     ace.add_command(server_timedrestart, 'stk-timed-restart', ((str, 'name'), (int, 'interval_mins')), description='Enable autorestart timer for STK server')
 
     async def stk_stopall(cmd: AdminCommandExecutor):
         cmd.print('Stopping all the servers forcefully')
-        for server in ace.servers:
+        for server in ace.servers.values():
             if server.active:
                 server.restart = False
-                _tsk = asyncio.create_task(server.stop())
-                ace.tasks[_tsk.get_name()] = _tsk
+                ace.task_registry.spawn(server.stop(), owner=server.name, description='stop', tasks=ace.tasks)
     ace.add_command(stk_stopall, 'stk-stopall', description='Stops all servers')
 
     async def wrapper_reloadcfg(cmd: AdminCommandExecutor, full=False):
@@ -946,7 +3402,7 @@ def stkwrapper_command_set(ace: AdminCommandExecutor):
                 server.restart = False
             await asyncio.gather(*(server.stop(10) for server in ace.servers.values() if server.active))
             ace.servers.clear()
-        load_config()
+        load_config(ace)
         cmd.print('Configuration reloaded and changes are reverted.')
     ace.add_command(wrapper_reloadcfg, 'reloadcfg', optargs=((bool, 'hard reload?'), ),
                     description='Reloads config.json. When hard reload is enabled, turns all servers off within 10 seconds')
@@ -1206,10 +3662,222 @@ def stkwrapper_command_set(ace: AdminCommandExecutor):
                     atabcomplete=stkserver_tab)
 
 
+class ControlExecutor:
+    """
+    Stands for AdminCommandExecutor in the commands that are run over the control socket:
+    collects the output of print() and error() for the response, everything else is taken from the executor
+    """
+    def __init__(self, ace: AdminCommandExecutor):
+        self._ace = ace
+        self.output: MutableSequence[str] = []
+        self.errors: MutableSequence[str] = []
+
+    def __getattr__(self, name: str):
+        return getattr(self._ace, name)
+
+    @property
+    def ainput(self):
+        raise RuntimeError('interactive prompts are not available over the control socket')
+
+    def print(self, *values, sep=' ', **kwargs):
+        self.output.extend(sep.join(str(value) for value in values).splitlines())
+
+    def error(self, msg, log=True):
+        self.errors.extend(str(msg).splitlines())
+        if log:
+            self._ace.logger.error(msg)
+
+
+class ControlServer:
+    """
+    JSON lines API over a Unix socket for the scripts and the headless mode.
+    Request: {"id": 1, "command": "stk-servers"}
+    Response: {"id": 1, "ok": true, "output": [lines], "errors": [lines], "duration": seconds}
+    Requests are run concurrently, even within a single connection, so the responses may come out of order
+    """
+    def __init__(self, ace: AdminCommandExecutor, path: str):
+        self.ace = ace
+        self.path = path
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.clients: MutableMapping[asyncio.StreamWriter, MutableMapping[str, asyncio.Task]] = {}
+
+    async def start(self):
+        if os.path.exists(self.path):
+            # left by a previous wrapper
+            os.remove(self.path)
+        # only the owner may connect, the socket never exists with wider permissions
+        _sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        _umask = os.umask(0o077)
+        try:
+            _sock.bind(self.path)
+        except OSError:
+            _sock.close()
+            raise
+        finally:
+            os.umask(_umask)
+        self.server = await asyncio.start_unix_server(self._handle_client, sock=_sock)
+
+    async def stop(self):
+        if self.server is None:
+            return
+        self.server.close()
+        for writer, tasks in tuple(self.clients.items()):
+            for task in tasks.values():
+                task.cancel()
+            writer.close()
+        await self.server.wait_closed()
+        self.server = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    async def execute(self, cmdline: str) -> Tuple[bool, MutableSequence[str], MutableSequence[str]]:
+        """Runs the command line, returns whether it succeeded, its output and errors"""
+        executor = ControlExecutor(self.ace)
+        name, _, args = cmdline.strip().partition(' ')
+        if name not in self.ace.commands:
+            executor.error(f'Unknown command "{name}"', log=False)
+            return False, executor.output, executor.errors
+        try:
+            await self.ace.commands[name].execute(executor, args)
+        except Exception as exc:
+            self.ace.logger.exception(f'Control command "{cmdline}" failed:')
+            executor.error(f'{type(exc).__name__}: {exc}', log=False)
+        return not executor.errors, executor.output, executor.errors
+
+    async def _respond(self, writer: asyncio.StreamWriter, request: Mapping[str, Any]):
+        _start = time.monotonic()
+        ok, output, errors = await self.execute(request['command'])
+        writer.write(json.dumps({
+            'id': request.get('id'), 'ok': ok, 'output': output, 'errors': errors,
+            'duration': time.monotonic() - _start
+        }).encode() + b'\n')
+        await writer.drain()
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        tasks = self.clients[writer] = {}
+        try:
+            while not reader.at_eof():
+                line = await reader.readline()
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request.get('command'), str):
+                        raise ValueError('"command" must be a string')
+                except ValueError as exc:
+                    writer.write(json.dumps({'id': None, 'ok': False, 'output': [],
+                                             'errors': [f'invalid request: {exc}']}).encode() + b'\n')
+                    continue
+                _tsk = asyncio.create_task(self._respond(writer, request))
+                tasks[_tsk.get_name()] = _tsk
+                _tsk.add_done_callback(lambda task: tasks.pop(task.get_name(), None))
+            if tasks:
+                await asyncio.wait(tuple(tasks.values()))
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            for task in tasks.values():
+                task.cancel()
+            del self.clients[writer]
+            writer.close()
+
+
+class EventStreamServer:
+    """
+    Server-Sent Events endpoint of the EventBus: GET /events?servers=a,b&types=goal,player_join
+    Every event is sent as "id", "event" (the type) and "data" (JSON of the event) lines.
+    Events lost by a slow client are reported with a "dropped" event
+    """
+    keepalive_interval = 15.0
+    request_timeout = 10.0
+
+    def __init__(self, bus: EventBus, host: str, port: int):
+        self.bus = bus
+        self.host = host
+        self.port = port
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.clients: MutableMapping[asyncio.StreamWriter, EventSubscriber] = {}
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle_client, self.host, self.port)
+
+    async def stop(self):
+        if self.server is None:
+            return
+        self.server.close()
+        for writer, subscriber in tuple(self.clients.items()):
+            self.bus.unsubscribe(subscriber)
+            # a client that doesn't read would keep the unsent events forever
+            writer.transport.abort()
+        await self.server.wait_closed()
+        self.server = None
+
+    @staticmethod
+    def _response(writer: asyncio.StreamWriter, status: str, body: str = ''):
+        writer.write(f'HTTP/1.1 {status}\r\nContent-Type: text/plain\r\nContent-Length: {len(body)}\r\n'
+                     f'Connection: close\r\n\r\n{body}'.encode())
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            _head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.request_timeout)
+            _method, _target, *_ = _head.split(b'\r\n', 1)[0].decode('latin-1').split(' ')
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError, ConnectionError):
+            writer.close()
+            return
+        _url = urlsplit(_target)
+        if _method != 'GET' or _url.path != '/events':
+            self._response(writer, '404 Not Found', 'GET /events?servers=a,b&types=goal,player_join\n')
+            writer.close()
+            return
+        _query = parse_qs(_url.query)
+        _peer = writer.get_extra_info('peername')
+        subscriber = self.clients[writer] = self.bus.subscribe(
+            [name for value in _query.get('servers', ()) for name in value.split(',') if name],
+            [name for value in _query.get('types', ()) for name in value.split(',') if name],
+            f'{_peer[0]}:{_peer[1]}' if isinstance(_peer, tuple) else str(_peer))
+        try:
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n'
+                         b'Connection: keep-alive\r\n\r\n')
+            while True:
+                try:
+                    _event = await asyncio.wait_for(subscriber.queue.get(), self.keepalive_interval)
+                except asyncio.TimeoutError:
+                    writer.write(b': keepalive\n\n')
+                    await writer.drain()
+                    continue
+                if _event is None:
+                    break
+                if subscriber.dropped:
+                    writer.write(f'event: dropped\ndata: {json.dumps({"count": subscriber.dropped})}\n\n'.encode())
+                    subscriber.dropped = 0
+                writer.write(f'id: {_event["id"]}\nevent: {_event["type"]}\ndata: {json.dumps(_event)}\n\n'.encode())
+                subscriber.delivered += 1
+                # a slow client only waits here, its queue overflows instead of the publishers waiting
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.bus.unsubscribe(subscriber)
+            self.clients.pop(writer, None)
+            writer.close()
+
+
+async def _cleanup_control(ace: AdminCommandExecutor):
+    if ace.control is not None:
+        await ace.control.stop()
+    if ace.event_stream is not None:
+        await ace.event_stream.stop()
+
+
 async def _cleanup_servers(ace: AdminCommandExecutor):
-    for server in ace.servers.values():
+    # keep the saved schedules intact while the servers are being stopped
+    ace.scheduler.stop()
+    # in detached mode, the processes keep running until the next wrapper attaches to them
+    _detached = await asyncio.gather(*(server.detach() for server in ace.servers.values()))
+    _servers = tuple(server for server, detached in zip(ace.servers.values(), _detached) if not detached)
+    for server in _servers:
         server.restart = False
-    await asyncio.gather(*(server.stop(10, no_lock=True) for server in ace.servers.values() if server.active))
+    await asyncio.gather(*(server.stop(10, no_lock=True) for server in _servers if server.active))
 
 
 async def main():
@@ -1218,11 +3886,29 @@ async def main():
             file.write('{}')
     ace = AdminCommandExecutor({}, logger=logging.getLogger('STKServerWrapper'))
     ace.full_cleanup_steps.add(_cleanup_servers)
-    restarter_cond = ace.server_restart_cond = asyncio.Condition()
-    start_stop_guard = ace.start_stop_guard = asyncio.Lock()
+    ace.full_cleanup_steps.add(_cleanup_control)
+    ace.full_cleanup_steps.add(_cleanup_looplag)
+    ace.full_cleanup_steps.add(_cleanup_timeseries)
+    ace.full_cleanup_steps.add(_cleanup_watcher)
+    ace.looplag: Optional[LoopLagMonitor] = None
+    ace.control: Optional[ControlServer] = None
+    ace.event_stream: Optional[EventStreamServer] = None
+    # headless mode runs under a service manager, without the interactive prompt
+    _headless = ace.config['headless'] = ace.config.get('headless', False) or '--headless' in sys.argv[1:]
+    ace.writeln = ace.ainput.writeln if not _headless else ace.logger.info
+    ace.server_restart_cond = asyncio.Condition()
+    ace.start_stop_guard = asyncio.Lock()
+    ace.metrics = MetricsRegistry()
+    ace.timeseries: Optional[TimeSeriesStore] = None
+    ace.file_watcher: Optional[FileWatcher] = None
+    ace.task_registry = TaskRegistry(ace.logger)
+    ace.config['schedule_path'] = ace.config.get('schedule_path', 'schedule.json')
+    ace.config['scheduler_jitter'] = ace.config.get('scheduler_jitter', 5.0)
+    ace.scheduler = Scheduler(ace.logger, ace.config['schedule_path'], ace.config['scheduler_jitter'])
     ace.server_restart_clk = partial(server_restart_clk, ace)
     ace.servers: MutableMapping[str, STKServer] = {}
     _servers_to_start = []
+    _attached = []
     _ver = ace.config['stk_version'] = ace.config.get('stk_version', '1.4.0')
     _logpath = ace.config['logpath'] = ace.config.get('logpath', 'logs')
     _servers = ace.config['servers'] = ace.config.get('servers', {})
@@ -1247,6 +3933,45 @@ async def main():
         _server_startup_timeout = None
 
     ace.config['server_startup_timeout'] = _server_startup_timeout
+    ace.config['metrics_textfile'] = ace.config.get('metrics_textfile', '')
+    ace.config['child_watcher'] = ace.config.get('child_watcher', 'auto')
+    ace.config['event_loop'] = ace.config.get('event_loop', 'asyncio')
+    ace.config['watchdog_interval'] = ace.config.get('watchdog_interval', 30.0)
+    ace.config['watchdog_timeout'] = ace.config.get('watchdog_timeout', 15.0)
+    ace.config['watchdog_max_latency'] = ace.config.get('watchdog_max_latency', 10.0)
+    ace.config['watchdog_max_failures'] = ace.config.get('watchdog_max_failures', 3)
+    ace.config['detached'] = ace.config.get('detached', False)
+    ace.config['statedir'] = ace.config.get('statedir', 'state')
+    ace.config['log_verbosity'] = ace.config.get('log_verbosity', 'auto')
+    ace.config['reader_budget_lines'] = ace.config.get('reader_budget_lines', 200)
+    ace.config['reader_budget_ms'] = ace.config.get('reader_budget_ms', 10.0)
+    ace.config['stats_interval'] = ace.config.get('stats_interval', 60.0)
+    ace.config['stats_jitter'] = ace.config.get('stats_jitter', 10.0)
+    ace.config['stats_history'] = ace.config.get('stats_history', 360)
+    ace.config['metrics_interval'] = ace.config.get('metrics_interval', 15.0)
+    ace.config['file_watch'] = ace.config.get('file_watch', 'auto')
+    ace.config['file_watch_debounce'] = ace.config.get('file_watch_debounce', 1.0)
+    ace.config['file_watch_poll_interval'] = ace.config.get('file_watch_poll_interval', 2.0)
+    ace.config['timeseries_interval'] = ace.config.get('timeseries_interval', 10.0)
+    ace.config['timeseries_path'] = ace.config.get('timeseries_path', 'timeseries.json')
+    ace.config['timeseries_snapshot_interval'] = ace.config.get('timeseries_snapshot_interval', 300.0)
+    ace.config['timeseries_tiers'] = ace.config.get('timeseries_tiers', [list(tier) for tier in TimeSeriesStore.default_tiers])
+    # "auto" is control.sock in the headless mode and nothing in the interactive one
+    ace.config['control_socket'] = ace.config.get('control_socket', 'auto')
+    ace.config['events_host'] = ace.config.get('events_host', '127.0.0.1')
+    ace.config['events_port'] = ace.config.get('events_port', 0)
+    ace.config['events_queue_size'] = ace.config.get('events_queue_size', 256)
+    ace.config['events_slow_policy'] = ace.config.get('events_slow_policy', 'sample')
+    ace.config['events_sample_every'] = ace.config.get('events_sample_every', 10)
+    # extensions publish into it even when the stream is disabled, it costs nothing without subscribers
+    ace.events = EventBus(ace.logger, ace.config['events_queue_size'], ace.config['events_slow_policy'],
+                          ace.config['events_sample_every'], ace.metrics)
+    ace.config['looplag_interval'] = ace.config.get('looplag_interval', 0.5)
+    TimedHandlerChain.enabled = ace.config['handler_timing'] = ace.config.get('handler_timing', False)
+    ace.config['looplag_threshold'] = ace.config.get('looplag_threshold', 0.1)
+    # patches asyncio internals to time every callback, only for debugging
+    ace.config['looplag_slow_callback'] = ace.config.get('looplag_slow_callback', 0)
+    ace.config['looplag_report_interval'] = ace.config.get('looplag_report_interval', 60.0)
     _global_logignores = ace.config['global_logignores'] = ace.config.get('global_logignores', {})
     ace.global_logignores = make_logignores(_global_logignores)
     ace.save_config()
@@ -1256,7 +3981,11 @@ async def main():
     date_format = '%Y-%m-%d %H:%M:%S'
     time_format = '%H:%M:%S'
     record_format = '%(asctime)s [%(levelname)s] %(message)s'
-    stdout_handler = ARILogHandler(ace.ainput)
+    if _headless:
+        # no terminal to redraw, the service manager collects stderr
+        stdout_handler = logging.StreamHandler(sys.stderr)
+    else:
+        stdout_handler = ARILogHandler(ace.ainput)
     stdout_handler.setFormatter(
         logging.Formatter(record_format, date_format)
     )
@@ -1271,6 +4000,9 @@ async def main():
     )
     ace.logger.addHandler(file_handler)
     ace.logger.addHandler(stdout_handler)
+    ace.logger.info(f'Running on {type(asyncio.get_running_loop()).__module__} event loop')
+    _watcher = install_child_watcher(ace.config['child_watcher'], ace.logger)
+    ace.logger.info(f'Process exits are detected with the {_watcher} child watcher')
     print('Loading server list...')
     for servername, serverdata in _servers.items():
         # cwd: str, autorestart=True, timed_autorestart=False,
@@ -1278,8 +4010,8 @@ async def main():
         # restarter_cond: Optional[asyncio.Condition] = None,
         # extra_args: Optional[Sequence[str]] = tuple()):
         server = ace.servers[servername] = STKServer(
-            ace.logger, ace.ainput.writeln, servername, cfgpath=serverdata['cfgpath'],
-            restarter_cond=restarter_cond, start_stop_guard=start_stop_guard,
+            ace.logger, ace.writeln, servername, cfgpath=serverdata['cfgpath'],
+            **server_services(ace, serverdata),
             datapath=serverdata.get('datapath', ace.config['datapath']),
             executable_path=serverdata.get('executable_path', ace.config['executable_path']),
             cwd=serverdata.get('cwd', ace.config.get('cwd', os.getcwd())),
@@ -1295,20 +4027,67 @@ async def main():
             global_logignores=ace.global_logignores,
             logignores=make_logignores(serverdata.get('log_ignores', {}))
         )
-        if server.autostart:
+        if await server.attach(start_reading=False):
+            _attached.append(server)
+        elif server.autostart:
             _servers_to_start.append(server)
     basic_command_set(ace)
     stkwrapper_command_set(ace)
+    if ace.config['file_watch'] != 'off':
+        # extensions watch their own files
+        ace.file_watcher = FileWatcher(ace.logger, ace.config['file_watch'], ace.config['file_watch_debounce'],
+                                       ace.config['file_watch_poll_interval'])
+        ace.file_watcher.watch(_cfgfile_path, partial(_reload_wrapper_config, ace))
+        # saves of the wrapper itself are not reloaded
+        ace.save_config = partial(_save_wrapper_config, ace, ace.save_config)
+        ace.logger.info(f'Watching the config files for changes with {ace.file_watcher.mode}')
     await ace.load_extensions()
+    # the enhancers are ready now, so the output of re-attached servers can be processed
+    for server in _attached:
+        server.start_readers()
     ace.promptheader = '-=STK=-'
     ace.promptarrow = ':'
     ace.prompt_format = {'fgcolor': colors.GREEN}
     ace.input_format = {'fgcolor': colors.WHITE}
+    ace.scheduler.start()
+    if ace.config['looplag_interval']:
+        ace.looplag = LoopLagMonitor(ace.logger, ace.metrics, ace.config['looplag_interval'], ace.config['looplag_threshold'],
+                                     ace.config['looplag_slow_callback'], ace.config['looplag_report_interval'])
+        ace.looplag.start()
+    if ace.config['metrics_textfile']:
+        ace.scheduler.add_job('metrics:textfile', partial(_metrics_writer, ace), Interval(ace.config['metrics_interval']),
+                              jitter=0.0, persist=False)
+    ace.timeseries = TimeSeriesStore(ace.logger, ace.config['timeseries_path'] or None, ace.config['timeseries_tiers'])
+    ace.timeseries.load()
+    if ace.config['timeseries_interval']:
+        ace.scheduler.add_job('timeseries:sample', partial(_timeseries_sampler, ace), Interval(ace.config['timeseries_interval']),
+                              jitter=0.0, persist=False)
+    if ace.config['timeseries_path'] and ace.config['timeseries_snapshot_interval']:
+        ace.scheduler.add_job('timeseries:snapshot', ace.timeseries.snapshot, Interval(ace.config['timeseries_snapshot_interval']),
+                              jitter=0.0, persist=False)
+    _control_socket = ace.config['control_socket']
+    if _control_socket == 'auto':
+        _control_socket = 'control.sock' if _headless else ''
+    if _control_socket:
+        ace.control = ControlServer(ace, _control_socket)
+        await ace.control.start()
+        ace.logger.info(f'Control socket is listening on "{_control_socket}"')
+    if ace.config['events_port']:
+        ace.event_stream = EventStreamServer(ace.events, ace.config['events_host'], ace.config['events_port'])
+        await ace.event_stream.start()
+        ace.logger.info(f'Event stream is listening on http://{ace.config["events_host"]}:{ace.config["events_port"]}/events')
     # autostarting servers that has autostart enabled
     for server in _servers_to_start:
-        ace.print(f'Autostarting server {server.name}...')
-        _tsk = asyncio.create_task(server.launch())
-        ace.tasks[_tsk.get_name()] = _tsk
+        ace.logger.info(f'Autostarting server {server.name}...')
+        ace.task_registry.spawn(server.launch(), owner=server.name, description='autostart', tasks=ace.tasks)
+    if _headless:
+        _stop = asyncio.Event()
+        _loop = asyncio.get_running_loop()
+        for _signal in (signal.SIGTERM, signal.SIGINT):
+            _loop.add_signal_handler(_signal, _stop.set)
+        ace.logger.info('Running headless, send SIGTERM to stop')
+        await _stop.wait()
+        return await ace.full_cleanup()
     return await ace.prompt_loop()
 
 
@@ -1321,5 +4100,14 @@ async def extension_cleanup(self: AdminCommandExtension):
     self.msg('bye')
 
 
+def _configured_event_loop() -> str:
+    # the event loop is chosen before main() loads the config
+    try:
+        with open(_cfgfile_path, 'r') as file:
+            return json.load(file).get('event_loop', 'asyncio')
+    except (OSError, ValueError):
+        return 'asyncio'
+
+
 if __name__ == '__main__':
-    asyncio.run(main())
+    run(main(), _configured_event_loop())
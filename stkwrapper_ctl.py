@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+* stkwrapper_ctl.py - sends commands to the running wrapper over its control socket
+* License: GNU LGPL v2.1
+
+Usage: stkwrapper_ctl.py [-s control.sock] command [args...]
+Without a command, reads one command per line from stdin and runs them concurrently.
+Exits with code 1 if any command has failed.
+"""
+import argparse
+import asyncio
+import json
+import sys
+
+
+async def run(socket_path: str, commands) -> bool:
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    for i, command in enumerate(commands):
+        writer.write(json.dumps({'id': i, 'command': command}).encode() + b'\n')
+    await writer.drain()
+    ok = True
+    for _ in commands:
+        line = await reader.readline()
+        if not line:
+            print('Connection closed by the wrapper', file=sys.stderr)
+            return False
+        response = json.loads(line)
+        if len(commands) > 1:
+            print(f'>>> {commands[response["id"]]}')
+        for _line in response['output']:
+            print(_line)
+        for _line in response['errors']:
+            print(_line, file=sys.stderr)
+        ok = ok and response['ok']
+    writer.close()
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-s', '--socket', default='control.sock', help='path to the control socket of the wrapper')
+    parser.add_argument('command', nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    if args.command:
+        commands = [' '.join(args.command)]
+    else:
+        commands = [line.strip() for line in sys.stdin if line.strip()]
+    if not commands:
+        return
+    sys.exit(0 if asyncio.run(run(args.socket, commands)) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime
+
+import pytest
+
+from stkserver_wrapper import Cron, Interval, OneShot, ScheduleRule, Scheduler
+
+logger = logging.getLogger('test')
+
+
+def ts(*args) -> float:
+    return datetime(*args).timestamp()
+
+
+def test_cron_fields():
+    rule = Cron('*/15 2-4,6 1 1-12/6 *')
+    assert rule.minutes == {0, 15, 30, 45}
+    assert rule.hours == {2, 3, 4, 6}
+    assert rule.days == {1}
+    assert rule.months == {1, 7}
+    assert rule.weekdays == set(range(8))
+
+
+def test_cron_sunday_is_0_and_7():
+    assert Cron('0 0 * * 7').weekdays == {0, 7}
+    # 2024-01-07 is a Sunday
+    assert Cron('0 0 * * 7').next_after(ts(2024, 1, 3)) == ts(2024, 1, 7)
+    assert Cron('0 0 * * 0').next_after(ts(2024, 1, 3)) == ts(2024, 1, 7)
+
+
+@pytest.mark.parametrize('expr', ['* * * *', '60 * * * *', '* 24 * * *', '* * 0 * *', '* * * 13 *',
+                                  '5-1 * * * *', '*/0 * * * *', 'x * * * *'])
+def test_cron_invalid(expr):
+    with pytest.raises(ValueError):
+        Cron(expr)
+
+
+@pytest.mark.parametrize('expr, after, expected', [
+    # strictly after the given moment
+    ('30 2 * * *', (2024, 1, 1, 2, 30), (2024, 1, 2, 2, 30)),
+    ('30 2 * * *', (2024, 1, 1, 2, 29, 59), (2024, 1, 1, 2, 30)),
+    ('*/15 * * * *', (2024, 1, 1, 10, 46), (2024, 1, 1, 11, 0)),
+    # month and year rollover
+    ('0 0 1 * *', (2024, 1, 31, 12, 0), (2024, 2, 1, 0, 0)),
+    ('0 0 1 1 *', (2024, 3, 1), (2025, 1, 1)),
+    ('0 0 29 2 *', (2023, 3, 1), (2024, 2, 29)),
+    # day of month or day of week when both are restricted, 2024-09-13 is a Friday, 2024-09-06 too
+    ('0 0 13 * 5', (2024, 9, 1), (2024, 9, 6)),
+    ('0 0 13 * 5', (2024, 9, 12), (2024, 9, 13)),
+    # only day of week
+    ('0 12 * * 1-5', (2024, 9, 7, 13, 0), (2024, 9, 9, 12, 0)),
+])
+def test_cron_next_after(expr, after, expected):
+    assert Cron(expr).next_after(ts(*after)) == ts(*expected)
+
+
+def test_cron_never():
+    assert Cron('0 0 31 2 *').next_after(ts(2024, 1, 1)) is None
+
+
+def test_oneshot_and_interval():
+    assert OneShot(100.0).next_after(50.0) == 100.0
+    assert OneShot(100.0).next_after(100.0) is None
+    assert Interval(30).next_after(100.0) == 130.0
+    with pytest.raises(ValueError):
+        Interval(0)
+
+
+def test_rule_is_abstract():
+    with pytest.raises(TypeError):
+        ScheduleRule()
+
+
+@pytest.mark.parametrize('rule', [OneShot(1234.5), Interval(60), Cron('0 4 * * 1')])
+def test_rule_json_roundtrip(rule):
+    _data = json.loads(json.dumps(rule.to_json()))
+    _restored = ScheduleRule.from_json(_data)
+    assert type(_restored) is type(rule)
+    assert _restored.to_json() == rule.to_json()
+    assert _restored.next_after(ts(2024, 1, 1)) == rule.next_after(ts(2024, 1, 1))
+
+
+def noop():
+    pass
+
+
+def test_scheduler_persists_and_resumes(tmp_path):
+    path = str(tmp_path / 'schedule.json')
+    scheduler = Scheduler(logger, path)
+    job = scheduler.add_job('job', noop, Interval(3600), jitter=0.0)
+    scheduler.add_job('volatile', noop, Interval(3600), jitter=0.0, persist=False)
+    _next = job.next_run
+    scheduler.stop()
+    with open(path) as file:
+        saved = json.load(file)
+    assert set(saved) == {'job'}
+    assert saved['job']['rule'] == {'kind': 'interval', 'seconds': 3600}
+    assert saved['job']['next_run'] == _next
+
+    scheduler = Scheduler(logger, path)
+    assert scheduler.add_job('job', noop, Interval(3600), jitter=0.0).next_run == _next
+
+
+def test_scheduler_rule_change_is_not_resumed(tmp_path):
+    path = str(tmp_path / 'schedule.json')
+    scheduler = Scheduler(logger, path)
+    _next = scheduler.add_job('job', noop, Interval(3600), jitter=0.0).next_run
+    scheduler.stop()
+    scheduler = Scheduler(logger, path)
+    job = scheduler.add_job('job', noop, Interval(60), jitter=0.0)
+    assert job.next_run != _next
+    assert job.next_run <= time.time() + 60
+
+
+def test_scheduler_overdue_catch_up(tmp_path):
+    path = str(tmp_path / 'schedule.json')
+    _overdue = time.time() - 600
+    with open(path, 'w') as file:
+        json.dump({'job': {'rule': Interval(3600).to_json(), 'next_run': _overdue, 'last_run': None,
+                           'last_duration': None, 'runs': 3, 'owner': ''}}, file)
+    scheduler = Scheduler(logger, path)
+    job = scheduler.add_job('job', noop, Interval(3600), jitter=0.0)
+    # fires right away
+    assert job.next_run == _overdue
+    assert job.runs == 3
+    job = scheduler.add_job('job', noop, Interval(3600), jitter=0.0, catch_up=False)
+    assert job.next_run > time.time() + 3500
+
+
+def test_scheduler_remove_job_forgets(tmp_path):
+    path = str(tmp_path / 'schedule.json')
+    scheduler = Scheduler(logger, path)
+    scheduler.add_job('job', noop, Interval(3600))
+    scheduler.remove_job('job')
+    scheduler.save_state()
+    with open(path) as file:
+        assert json.load(file) == {}
+
+
+def test_scheduler_runs_jobs(tmp_path):
+    path = str(tmp_path / 'schedule.json')
+    runs = []
+
+    async def run():
+        scheduler = Scheduler(logger, path)
+        scheduler.start()
+        scheduler.add_job('once', lambda: runs.append('once'), OneShot(time.time() + 0.05))
+        scheduler.add_job('every', lambda: runs.append('every'), Interval(0.05), jitter=0.0)
+        await asyncio.sleep(0.3)
+        scheduler.stop()
+        return scheduler
+
+    scheduler = asyncio.run(run())
+    assert runs.count('once') == 1
+    assert runs.count('every') >= 3
+    # the one-shot job is done and forgotten, the other one is saved with its counters
+    assert 'once' not in scheduler.jobs
+    with open(path) as file:
+        saved = json.load(file)
+    assert set(saved) == {'every'}
+    assert saved['every']['runs'] >= 3